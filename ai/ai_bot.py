@@ -52,11 +52,18 @@ class AIBot(object):
         return result
 
     async def run(self):
+        for mw in self._middlewares:
+            await mw.start()
+
         while True:
             message: IncomingMessage = await incoming_queue.get()
 
             for mw in self._middlewares:
-                message = mw.incoming(message)
+                try:
+                    message = await mw.incoming(message)
+                except Exception:
+                    logger.exception(f"{mw.__class__.__name__} failed on message #{message.database_id}, dropping it")
+                    message = None
 
                 if message is None or isinstance(message, OutgoingMessage):
                     break
@@ -109,7 +116,11 @@ class AIBot(object):
                 )
 
                 for mw in reversed(self._middlewares):
-                    outgoing_message = mw.outgoing(outgoing_message)
+                    try:
+                        outgoing_message = await mw.outgoing(outgoing_message)
+                    except Exception:
+                        # Completion is already paid for, so it's sent as is
+                        logger.exception(f"{mw.__class__.__name__} failed on answer to #{message.database_id}")
 
                     if outgoing_message is None:
                         break
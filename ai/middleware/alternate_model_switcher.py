@@ -17,7 +17,7 @@ class AlternateModelSwitcherMiddleware(AIBotMiddleware):
     alternate_model = settings.openai.model_secondary
     switch_command = settings.openai.model_secondary_command
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         if self.switch_command in message.commands:
             logger.info(f"{self.__class__.__name__} Switched to model {self.alternate_model}")
             message.model = self.alternate_model
@@ -8,7 +8,12 @@ class AIBotMiddleware(object):
     Base middleware class for AIBot
     """
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def start(self) -> None:
+        """
+        This method is called once before AIBot starts processing messages
+        """
+
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         """
         This method should handle incoming message.
         It should return either:
@@ -18,7 +23,7 @@ class AIBotMiddleware(object):
         """
         return message
 
-    def outgoing(self, message: OutgoingMessage) -> t.Optional[OutgoingMessage]:
+    async def outgoing(self, message: OutgoingMessage) -> t.Optional[OutgoingMessage]:
         """
         This method should handle outgoing message.
         It should return message instance, probably modified, or None to stop processing
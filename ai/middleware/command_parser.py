@@ -16,7 +16,7 @@ class CommandParserMiddleware(AIBotMiddleware):
 
     command_prefix = settings.openai.command_prefix
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         while message.text.startswith(self.command_prefix):
             command_and_text = message.text.split(" ", maxsplit=1)
 
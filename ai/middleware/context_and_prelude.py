@@ -6,7 +6,8 @@ from textwrap import shorten
 
 from ai.types import OutgoingMessage
 from config import settings
-from db import Chat, Message, db_session, get_last_n_messages_for_ai
+from db_async import async_db
+from db_read import AIContextRecord, get_chat_list, get_last_messages_for_ai
 from util.plurals import pluralize
 from util.token_counter import count_tokens_for_message, get_encoder_for_model
 
@@ -44,9 +45,10 @@ class ContextWithPreludeMiddleware(AIBotMiddleware):
         self._prelude_tokens: t.DefaultDict[int, int] = defaultdict(int)  # {chat_id: prelude_tokens_count}
         self._encoders: t.Dict[str, object] = {}  # {model_name: encoder}
 
-        self._load_context_from_db()
+    async def start(self) -> None:
+        await async_db.run(self._load_context_from_db)
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         if self.command_clear_context in message.commands:
             clear_result = self._handle_command_clear_context(message)
 
@@ -70,7 +72,7 @@ class ContextWithPreludeMiddleware(AIBotMiddleware):
 
         return message
 
-    def outgoing(self, message: OutgoingMessage) -> t.Optional[OutgoingMessage]:
+    async def outgoing(self, message: OutgoingMessage) -> t.Optional[OutgoingMessage]:
         self._rotate_context(message)
         return message
 
@@ -209,7 +211,7 @@ class ContextWithPreludeMiddleware(AIBotMiddleware):
         logger.info(f"{self.__class__.__name__}: Encoder for {model_name} is loaded.")
         return self._encoders[model_name]
 
-    def _db_message_to_ai_message(self, message: Message):
+    def _db_message_to_ai_message(self, message: AIContextRecord):
         role = "assistant" if message.outgoing else "user"
         nick = f"{message.nick}: " if message.nick != "[FOR AI]" else ""
         content = nick + message.text
@@ -219,39 +221,27 @@ class ContextWithPreludeMiddleware(AIBotMiddleware):
     def _load_context_from_db(self):
         logger.info(f"{self.__class__.__name__}: Populating AI context from DB...")
 
-        def get_message_model(msg: Message) -> str:
-            msg_usage = None
+        for chat in get_chat_list():
+            chat_id = chat["id"]
+            tokens = self._prelude_tokens[chat_id]
+            self._context.setdefault(chat_id, deque())
 
-            if msg.outgoing:
-                msg_usage = msg.ai_usage.select().first()
-            else:
-                msg_usage = msg.user_usage.select().first()
+            for msg in get_last_messages_for_ai(chat_id, 300):
+                if chat["is_muc"] and msg.nick != self.bot_nick and not msg.text.strip().startswith(self.bot_nick):
+                    continue
 
-            return msg_usage.model.name if msg_usage else self.default_model
+                msg_model = msg.model or self.default_model
+                msg_encoder = self._get_encoder(msg_model)
+                msg = self._db_message_to_ai_message(msg)
+                msg_tokens = count_tokens_for_message(msg_encoder, (msg,))
 
-        with db_session:
-            chats = Chat.select()
+                if (tokens + msg_tokens) >= self.max_tokens:
+                    break
 
-            for chat in chats:
-                tokens = self._prelude_tokens[chat.id]
-                self._context.setdefault(chat.id, deque())
+                tokens += msg_tokens
+                self._context[chat_id].appendleft(self.ContextItem(message=msg, model=msg_model, tokens=msg_tokens))
 
-                for msg in get_last_n_messages_for_ai(chat, 300):
-                    if chat.is_muc and msg.nick != self.bot_nick and not msg.text.strip().startswith(self.bot_nick):
-                        continue
-
-                    msg_model = get_message_model(msg)
-                    msg_encoder = self._get_encoder(msg_model)
-                    msg = self._db_message_to_ai_message(msg)
-                    msg_tokens = count_tokens_for_message(msg_encoder, (msg,))
-
-                    if (tokens + msg_tokens) >= self.max_tokens:
-                        break
-
-                    tokens += msg_tokens
-                    self._context[chat.id].appendleft(self.ContextItem(message=msg, model=msg_model, tokens=msg_tokens))
-
-                self._context_tokens[chat.id] = tokens
+            self._context_tokens[chat_id] = tokens
 
         logger.info(f"{self.__class__.__name__}: AI context was populated")
 
@@ -2,7 +2,8 @@ import logging
 import typing as t
 
 from config import settings
-from db import is_user_blocked, add_user_in_blocklist, remove_user_from_blocklist, get_blocked_users
+from db import blocked_users, is_user_blocked
+from db_async import async_db
 from util.plurals import pluralize
 
 from ..types import IncomingMessage, OutgoingMessage
@@ -16,7 +17,7 @@ class DropIncomingIfAIDisabledMiddleware(AIBotMiddleware):
     Drop incoming message if AI is disabled
     """
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         if not settings.openai.enabled:
             logger.info(f"{self.__class__.__name__}: Message dropped")
             return None
@@ -31,7 +32,7 @@ class DropIncomingIfNotAddressedMiddleware(AIBotMiddleware):
 
     bot_nick = settings.openai.user_nick
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         if not message.is_muc:
             return message
 
@@ -59,23 +60,33 @@ class DropIncomingIfUserIsBlockedMiddleware(AIBotMiddleware):
         if "admin_jids" not in settings:
             logger.warning(f"{self.__class__.__name__}: admin_jids is not configured")
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
-        if message.is_muc and is_user_blocked(message.sender_nick):
+    async def start(self) -> None:
+        await async_db.run(blocked_users.get)
+
+    async def _is_user_blocked(self, jid_or_nick: str) -> bool:
+        # Blocklist is held in memory; database is only hit if it was invalidated
+        if blocked_users.loaded:
+            return is_user_blocked(jid_or_nick)
+
+        return await async_db.is_user_blocked(jid_or_nick)
+
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+        if message.is_muc and await self._is_user_blocked(message.sender_nick):
             logger.info(f"{self.__class__.__name__}: Message dropped (blocked nickname)")
             return None
 
-        if not message.is_muc and is_user_blocked(message.chat_jid):
+        if not message.is_muc and await self._is_user_blocked(message.chat_jid):
             logger.info(f"{self.__class__.__name__}: Message dropped (blocked jid)")
             return None
 
         if self.command_block_user in message.commands:
-            return self._handle_command_block(message)
+            return await self._handle_command_block(message)
 
         if self.command_unblock_user in message.commands:
-            return self._handle_command_unblock(message)
+            return await self._handle_command_unblock(message)
 
         if self.command_list_blocked_users in message.commands:
-            return self._handle_command_blocklist(message)
+            return await self._handle_command_blocklist(message)
 
         return message
 
@@ -96,14 +107,14 @@ class DropIncomingIfUserIsBlockedMiddleware(AIBotMiddleware):
 
         return True, None
 
-    def _handle_command_block(self, message: IncomingMessage) -> OutgoingMessage:
+    async def _handle_command_block(self, message: IncomingMessage) -> OutgoingMessage:
         can_execute, error_message = self._check_privileges(message)
 
         if not can_execute:
             return error_message
 
         jid_or_nick = message.text
-        add_user_in_blocklist(jid_or_nick)
+        await async_db.add_user_in_blocklist(jid_or_nick)
 
         return OutgoingMessage(
             chat_id=message.chat_id,
@@ -111,14 +122,14 @@ class DropIncomingIfUserIsBlockedMiddleware(AIBotMiddleware):
             text=f"{jid_or_nick} is added to blocklist",
         )
 
-    def _handle_command_unblock(self, message: IncomingMessage) -> OutgoingMessage:
+    async def _handle_command_unblock(self, message: IncomingMessage) -> OutgoingMessage:
         can_execute, error_message = self._check_privileges(message)
 
         if not can_execute:
             return error_message
 
         jid_or_nick = message.text
-        is_unblocked = remove_user_from_blocklist(jid_or_nick)
+        is_unblocked = await async_db.remove_user_from_blocklist(jid_or_nick)
 
         if not is_unblocked:
             return OutgoingMessage(
@@ -133,13 +144,13 @@ class DropIncomingIfUserIsBlockedMiddleware(AIBotMiddleware):
             text=f"{jid_or_nick} is removed from blocklist",
         )
 
-    def _handle_command_blocklist(self, message: IncomingMessage) -> OutgoingMessage:
+    async def _handle_command_blocklist(self, message: IncomingMessage) -> OutgoingMessage:
         can_execute, error_message = self._check_privileges(message)
 
         if not can_execute:
             return error_message
 
-        blocked_users = get_blocked_users()
+        blocked_users = await async_db.get_blocked_users()
 
         if len(blocked_users) == 0:
             return OutgoingMessage(
@@ -14,9 +14,10 @@ HELP = """Команды начинаются с символа ~. У бота 
 ~4 - использовать модель GPT 4 (дороже)
 ~t <temp> - задать температуру для запроса (temp - число от 0.0 до 2.0)
 ~$ - посчитать деньги потраченные на этот запрос
-~usage [global] [days] - показать статистику использования. Примеры:
+~usage [global] [days|all] - показать статистику использования. Примеры:
   - ~usage 7 - статистика использования в этом чате за неделю
   - ~usage global - статистика использования по всем чатам за месяц
+  - ~usage global all - статистика использования по всем чатам за всё время
 
 Некоторые команды можно комбинировать, например:
   - ~clear ~dan <text> - очистит контекст и сгенерирует ответ с помощью DAN
@@ -30,7 +31,7 @@ HELP = """Команды начинаются с символа ~. У бота 
 
 
 class HelpCommandHandlerMiddleware(AIBotMiddleware):
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         if "help" in message.commands:
             return OutgoingMessage(
                 message.chat_id,
@@ -9,6 +9,6 @@ class StripMessageTextMiddleware(AIBotMiddleware):
     Trim space characters in message text
     """
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         message.text = message.text.strip()
         return message
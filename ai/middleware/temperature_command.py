@@ -11,7 +11,7 @@ class TemperatureCommandMiddleware(AIBotMiddleware):
 
     command_set_temperature = "t"
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         if self.command_set_temperature in message.commands:
             return self._handle_command_t(message)
         return message
@@ -4,7 +4,8 @@ from dataclasses import dataclass
 from textwrap import shorten
 
 from ai.types import OutgoingMessage
-from db import get_usage_for_last_n_days
+from db_async import async_db
+from db_read import get_usage_for_last_n_days
 from util.plurals import pluralize
 
 from ..types import IncomingMessage, OutgoingMessage
@@ -15,6 +16,9 @@ GPT_4_PRICE_PER_1K_OUTPUT_TOKENS = 0.06
 GPT_3_5_PRICE_PER_1K_INPUT_TOKENS = 0.0015
 GPT_3_5_PRICE_PER_1K_OUTPUT_TOKENS = 0.002
 
+# Longer periods don't fit in datetime; "all" is for them
+MAX_DAYS = 36500
+
 
 @dataclass
 class UsageStats:
@@ -49,7 +53,7 @@ class UsageCommandMiddleware(AIBotMiddleware):
 
     command = "usage"
 
-    def _make_report(self, global_: bool, n_days=30) -> str:
+    def _make_report(self, global_: bool, n_days: t.Optional[int] = 30, chat_id: t.Optional[int] = None) -> str:
         result = []
         table = []
         table_col_width = defaultdict(int)
@@ -70,8 +74,12 @@ class UsageCommandMiddleware(AIBotMiddleware):
         def result_hline():
             result.append("-:-".join(("-" * min(30, table_col_width[i]) for i in range(len(table_col_width)))))
 
-        days_plural = pluralize(n_days, "день", "дней", "дня")
-        days_text = "сегодня" if n_days == 1 else f"последние {n_days} {days_plural}"
+        if n_days is None:
+            days_text = "всё время"
+        elif n_days == 1:
+            days_text = "сегодня"
+        else:
+            days_text = f"последние {n_days} {pluralize(n_days, 'день', 'дней', 'дня')}"
 
         if global_:
             result.append(f"Статистика использования по всем чатам за {days_text}:")
@@ -81,7 +89,9 @@ class UsageCommandMiddleware(AIBotMiddleware):
             row_output("#", "User", "Total", "4 in", "4 out", "3.5 in", "3.5 out")
 
         # Count in tokens
-        for chat_name, nick, model, tok_compl, tok_prompt, tok_total in get_usage_for_last_n_days(n_days):
+        for chat_name, nick, model, tok_compl, tok_prompt, tok_total in get_usage_for_last_n_days(
+            n_days, chat_id=None if global_ else chat_id
+        ):
             if global_:
                 stat = chat_usage[chat_name]
             else:
@@ -157,7 +167,7 @@ class UsageCommandMiddleware(AIBotMiddleware):
 
         return "\n".join(result)
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         if self.command not in message.commands:
             return message
 
@@ -165,15 +175,17 @@ class UsageCommandMiddleware(AIBotMiddleware):
         n_days = 30
 
         for msg_part in message.text.split(" ", maxsplit=2):
-            if msg_part.isdigit():
-                n_days = max(1, min(30, int(msg_part)))
+            if msg_part.isdecimal():
+                n_days = max(1, min(int(msg_part), MAX_DAYS))
+            elif msg_part.lower() == "all":
+                n_days = None
             elif msg_part.lower() == "global":
                 global_ = True
 
         return OutgoingMessage(
             chat_id=message.chat_id,
             reply_for=message.database_id,
-            text=self._make_report(global_, n_days),
+            text=await async_db.run(self._make_report, global_, n_days, message.chat_id),
         )
 
 
@@ -184,7 +196,7 @@ class UsageInlineCommandMiddleware(AIBotMiddleware):
 
     command = "$"
 
-    def outgoing(self, message: OutgoingMessage) -> t.Optional[OutgoingMessage]:
+    async def outgoing(self, message: OutgoingMessage) -> t.Optional[OutgoingMessage]:
         if self.command not in message.commands:
             return message
 
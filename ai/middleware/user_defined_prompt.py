@@ -11,7 +11,7 @@ class UserDefinedPromptMiddleware(AIBotMiddleware):
     Handles user defined prompts
     """
 
-    def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
+    async def incoming(self, message: IncomingMessage) -> t.Optional[t.Union[IncomingMessage, OutgoingMessage]]:
         if not "prompt" in settings.openai:
             return message
 
@@ -1,7 +1,7 @@
 import asyncio
 import secrets
 import typing as t
-from asyncio.queues import Queue
+from asyncio import Queue
 from hashlib import sha512
 from uuid import UUID, uuid4
 
@@ -19,11 +19,26 @@ from starlette.types import Receive, Scope, Send
 from starlette.websockets import WebSocket
 
 import db
+import invalidation
+import resume
+import ws_protocol
 from config import settings
+from event_bus import WS_TOPIC, RedisEventBus, event_bus
+from redis_cache import async_cache
+from util import stats
 from util.signer import Signer
+from ws_queue import ClientQueue, EncodedEvent, create_queue, encode_events, queue_stats
+
+try:
+    from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+    from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+except ImportError:
+    WebSocketProtocol = None
 
 cookie_signer = Signer(settings.webui.signing_key, settings.webui.auth_expiration)
-ws_clients: t.Mapping[UUID, Queue] = {}
+ws_clients: t.Dict[UUID, ClientQueue] = {}
+
+stats.register("ws_clients", lambda: queue_stats(ws_clients.values()))
 
 
 class SignedCookieAuthenticationBackend(AuthenticationBackend):
@@ -108,36 +123,67 @@ async def ws(websocket: WebSocket):
     if not token or not cookie_signer.check_token(token):
         await websocket.close()
 
-    await websocket.accept()
+    protocol = ws_protocol.negotiate(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=protocol)
 
     client_id = uuid4()
-    sender_queue = Queue()
+    sender_queue = create_queue()
     ws_clients[client_id] = sender_queue
 
+    # Events missed while client was disconnected, e.g. by restart of this worker. Client is registered first,
+    # so events fanned out while they are read aren't missed either
+    since = websocket.query_params.get("since")
+
+    if since:
+        sender_queue.put_missed(encode_events(await event_bus.replay(WS_TOPIC, since)))
+
     from ws_handler import command_router
 
+    # Commands run concurrently, so responses may arrive out of order and carry `request_id` of their command
+    inflight = asyncio.Semaphore(settings.get("webui.max_inflight_commands", 8))
+    commands: t.Set[asyncio.Task] = set()
+
+    async def run_command(message):
+        # respond() never fails, so every command gets a response
+        sender_queue.put_response(await command_router.respond(message, protocol))
+
     async def receiver():
         async for message in websocket.iter_json():
-            result = command_router.execute(message)
-            await websocket.send_json(result)
+            # Frames aren't read while the connection has too many commands in flight. Command stays in flight
+            # until its response is written, so unsent responses are bounded as well
+            await inflight.acquire()
+            task = asyncio.create_task(run_command(message))
+            commands.add(task)
+            task.add_done_callback(commands.discard)
 
     async def sender():
-        try:
-            while True:
-                message = await sender_queue.get()
-                await websocket.send_json(message)
-                sender_queue.task_done()
-        except asyncio.CancelledError:
-            return
+        while True:
+            message = await sender_queue.get()
+
+            # Client didn't keep up with events
+            if message is None:
+                return
+
+            if isinstance(message, EncodedEvent):
+                await websocket.send_text(message.text(protocol))
+            elif isinstance(message, str):
+                # Command response
+                await websocket.send_text(message)
+                inflight.release()
+            else:
+                await websocket.send_text(ws_protocol.encode(message, protocol))
+
+    tasks = (asyncio.create_task(receiver()), asyncio.create_task(sender()))
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
 
-    sender_coroutine = sender()
-    await asyncio.wait((receiver(), sender_coroutine), return_when=asyncio.FIRST_COMPLETED)
+    for task in (*tasks, *commands):
+        task.cancel()
 
-    sender_coroutine.throw(asyncio.CancelledError)
-    sender_coroutine.close()
+    await asyncio.gather(*tasks, *commands, return_exceptions=True)
 
     del ws_clients[client_id]
-    await websocket.close()
+    # 1013 is "try again later"
+    await websocket.close(code=1013 if sender_queue.disconnected else 1000)
 
 
 app = Starlette(
@@ -154,20 +200,128 @@ app = Starlette(
 )
 
 
+background_tasks: t.List[asyncio.Task] = []
+
+
+async def fanout_task():
+    """
+    Deliver bus events to websocket clients of this worker. Every event is encoded once for all clients;
+    with `webui.event_batch_ms` window, new_message events arriving within it go out as one frame
+    """
+    window = settings.get("webui.event_batch_ms", 0) / 1000
+    loop = asyncio.get_running_loop()
+    received = Queue()
+
+    async def receive():
+        async for item in event_bus.subscribe(WS_TOPIC):
+            resume.ring.add(item[1])
+            received.put_nowait(item)
+
+    await resume.preload()
+    receiver = asyncio.create_task(receive())
+
+    try:
+        while True:
+            batch = [await received.get()]
+            deadline = loop.time() + window
+
+            while window and loop.time() < deadline:
+                try:
+                    batch.append(await asyncio.wait_for(received.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+
+            for frame in encode_events(batch, pack=bool(window)):
+                for q in ws_clients.values():
+                    q.put_event(frame)
+    finally:
+        receiver.cancel()
+
+
 @app.on_event("startup")
 def main():
-    from bot import bot_task
-
     db.db_init()
 
     loop = asyncio.get_running_loop()
-    loop.create_task(bot_task(ws_clients))
+    background_tasks.append(loop.create_task(fanout_task()))
+
+    # Disabled when bot runs in its own process with `python bot.py`, e.g. to serve web UI with several workers
+    if settings.get("webui.run_bot", True):
+        from bot import bot_task
+
+        background_tasks.append(loop.create_task(bot_task()))
+
+    invalidation.start_listener()
+
+    if settings.get("archive.enabled", False):
+        from archive import maintenance_task
+
+        background_tasks.append(loop.create_task(maintenance_task()))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # bot_task drains the batched writer when cancelled
+    for task in background_tasks:
+        task.cancel()
+
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await event_bus.close()
+    await async_cache.close()
+
+
+if WebSocketProtocol is not None:
+
+    class CompressedWebSocketProtocol(WebSocketProtocol):
+        """
+        permessage-deflate with settings of [webui.ws_compression] instead of library defaults
+        """
+
+        def __init__(self, *args, **kwargs) -> None:
+            super().__init__(*args, **kwargs)
+            window_bits = settings.get("webui.ws_compression.window_bits", 15)
+            self.available_extensions = [
+                ServerPerMessageDeflateFactory(
+                    server_max_window_bits=window_bits,
+                    client_max_window_bits=window_bits,
+                    compress_settings={
+                        "level": settings.get("webui.ws_compression.level", 6),
+                        "memLevel": settings.get("webui.ws_compression.mem_level", 8),
+                    },
+                )
+            ]
+
+
+def check_workers(workers: int, run_bot: bool) -> None:
+    """
+    Every worker process runs startup of the app, so with several of them bot must run in its own process, and
+    events have to go between processes through Redis
+    """
+    if workers <= 1:
+        return
+
+    if run_bot:
+        raise RuntimeError("Each of several web UI workers would run the bot: set webui.run_bot = false")
+
+    if not isinstance(event_bus, RedisEventBus):
+        raise RuntimeError("Several web UI workers need Redis for event bus: set redis.enabled = true")
 
 
 if __name__ == "__main__":
+    workers = settings.get("webui.workers", 1)
+    check_workers(workers, settings.get("webui.run_bot", True))
+    ws_options = {}
+
+    if settings.get("webui.ws_compression.enabled", True) and WebSocketProtocol is not None:
+        ws_options["ws"] = CompressedWebSocketProtocol
+    else:
+        ws_options["ws_per_message_deflate"] = False
+
     uvicorn.run(
         "app:app",
         host=settings.webui.listen,
         port=settings.webui.port,
+        workers=workers,
         loop="asyncio",
+        **ws_options,
     )
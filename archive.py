@@ -0,0 +1,173 @@
+"""
+Message archive maintenance
+
+Messages older than `archive.hot_days` are moved from Message to ArchivedMessage table (together with their
+AIUsage rows), so queries on hot path only touch recent history. Archived rows keep their ids and can be
+read back on demand. Archived rows older than `archive.retention_days` are pruned, if retention is configured.
+"""
+import asyncio
+import logging
+import typing as t
+from datetime import datetime, timedelta
+
+import pytz
+
+from config import settings
+from db import db, db_session, raw_connection, to_utc_hour
+from db_async import async_db
+from invalidation import tiered_cache
+
+logger = logging.getLogger(__name__)
+
+HOT_DAYS = settings.get("archive.hot_days", 90)
+RETENTION_DAYS = settings.get("archive.retention_days", 0)
+BATCH_SIZE = settings.get("archive.batch_size", 5000)
+INTERVAL_MINUTES = settings.get("archive.interval_minutes", 60)
+VACUUM = settings.get("archive.vacuum", False)
+
+_BATCH_MESSAGES = "SELECT id FROM message WHERE id <= $max_id AND utctime < $cutoff"
+_FTS_KEY = {"sqlite": "rowid", "postgres": "id"}
+
+
+def hot_cutoff() -> datetime:
+    """
+    Messages older than this may be in archive; newer ones are always in Message table
+    """
+    return datetime.now().astimezone(pytz.utc) - timedelta(days=HOT_DAYS)
+
+
+@db_session
+def archive_batch(cutoff: datetime, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Move up to `batch_size` oldest messages with their AI usage into archive tables in one transaction.
+    Returns number of archived messages
+    """
+    (max_id,) = db.select(
+        "SELECT max(id) FROM (SELECT id FROM message WHERE utctime < $cutoff ORDER BY id LIMIT $batch_size) AS batch"
+    )
+
+    if max_id is None:
+        return 0
+
+    db.execute(
+        "INSERT INTO archivedaiusage (id, model, prompt, completion, completion_tokens, prompt_tokens, total_tokens)"
+        " SELECT id, model, prompt, completion, completion_tokens, prompt_tokens, total_tokens FROM aiusage"
+        f" WHERE prompt IN ({_BATCH_MESSAGES}) OR completion IN ({_BATCH_MESSAGES})"
+    )
+    db.execute(f"DELETE FROM aiusage WHERE prompt IN ({_BATCH_MESSAGES}) OR completion IN ({_BATCH_MESSAGES})")
+
+    archived = db.execute(
+        "INSERT INTO archivedmessage (id, chat, utctime, msg_type, nick, text, text_compressed, outgoing)"
+        " SELECT id, chat, utctime, msg_type, nick, text, text_compressed, outgoing FROM message"
+        " WHERE id <= $max_id AND utctime < $cutoff"
+    ).rowcount
+    db.execute("DELETE FROM message WHERE id <= $max_id AND utctime < $cutoff")
+
+    return archived
+
+
+@db_session
+def get_pruned_hours(cutoff: datetime) -> t.Dict[int, t.List[int]]:
+    """
+    Hours of calendar index per chat which prune_archive() with the same cutoff deletes messages of
+    """
+    # Including the cutoff hour, which is kept in the index, but loses messages before cutoff
+    cutoff_hour = to_utc_hour(cutoff)
+    hours_by_chat = {}
+
+    for chat_id, hour in db.select("SELECT chat, hour FROM chatday WHERE hour <= $cutoff_hour"):
+        hours_by_chat.setdefault(chat_id, []).append(hour)
+
+    return hours_by_chat
+
+
+@db_session
+def prune_archive(cutoff: datetime) -> int:
+    _archived_batch = "SELECT id FROM archivedmessage WHERE utctime < $cutoff"
+
+    db.execute(f"DELETE FROM archivedaiusage WHERE prompt IN ({_archived_batch}) OR completion IN ({_archived_batch})")
+    db.execute(f"DELETE FROM message_fts WHERE {_FTS_KEY[db.provider_name]} IN ({_archived_batch})")
+    db.execute(
+        "UPDATE chatsummary SET message_count = message_count"
+        " - (SELECT count(*) FROM archivedmessage a WHERE a.chat = chatsummary.chat AND a.utctime < $cutoff)"
+    )
+    pruned = db.execute("DELETE FROM archivedmessage WHERE utctime < $cutoff").rowcount
+
+    # Only hours which are entirely before cutoff; the cutoff hour still has messages left
+    cutoff_hour = to_utc_hour(cutoff)
+    db.execute("DELETE FROM chatday WHERE hour < $cutoff_hour")
+
+    return pruned
+
+
+def optimize(vacuum: bool = VACUUM) -> None:
+    # VACUUM can't run inside of a transaction opened by Pony
+    connection = raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        if db.provider_name == "postgres":
+            for table in ("message", "aiusage", "archivedmessage", "archivedaiusage"):
+                cursor.execute(f"VACUUM ANALYZE {table}" if vacuum else f"ANALYZE {table}")
+        else:
+            cursor.execute("ANALYZE")
+
+            if vacuum:
+                cursor.execute("VACUUM")
+    finally:
+        connection.close()
+
+
+def run_maintenance() -> t.Dict[int, t.List[int]]:
+    """
+    Archive old messages and prune expired ones. Returns pruned hours per chat, see get_pruned_hours()
+    """
+    cutoff = hot_cutoff()
+    pruned_hours = {}
+    total = 0
+
+    while True:
+        archived = archive_batch(cutoff)
+        total += archived
+
+        if archived == 0:
+            break
+
+        logger.info(f"Archived {archived} messages older than {cutoff:%Y-%m-%d}, {total} in total")
+
+    if RETENTION_DAYS:
+        retention_cutoff = datetime.now().astimezone(pytz.utc) - timedelta(days=RETENTION_DAYS)
+        pruned_hours = get_pruned_hours(retention_cutoff)
+        pruned = prune_archive(retention_cutoff)
+        logger.info(f"Pruned {pruned} archived messages older than {retention_cutoff:%Y-%m-%d}")
+
+    optimize()
+    return pruned_hours
+
+
+async def invalidate_pruned(pruned_hours: t.Dict[int, t.List[int]]) -> None:
+    """
+    Drop cached day pages and calendar hours of chats which lost messages to pruning
+    """
+    # ws_handler imports this module
+    from ws_handler import ChatMessagesHandler
+
+    for chat_id, hours in pruned_hours.items():
+        await ChatMessagesHandler.invalidate_hours(chat_id, hours)
+
+    await tiered_cache.delete(
+        *(key for chat_id in pruned_hours for key in (f"chat_hours:{chat_id}", f"chat_hours:{chat_id}_latest"))
+    )
+
+
+async def maintenance_task() -> None:
+    logger.info(f"Archive maintenance: hot window is {HOT_DAYS} days, running every {INTERVAL_MINUTES} minutes")
+
+    while True:
+        try:
+            await invalidate_pruned(await async_db.run(run_maintenance))
+        except Exception:
+            logger.exception("Archive maintenance failed")
+
+        await asyncio.sleep(INTERVAL_MINUTES * 60)
@@ -1,7 +1,5 @@
 import asyncio
 import logging
-import typing as t
-from uuid import UUID
 
 import aioxmpp
 import aioxmpp.muc
@@ -10,30 +8,26 @@ import db
 from ai import ai_bot
 from ai import types as ai_types
 from config import settings
+from db_async import async_db
+from db_writer import writer
+from event_bus import OUTGOING_TOPIC, event_bus
 from models import MessageModel
+from resume import publish_message, sequencer
 from util.xmpp import create_message
-from ws_handler import OutgoingMessage, outgoing_queue
+from ws_handler import ChatMessagesHandler, OutgoingMessage
 from xmpp import ClientVersion, Handler, XMPPClient
 
 logger = logging.getLogger(__name__)
 
 
-def notify_ws_clients(clients, data):
-    for _, q in clients.items():
-        q.put_nowait(data)
+async def send_message_to_ws_clients(message: db.StoredMessage):
+    # First await after storing, so messages of chat are numbered in storage order
+    async with sequencer.lock(message.chat.id):
+        await ChatMessagesHandler.invalidate(message.chat.id, message.utctime)
+        await publish_message(MessageModel.from_orm(message).dict())
 
 
-def send_message_to_ws_clients(clients, message: db.Message):
-    notify_ws_clients(
-        clients,
-        {
-            "command": "new_message",
-            "message": MessageModel.from_orm(message).dict(),
-        },
-    )
-
-
-async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
+async def bot_task():
     bot = XMPPClient(
         jid=settings.xmpp.jid,
         password=settings.xmpp.password,
@@ -43,16 +37,16 @@ async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
     )
 
     @bot.register_handler(Handler.MESSAGE)
-    def on_message(message: aioxmpp.Message):
+    async def on_message(message: aioxmpp.Message):
         barejid = message.from_.bare()
         is_muc_privmsg = bot.get_room_by_muc_jid(barejid) is not None
 
         if is_muc_privmsg:
-            message_in_db = db.store_muc_privmsg(message)
+            message_in_db = await writer.store(db.make_muc_privmsg(message))
         else:
-            message_in_db = db.store_message(message)
+            message_in_db = await writer.store(db.make_message(message))
 
-        send_message_to_ws_clients(ws_clients, message_in_db)
+        await send_message_to_ws_clients(message_in_db)
 
         ai_bot.incoming_queue.put_nowait(
             ai_types.IncomingMessage(
@@ -66,9 +60,9 @@ async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
         )
 
     @bot.register_handler(Handler.MUC_MESSAGE)
-    def on_muc_message(message: aioxmpp.Message, member: aioxmpp.muc.Occupant, source, **kwargs):
-        message = db.store_muc_message(message, member)
-        send_message_to_ws_clients(ws_clients, message)
+    async def on_muc_message(message: aioxmpp.Message, member: aioxmpp.muc.Occupant, source, **kwargs):
+        message = await writer.store(db.make_muc_message(message, member))
+        await send_message_to_ws_clients(message)
         ai_bot.incoming_queue.put_nowait(
             ai_types.IncomingMessage(
                 database_id=message.id,
@@ -81,19 +75,19 @@ async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
         )
 
     @bot.register_handler(Handler.MUC_USER_JOIN)
-    def on_muc_user_join(member: aioxmpp.muc.Occupant, **kwargs):
-        message = db.store_muc_user_join(member)
-        send_message_to_ws_clients(ws_clients, message)
+    async def on_muc_user_join(member: aioxmpp.muc.Occupant, **kwargs):
+        message = await writer.store(db.make_muc_user_join(member))
+        await send_message_to_ws_clients(message)
 
     @bot.register_handler(Handler.MUC_USER_LEAVE)
-    def on_muc_leave(occupant: aioxmpp.muc.Occupant, muc_leave_mode: aioxmpp.muc.LeaveMode = None, **kwargs):
-        message = db.store_muc_user_leave(occupant, muc_leave_mode)
-        send_message_to_ws_clients(ws_clients, message)
+    async def on_muc_leave(occupant: aioxmpp.muc.Occupant, muc_leave_mode: aioxmpp.muc.LeaveMode = None, **kwargs):
+        message = await writer.store(db.make_muc_user_leave(occupant, muc_leave_mode))
+        await send_message_to_ws_clients(message)
 
     @bot.register_handler(Handler.MUC_TOPIC_CHANGED)
-    def on_topic_changed(member: aioxmpp.muc.ServiceMember, new_topic, *args, **kwargs):
-        message = db.store_muc_topic(member, new_topic)
-        send_message_to_ws_clients(ws_clients, message)
+    async def on_topic_changed(member: aioxmpp.muc.ServiceMember, new_topic, *args, **kwargs):
+        message = await writer.store(db.make_muc_topic(member, new_topic))
+        await send_message_to_ws_clients(message)
 
     for _, room in settings.xmpp.rooms.items():
         if not room.join:
@@ -102,12 +96,12 @@ async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
         bot.join_room(room.jid, room.nick)
 
     async def webui_outgoing_messages_handler():
-        while True:
-            msg: OutgoingMessage = await outgoing_queue.get()
+        async for _, event in event_bus.subscribe(OUTGOING_TOPIC):
+            msg = OutgoingMessage(**event)
             msg_xmpp = create_message(msg.jid, msg.text, msg.is_muc, bot.jid)
 
             if msg.for_ai:
-                message_in_db = db.store_message_for_ai(msg_xmpp, msg.is_muc)
+                message_in_db = await writer.store(db.make_message_for_ai(msg_xmpp, msg.is_muc))
                 ai_bot.incoming_queue.put_nowait(
                     ai_types.IncomingMessage(
                         database_id=message_in_db.id,
@@ -121,13 +115,13 @@ async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
             elif msg.is_muc:
                 barejid = msg_xmpp.to.bare()
                 room = bot.get_room_by_muc_jid(barejid)
-                message_in_db = db.store_muc_message(msg_xmpp, room.me, outgoing=True)
+                message_in_db = await writer.store(db.make_muc_message(msg_xmpp, room.me, outgoing=True))
                 bot.send(msg_xmpp)
             else:
-                message_in_db = db.store_message(msg_xmpp, outgoing=True)
+                message_in_db = await writer.store(db.make_message(msg_xmpp, outgoing=True))
                 bot.send(msg_xmpp)
 
-            send_message_to_ws_clients(ws_clients, message_in_db)
+            await send_message_to_ws_clients(message_in_db)
 
     ai = ai_bot.AIBot()
 
@@ -135,8 +129,7 @@ async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
         while True:
             msg: ai_types.OutgoingMessage = await ai_bot.outgoing_queue.get()
 
-            with db.db_session:
-                chat = db.Chat[msg.chat_id]
+            chat = await async_db.get_chat(msg.chat_id)
 
             msg_xmpp = create_message(chat.jid, msg.text, chat.is_muc)
             bot.send(msg_xmpp)
@@ -144,24 +137,29 @@ async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
             if chat.is_muc:
                 barejid = msg_xmpp.to.bare()
                 room = bot.get_room_by_muc_jid(barejid)
-                message_in_db = db.store_muc_message(msg_xmpp, room.me, outgoing=True)
+                message_in_db = await writer.store(db.make_muc_message(msg_xmpp, room.me, outgoing=True))
             else:
-                message_in_db = db.store_message(msg_xmpp, outgoing=True)
+                message_in_db = await writer.store(db.make_message(msg_xmpp, outgoing=True))
 
-            send_message_to_ws_clients(ws_clients, message_in_db)
+            await send_message_to_ws_clients(message_in_db)
 
             if msg.model:
-                db.store_ai_usage(
-                    msg.reply_for,
-                    message_in_db.id,
-                    msg.model,
-                    db.AIUsageInfo(
-                        prompt_tokens=msg.usage.prompt_tokens,
-                        reply_tokens=msg.usage.reply_tokens,
-                        total_tokens=msg.usage.total_tokens,
-                    ),
+                await writer.store(
+                    db.make_ai_usage(
+                        msg.reply_for,
+                        message_in_db.id,
+                        msg.model,
+                        db.AIUsageInfo(
+                            prompt_tokens=msg.usage.prompt_tokens,
+                            reply_tokens=msg.usage.reply_tokens,
+                            total_tokens=msg.usage.total_tokens,
+                        ),
+                    )
                 )
 
+    writer.start()
+    all_tasks = ()
+
     try:
         all_tasks = (
             asyncio.create_task(bot.run()),
@@ -172,3 +170,32 @@ async def bot_task(ws_clients: t.Mapping[UUID, asyncio.Queue]):
         await asyncio.wait(all_tasks, return_when=asyncio.FIRST_COMPLETED)
     finally:
         bot.stop()
+
+        for task in all_tasks:
+            task.cancel()
+
+        await asyncio.gather(*all_tasks, return_exceptions=True)
+        # Handlers of received stanzas are still storing them, writer has to outlive them
+        await bot.wait_handlers()
+        await writer.close()
+
+
+async def main():
+    """
+    Run bot without web UI, for web UI served by separate worker processes. Needs Redis for event bus
+    """
+    import invalidation
+    from redis_cache import async_cache
+
+    db.db_init()
+    invalidation.start_listener()
+
+    try:
+        await bot_task()
+    finally:
+        await event_bus.close()
+        await async_cache.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,292 @@
+"""
+Opt-in compression of stored message text
+
+With `compression.enabled`, texts of at least `compression.min_length` characters are stored compressed in
+`text_compressed` column instead of `text`. zstd is used if `zstandard` package is installed, zlib otherwise.
+zstd compression uses the latest dictionary trained on our own history, if any. Compressed texts are
+decompressed when they are read for a client or AI context.
+
+Usage:
+    python compression.py train [size_kb]  # train zstd dictionary on stored messages
+    python compression.py compress          # compress existing texts
+    python compression.py decompress        # turn compressed texts back into plain ones
+    python compression.py benchmark         # report size reduction and read/write overhead
+"""
+import logging
+import sys
+import time
+import typing as t
+import zlib
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENABLED = settings.get("compression.enabled", False)
+MIN_LENGTH = settings.get("compression.min_length", 256)
+LEVEL = settings.get("compression.level", 3)
+
+# First byte of compressed value
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_ZSTD_DICT = 3  # followed by 4 bytes of dictionary id
+
+TABLES = ("message", "archivedmessage")
+
+_dictionaries: t.Dict[int, "zstandard.ZstdCompressionDict"] = {}
+_active_dictionary_id: t.Optional[int] = None
+
+
+def set_dictionaries(dictionaries: t.Dict[int, bytes]) -> None:
+    """
+    Register trained dictionaries by id; the one with the greatest id is used for compression
+    """
+    global _active_dictionary_id
+
+    if zstandard is None:
+        return
+
+    for dictionary_id, data in dictionaries.items():
+        dictionary = zstandard.ZstdCompressionDict(bytes(data))
+        # Otherwise dictionary is digested again on every compression
+        dictionary.precompute_compress(level=LEVEL)
+        _dictionaries[dictionary_id] = dictionary
+
+    _active_dictionary_id = max(_dictionaries) if _dictionaries else None
+
+
+def compress(text: str, dictionary_id: t.Optional[int] = None) -> bytes:
+    data = text.encode()
+
+    if zstandard is None:
+        return bytes((CODEC_ZLIB,)) + zlib.compress(data, min(LEVEL, 9))
+
+    dictionary_id = _active_dictionary_id if dictionary_id is None else dictionary_id
+
+    if dictionary_id is None:
+        return bytes((CODEC_ZSTD,)) + zstandard.ZstdCompressor(level=LEVEL).compress(data)
+
+    compressor = zstandard.ZstdCompressor(level=LEVEL, dict_data=_dictionaries[dictionary_id])
+    return bytes((CODEC_ZSTD_DICT,)) + dictionary_id.to_bytes(4, "big") + compressor.compress(data)
+
+
+def decompress(value: bytes) -> str:
+    value = bytes(value)
+    codec = value[0]
+
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(value[1:]).decode()
+
+    if zstandard is None:
+        raise RuntimeError("Text is compressed with zstd, but zstandard package isn't installed")
+
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(value[1:]).decode()
+
+    if codec == CODEC_ZSTD_DICT:
+        dictionary_id = int.from_bytes(value[1:5], "big")
+
+        if dictionary_id not in _dictionaries:
+            _load_dictionaries()
+
+        decompressor = zstandard.ZstdDecompressor(dict_data=_dictionaries[dictionary_id])
+        return decompressor.decompress(value[5:]).decode()
+
+    raise ValueError(f"Unknown compression codec {codec}")
+
+
+def pack_text(text: t.Optional[str]) -> t.Tuple[t.Optional[str], t.Optional[bytes]]:
+    """
+    Returns (text, text_compressed) column values for storing `text`. Compressed text leaves `text` empty,
+    as Pony stores optional strings as NOT NULL columns
+    """
+    if not ENABLED or text is None or len(text) < MIN_LENGTH:
+        return text, None
+
+    compressed = compress(text)
+
+    # Not worth it for texts which don't compress
+    if len(compressed) >= len(text.encode()):
+        return text, None
+
+    return "", compressed
+
+
+def unpack_text(text: t.Optional[str], text_compressed: t.Optional[bytes]) -> t.Optional[str]:
+    return decompress(text_compressed) if text_compressed is not None else text
+
+
+def _load_dictionaries() -> None:
+    from db import TextDictionary, db_session
+
+    with db_session:
+        set_dictionaries({d.id: d.data for d in TextDictionary.select()})
+
+
+def _sample_texts(limit: int) -> t.List[str]:
+    from db import db, db_session
+
+    with db_session:
+        rows = db.select(
+            "SELECT * FROM (SELECT id, text, text_compressed FROM message"
+            " UNION ALL SELECT id, text, text_compressed FROM archivedmessage) AS texts ORDER BY id DESC LIMIT $limit"
+        )
+
+    return [unpack_text(text, text_compressed) for _, text, text_compressed in rows]
+
+
+def train_dictionary(size: int = 112 * 1024, samples: int = 100_000) -> int:
+    from datetime import datetime
+
+    import pytz
+
+    from db import TextDictionary, db_session
+
+    if zstandard is None:
+        raise RuntimeError("zstandard package is required to train dictionary")
+
+    texts = [text.encode() for text in _sample_texts(samples) if text]
+    dictionary = zstandard.train_dictionary(size, texts)
+
+    with db_session:
+        stored = TextDictionary(data=dictionary.as_bytes(), created_at=datetime.now().astimezone(pytz.utc))
+
+    _load_dictionaries()
+    logger.info(f"Trained {len(dictionary.as_bytes())} bytes dictionary #{stored.id} on {len(texts)} messages")
+    return stored.id
+
+
+def _convert(table: str, to_compressed: bool, batch_size: int) -> int:
+    from db import db, db_session
+
+    if to_compressed:
+        select_sql = (
+            f"SELECT id, text, text_compressed FROM {table} WHERE id > $last_id AND length(text) >= $MIN_LENGTH"
+            " ORDER BY id LIMIT $batch_size"
+        )
+    else:
+        select_sql = (
+            f"SELECT id, text, text_compressed FROM {table} WHERE id > $last_id AND text_compressed IS NOT NULL"
+            " ORDER BY id LIMIT $batch_size"
+        )
+
+    last_id, converted, started = 0, 0, time.monotonic()
+
+    while True:
+        with db_session:
+            rows = db.select(select_sql)
+
+            for message_id, text, text_compressed in rows:
+                text = unpack_text(text, text_compressed)
+                text, text_compressed = pack_text(text) if to_compressed else (text, None)
+
+                # Texts which don't compress well are left as is
+                if to_compressed and text_compressed is None:
+                    continue
+
+                db.execute(
+                    f"UPDATE {table} SET text = $text, text_compressed = $text_compressed WHERE id = $message_id"
+                )
+                converted += 1
+
+        if not rows:
+            break
+
+        last_id = rows[-1][0]
+        logger.info(f"{table}: {converted} rows converted, {converted / (time.monotonic() - started):.0f} rows/s")
+
+    return converted
+
+
+def convert_all(to_compressed: bool, batch_size: int = 1000) -> None:
+    if to_compressed and not ENABLED:
+        raise RuntimeError("Set compression.enabled = true first, otherwise new messages are stored uncompressed")
+
+    for table in TABLES:
+        converted = _convert(table, to_compressed, batch_size)
+        logger.info(f"{table}: done, {converted} rows {'compressed' if to_compressed else 'decompressed'}")
+
+
+def benchmark(samples: int = 20_000) -> None:
+    """
+    Compare storage size and per-message cost of available codecs on latest stored messages
+    """
+    texts = [text for text in _sample_texts(samples) if text]
+    large = [text for text in texts if len(text) >= MIN_LENGTH]
+    raw_size = sum(len(text.encode()) for text in texts)
+
+    if not texts:
+        print("No stored messages to benchmark on")
+        return
+
+    codecs = {"zlib": lambda text: bytes((CODEC_ZLIB,)) + zlib.compress(text.encode(), min(LEVEL, 9))}
+
+    if zstandard is not None:
+        codecs["zstd"] = lambda text: bytes((CODEC_ZSTD,)) + zstandard.ZstdCompressor(level=LEVEL).compress(
+            text.encode()
+        )
+
+        if _active_dictionary_id is not None:
+            codecs[f"zstd + dictionary #{_active_dictionary_id}"] = compress
+
+    print(f"{len(texts)} messages, {raw_size / 1024:.0f} KiB of text, {len(large)} of >= {MIN_LENGTH} characters")
+
+    for name, codec in codecs.items():
+        started = time.perf_counter()
+        compressed = [codec(text) for text in large]
+        write_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+
+        for value in compressed:
+            decompress(value)
+
+        read_time = time.perf_counter() - started
+
+        # Short texts and ones which don't compress are stored as is
+        stored_size = sum(min(len(value), len(text.encode())) for text, value in zip(large, compressed)) + sum(
+            len(text.encode()) for text in texts if len(text) < MIN_LENGTH
+        )
+
+        n = max(len(large), 1)
+        print(
+            f"  {name}: {stored_size / 1024:.0f} KiB ({100 - stored_size * 100 / max(raw_size, 1):.1f}% smaller),"
+            f" compress {write_time * 1e6 / n:.1f} us/msg, decompress {read_time * 1e6 / n:.1f} us/msg"
+        )
+
+
+def main(argv: t.List[str]) -> int:
+    from db import db_init
+
+    command = argv[1] if len(argv) > 1 else ""
+
+    if command not in ("train", "compress", "decompress", "benchmark"):
+        print(__doc__)
+        return 2
+
+    db_init()
+    # Run as script, this module isn't the one db_init() registered dictionaries in
+    _load_dictionaries()
+
+    if command == "train":
+        train_dictionary(size=int(argv[2]) * 1024 if len(argv) > 2 else 112 * 1024)
+
+    if command == "compress":
+        convert_all(to_compressed=True)
+
+    if command == "decompress":
+        convert_all(to_compressed=False)
+
+    if command == "benchmark":
+        benchmark()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
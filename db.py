@@ -1,15 +1,21 @@
 import logging
 import os
+import sqlite3
 import typing as t
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import date, datetime
 from enum import Enum
 
 import aioxmpp
 import pytz
 from pony.orm import *
 
+from compression import pack_text, set_dictionaries, unpack_text
 from config import settings
+from invalidation import CachedTable
+from util import stats
+from util.lru import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +32,10 @@ class MessageType(Enum):
     MUC_PRIVMSG = 6
 
 
+# AI usage is reported for answers to these
+USAGE_PROMPT_TYPES = (MessageType.USER.value, MessageType.FOR_AI.value)
+
+
 class Chat(db.Entity):
     jid = Required(str, unique=True)
     name = Required(str)
@@ -33,6 +43,9 @@ class Chat(db.Entity):
 
     messages = Set("Message")
     prelude = Set("AIPrelude")
+    usage_daily = Set("AIUsageDaily")
+    days = Set("ChatDay")
+    summary = Optional("ChatSummary")
 
 
 class Message(db.Entity):
@@ -41,11 +54,79 @@ class Message(db.Entity):
     msg_type = Required(int)
     nick = Required(str)
     text = Optional(str)
+    # Set instead of `text` for large texts if compression is enabled, see compression.py
+    text_compressed = Optional(bytes)
     outgoing = Required(bool)
 
     ai_usage = Set("AIUsage", reverse="completion")
     user_usage = Set("AIUsage", reverse="prompt")
 
+    def get_text(self) -> t.Optional[str]:
+        return unpack_text(self.text, self.text_compressed)
+
+
+class ArchivedMessage(db.Entity):
+    """
+    Message moved out of hot Message table by archive maintenance. Keeps the original id
+    """
+
+    id = PrimaryKey(int)
+    chat = Required(int)
+    utctime = Required(datetime)
+    msg_type = Required(int)
+    nick = Required(str)
+    text = Optional(str)
+    text_compressed = Optional(bytes)
+    outgoing = Required(bool)
+
+    composite_index(chat, utctime)
+
+
+class ChatDay(db.Entity):
+    """
+    Per-chat calendar index: number of messages (hot and archived) in each UTC hour, maintained by store_batch().
+    Hour is a number of hours since epoch, so the calendar can be built for any client timezone
+    """
+
+    chat = Required(Chat)
+    hour = Required(int)
+    message_count = Required(int, default=0)
+
+    composite_key(chat, hour)
+
+
+class ChatSummary(db.Entity):
+    """
+    Latest message and message count of chat for chat list, maintained by store_batch()
+    """
+
+    chat = Required(Chat, unique=True)
+    last_message_id = Required(int, index=True)
+    last_utctime = Required(datetime)
+    last_nick = Required(str)
+    preview = Optional(str, autostrip=False)  # first PREVIEW_LENGTH characters of last message text
+    message_count = Required(int, default=0)  # including archived messages
+
+
+class TextDictionary(db.Entity):
+    """
+    zstd dictionary trained on stored messages for text compression
+    """
+
+    data = Required(bytes)
+    created_at = Required(datetime)
+
+
+class ArchivedAIUsage(db.Entity):
+    id = PrimaryKey(int)
+    model = Required(int)
+    prompt = Required(int, index=True)
+    completion = Required(int, index=True)
+
+    completion_tokens = Optional(int)
+    prompt_tokens = Optional(int)
+    total_tokens = Optional(int)
+
 
 class NickColor(db.Entity):
     nick = Required(str, unique=True)
@@ -59,6 +140,7 @@ class BlockedUsers(db.Entity):
 class AIModel(db.Entity):
     name = Required(str, unique=True)
     usages = Set("AIUsage")
+    usage_daily = Set("AIUsageDaily")
 
 
 class AIPrelude(db.Entity):
@@ -77,6 +159,30 @@ class AIUsage(db.Entity):
     total_tokens = Optional(int)
 
 
+class AIUsageDaily(db.Entity):
+    """
+    Per-day AI usage rollup, maintained by store_batch(). Day is UTC date of prompt message; only prompts of
+    USAGE_PROMPT_TYPES are counted
+    """
+
+    day = Required(date)
+    chat = Required(Chat)
+    nick = Required(str)
+    model = Required(AIModel)
+
+    prompt_tokens = Required(int, default=0)
+    completion_tokens = Required(int, default=0)
+    total_tokens = Required(int, default=0)
+
+    composite_key(day, chat, nick, model)
+
+
+class SchemaMigration(db.Entity):
+    version = PrimaryKey(int)
+    description = Required(str)
+    applied_at = Required(datetime)
+
+
 @dataclass
 class AIUsageInfo:
     prompt_tokens: int
@@ -89,7 +195,36 @@ def db_init():
     db.bind(**settings.database)
 
     logger.info(f"Start database migration")
-    db.generate_mapping(create_tables=True)
+    # Tables are checked after migrations, which may add columns to existing tables
+    db.generate_mapping(check_tables=False)
+    db.create_tables()
+
+    from migrations import migrate
+
+    migrate()
+    db.check_tables()
+
+    with db_session:
+        set_dictionaries({d.id: d.data for d in TextDictionary.select()})
+
+    from db_pool import read_pool
+
+    read_pool.open()
+
+
+def raw_connection():
+    """
+    New DB-API connection to bound database outside of Pony's pool, in autocommit mode
+    """
+    if db.provider_name == "postgres":
+        import psycopg2
+
+        params = {k: v for k, v in settings.database.items() if k != "provider"}
+        connection = psycopg2.connect(**params)
+        connection.autocommit = True
+        return connection
+
+    return sqlite3.connect(db.provider.pool.filename, isolation_level=None)
 
 
 def get_or_create_muc_chat(mucjid: str):
@@ -121,218 +256,472 @@ def get_or_create_ai_model(name: str):
     return ai_model
 
 
-@db_session
-def store_message(message: aioxmpp.Message, outgoing=False):
-    logger.debug(f"Storing message {message}")
+@dataclass(frozen=True)
+class ChatInfo:
+    id: int
+    jid: str
+    name: str
+    is_muc: bool
+
+
+@dataclass
+class StoredMessage:
+    """
+    Detached copy of stored Message row, safe to use outside of db_session
+    """
+
+    id: int
+    chat: ChatInfo
+    utctime: datetime
+    msg_type: int
+    nick: str
+    text: t.Optional[str]
+    outgoing: bool
+
+
+# Chats and AI models are almost never changed, so there is no need to look them up for every stored message.
+# Keys are ("chat", is_muc, jid) and ("chat_id", id) for ChatInfo, ("ai_model", name) for AIModel id
+identity_cache: LRUCache[tuple, t.Any] = LRUCache(maxsize=settings.get("identity_cache.maxsize", 10000))
+stats.register("identity_cache", identity_cache.stats)
+
+SEARCH_TS_CONFIG = settings.get("search.ts_config", "simple")
+PREVIEW_LENGTH = 100
+
+
+def utcnow() -> datetime:
+    return datetime.now().astimezone(pytz.utc)
+
+
+@dataclass
+class PendingMessage:
+    """
+    Message row waiting to be written by store_batch()
+    """
+
+    chat_jid: str
+    chat_name: str
+    is_muc: bool
+    msg_type: MessageType
+    nick: str
+    text: t.Optional[str] = ""
+    outgoing: bool = False
+    utctime: datetime = field(default_factory=utcnow)
+
+
+@dataclass
+class PendingAIUsage:
+    prompt_message_id: int
+    completion_message_id: int
+    ai_model: str
+    usage_info: AIUsageInfo
 
-    now = datetime.now().astimezone(pytz.utc)
 
+def make_message(message: aioxmpp.Message, outgoing=False) -> PendingMessage:
     contact = message.to if outgoing else message.from_
-    contact_jid = str(contact.bare())
     contact_nick = message.from_.localpart if outgoing else contact.localpart
 
-    message = Message(
-        chat=get_or_create_chat(contact_jid, contact_nick),
-        utctime=now,
-        msg_type=MessageType.USER.value,
+    return PendingMessage(
+        chat_jid=str(contact.bare()),
+        chat_name=contact_nick,
+        is_muc=False,
+        msg_type=MessageType.USER,
         nick=contact_nick,
         text=message.body.any(),
         outgoing=outgoing,
     )
 
-    commit()
 
-    return message
-
-
-@db_session
-def store_muc_message(message: aioxmpp.Message, member: aioxmpp.muc.Occupant, outgoing=False):
-    logger.debug("Storing MUC message", message)
-
-    now = datetime.now().astimezone(pytz.utc)
+def make_muc_message(message: aioxmpp.Message, member: aioxmpp.muc.Occupant, outgoing=False) -> PendingMessage:
     mucjid = str(member.conversation_jid.bare())
 
-    message = Message(
-        chat=get_or_create_muc_chat(mucjid),
-        utctime=now,
-        msg_type=MessageType.USER.value,
+    return PendingMessage(
+        chat_jid=mucjid,
+        chat_name=mucjid,
+        is_muc=True,
+        msg_type=MessageType.USER,
         nick=member.nick,
         text=message.body.any(),
         outgoing=outgoing,
     )
 
-    commit()
-
-    return message
-
-
-@db_session
-def store_message_for_ai(message: aioxmpp.Message, is_muc: bool):
-    now = datetime.now().astimezone(pytz.utc)
 
+def make_message_for_ai(message: aioxmpp.Message, is_muc: bool) -> PendingMessage:
     contact_jid = str(message.to.bare())
 
-    if is_muc:
-        chat = get_or_create_muc_chat(contact_jid)
-    else:
-        chat = get_or_create_chat(contact_jid, message.to.localpart)
-
-    message = Message(
-        chat=chat,
-        utctime=now,
-        msg_type=MessageType.FOR_AI.value,
+    return PendingMessage(
+        chat_jid=contact_jid,
+        chat_name=contact_jid if is_muc else message.to.localpart,
+        is_muc=is_muc,
+        msg_type=MessageType.FOR_AI,
         nick="[FOR AI]",
         text=message.body.any(),
         outgoing=True,
     )
 
-    commit()
 
-    return message
+def make_muc_user_join(occupant: aioxmpp.muc.Occupant) -> PendingMessage:
+    mucjid = str(occupant.conversation_jid.bare())
 
+    return PendingMessage(
+        chat_jid=mucjid,
+        chat_name=mucjid,
+        is_muc=True,
+        msg_type=MessageType.PART_JOIN,
+        nick=occupant.nick,
+    )
 
-@db_session
-def store_muc_user_join(occupant: aioxmpp.muc.Occupant):
-    now = datetime.now().astimezone(pytz.utc)
+
+def make_muc_user_leave(
+    occupant: aioxmpp.muc.Occupant, muc_leave_mode: t.Optional[aioxmpp.muc.LeaveMode]
+) -> PendingMessage:
     mucjid = str(occupant.conversation_jid.bare())
 
-    message = Message(
-        chat=get_or_create_muc_chat(mucjid),
-        utctime=now,
-        msg_type=MessageType.PART_JOIN.value,
+    return PendingMessage(
+        chat_jid=mucjid,
+        chat_name=mucjid,
+        is_muc=True,
+        msg_type=MessageType.PART_LEAVE,
         nick=occupant.nick,
-        outgoing=False,
+        text=muc_leave_mode.name if muc_leave_mode is not None else None,
     )
 
-    commit()
 
-    return message
+def make_muc_topic(member: aioxmpp.muc.ServiceMember, new_topic) -> PendingMessage:
+    mucjid = str(member.conversation_jid.bare())
 
+    return PendingMessage(
+        chat_jid=mucjid,
+        chat_name=mucjid,
+        is_muc=True,
+        msg_type=MessageType.TOPIC,
+        nick=member.nick or "<?>",
+        text=new_topic.any() or "",
+    )
 
-@db_session
-def store_muc_user_leave(occupant: aioxmpp.muc.Occupant, muc_leave_mode: t.Optional[aioxmpp.muc.LeaveMode]):
-    now = datetime.now().astimezone(pytz.utc)
-    mucjid = str(occupant.conversation_jid.bare())
-    text = None
 
-    if muc_leave_mode is not None:
-        text = muc_leave_mode.name
+def make_muc_privmsg(message: aioxmpp.Message, outgoing=False) -> PendingMessage:
+    mucjid = str(message.from_.bare())
 
-    message = Message(
-        chat=get_or_create_muc_chat(mucjid),
-        utctime=now,
-        msg_type=MessageType.PART_LEAVE.value,
-        nick=occupant.nick,
-        text=text,
-        outgoing=False,
+    return PendingMessage(
+        chat_jid=mucjid,
+        chat_name=mucjid,
+        is_muc=True,
+        msg_type=MessageType.MUC_PRIVMSG,
+        nick=message.from_.resource,
+        text=message.body.any(),
+        outgoing=outgoing,
     )
 
-    commit()
 
-    return message
+def make_ai_usage(
+    prompt_message_id: int, completion_message_id: int, ai_model: str, usage_info: AIUsageInfo
+) -> PendingAIUsage:
+    return PendingAIUsage(
+        prompt_message_id=prompt_message_id,
+        completion_message_id=completion_message_id,
+        ai_model=ai_model,
+        usage_info=usage_info,
+    )
 
 
-@db_session
-def store_muc_topic(member: aioxmpp.muc.ServiceMember, new_topic: str):
-    now = datetime.now().astimezone(pytz.utc)
-    mucjid = str(member.conversation_jid.bare())
-    new_topic = new_topic.any()
+def _chat_info(chat: Chat) -> ChatInfo:
+    return ChatInfo(id=chat.id, jid=chat.jid, name=chat.name, is_muc=chat.is_muc)
 
-    message = Message(
-        chat=get_or_create_muc_chat(mucjid),
-        utctime=now,
-        msg_type=MessageType.TOPIC.value,
-        nick=member.nick or "<?>",
-        text=new_topic or "",
-        outgoing=False,
-    )
 
-    commit()
+def _cache_chat(chat: ChatInfo) -> None:
+    identity_cache.set(("chat", chat.is_muc, chat.jid), chat)
+    identity_cache.set(("chat_id", chat.id), chat)
 
-    return message
 
+def _stored_text(row: PendingMessage) -> str:
+    # Pony strips str attributes and doesn't accept None for optional ones, compressed text is stored the same way
+    return row.text.strip() if row.text else ""
 
-@db_session
-def store_muc_privmsg(message: aioxmpp.Message, outgoing=False):
-    now = datetime.now().astimezone(pytz.utc)
-    mucjid = str(message.from_.bare())
-    contact_nick = message.from_.resource
+
+def _insert_message(row: PendingMessage, resolved: t.Dict[tuple, t.Any]) -> t.Tuple[Message, t.Union[ChatInfo, Chat]]:
+    key = ("chat", row.is_muc, row.chat_jid)
+    chat = identity_cache.get(key) or resolved.get(key)
+
+    if chat is None:
+        if row.is_muc:
+            chat = get_or_create_muc_chat(row.chat_jid)
+        else:
+            chat = get_or_create_chat(row.chat_jid, row.chat_name)
+
+        resolved[key] = chat
+
+    text, text_compressed = pack_text(_stored_text(row))
 
     message = Message(
-        chat=get_or_create_muc_chat(mucjid),
-        utctime=now,
-        msg_type=MessageType.MUC_PRIVMSG.value,
-        nick=contact_nick,
-        text=message.body.any(),
-        outgoing=outgoing,
+        chat=chat.id if isinstance(chat, ChatInfo) else chat,
+        utctime=row.utctime,
+        msg_type=row.msg_type.value,
+        nick=row.nick,
+        text=text,
+        text_compressed=text_compressed,
+        outgoing=row.outgoing,
     )
 
-    commit()
-
-    return message
+    return message, chat
 
 
-@db_session
-def store_ai_usage(prompt_message_id: int, completion_message_id: int, ai_model: str, usage_info: AIUsageInfo):
+def _insert_ai_usage(row: PendingAIUsage, resolved: t.Dict[tuple, t.Any]) -> t.Tuple[AIUsage, None]:
     logger.debug(
         (
-            f"Storing AI Usage; #{prompt_message_id} -> #{completion_message_id},"
-            f"model: {ai_model}, {usage_info.total_tokens} total tokens"
+            f"Storing AI Usage; #{row.prompt_message_id} -> #{row.completion_message_id},"
+            f"model: {row.ai_model}, {row.usage_info.total_tokens} total tokens"
         )
     )
 
-    ai_model = get_or_create_ai_model(ai_model)
+    key = ("ai_model", row.ai_model)
+    ai_model = identity_cache.get(key) or resolved.get(key)
+
+    if ai_model is None:
+        ai_model = resolved[key] = get_or_create_ai_model(row.ai_model)
 
     ai_usage = AIUsage(
         model=ai_model,
-        prompt=prompt_message_id,
-        completion=completion_message_id,
-        completion_tokens=usage_info.reply_tokens,
-        prompt_tokens=usage_info.prompt_tokens,
-        total_tokens=usage_info.total_tokens,
+        prompt=row.prompt_message_id,
+        completion=row.completion_message_id,
+        completion_tokens=row.usage_info.reply_tokens,
+        prompt_tokens=row.usage_info.prompt_tokens,
+        total_tokens=row.usage_info.total_tokens,
     )
 
-    commit()
+    _update_usage_rollup(ai_usage)
 
-    return ai_usage
+    return ai_usage, None
 
 
-@db_session
-def get_last_n_messages_for_ai(chat: Chat, n: int):
-    types = MessageType.USER.value, MessageType.FOR_AI.value
+def _update_usage_rollup(ai_usage: AIUsage) -> None:
+    prompt = ai_usage.prompt
 
-    return reversed(chat.messages.select(lambda m: m.msg_type in types).order_by(desc(Message.utctime)).limit(n))
+    if prompt.msg_type not in USAGE_PROMPT_TYPES:
+        return
 
+    day = prompt.utctime.date()
+    rollup = AIUsageDaily.get(day=day, chat=prompt.chat, nick=prompt.nick, model=ai_usage.model)
 
-@db_session
-def get_usage_for_last_n_days(days: int, chat_id: int = None):
-    start_date = datetime.now() - timedelta(days=days)
-    start_date = start_date.astimezone(pytz.utc)
+    if rollup is None:
+        rollup = AIUsageDaily(day=day, chat=prompt.chat, nick=prompt.nick, model=ai_usage.model)
 
-    chat = Chat.select(id=chat_id).get() if chat_id else None
+    rollup.prompt_tokens += ai_usage.prompt_tokens or 0
+    rollup.completion_tokens += ai_usage.completion_tokens or 0
+    rollup.total_tokens += ai_usage.total_tokens or 0
 
-    types = MessageType.USER.value, MessageType.FOR_AI.value
-    messages = chat.messages if chat else Message
-    messages = messages.select(lambda m: m.msg_type in types and m.utctime >= start_date)
 
-    return select(
-        (
-            msg.chat.name,
-            msg.nick,
-            usage.model.name,
-            usage.completion_tokens,
-            usage.prompt_tokens,
-            usage.total_tokens,
+def to_utc_hour(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+
+    return int(value.timestamp()) // 3600
+
+
+def _update_calendar(messages: t.List[Message]) -> None:
+    counts = Counter((m.chat, to_utc_hour(m.utctime)) for m in messages)
+
+    for (chat, hour), count in counts.items():
+        chat_day = ChatDay.get(chat=chat, hour=hour)
+
+        if chat_day is None:
+            chat_day = ChatDay(chat=chat, hour=hour)
+
+        chat_day.message_count += count
+
+
+def _update_summaries(messages: t.List[t.Tuple[Message, t.Optional[str]]]) -> None:
+    counts = Counter(message.chat for message, _ in messages)
+    # Messages are inserted in order, so the last one of chat is its newest
+    latest = {message.chat: (message, text) for message, text in messages}
+
+    for chat, (message, text) in latest.items():
+        summary = chat.summary or ChatSummary(
+            chat=chat, last_message_id=message.id, last_utctime=message.utctime, last_nick=message.nick
         )
-        for msg in messages
-        for usage in AIUsage
-        if usage.prompt == msg
-    ).fetch()
+        summary.last_message_id = message.id
+        summary.last_utctime = message.utctime
+        summary.last_nick = message.nick
+        summary.preview = (text or "").strip()[:PREVIEW_LENGTH]
+        summary.message_count += counts[chat]
+
+
+def _detach_message(message: Message, chat: ChatInfo, row: PendingMessage) -> StoredMessage:
+    return StoredMessage(
+        id=message.id,
+        chat=chat,
+        utctime=row.utctime,
+        msg_type=message.msg_type,
+        nick=message.nick,
+        # Stored text may be compressed
+        text=_stored_text(row),
+        outgoing=message.outgoing,
+    )
+
+
+def raw_sql(query: str) -> str:
+    """
+    Convert query with qmark (?) placeholders to paramstyle of bound database
+    """
+    return query.replace("?", "%s") if db.provider_name == "postgres" else query
+
+
+def to_db_datetime(value: datetime) -> t.Union[datetime, str]:
+    """
+    Convert datetime to raw query parameter which compares correctly with stored values
+    """
+    value = value.astimezone(pytz.utc)
+
+    if db.provider_name == "sqlite":
+        # Same text format Pony uses for storing datetime in SQLite
+        return str(value)
+
+    return value
+
+
+def from_db_datetime(value: t.Union[datetime, str]) -> datetime:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def index_for_search(messages: t.List[t.Tuple[int, t.Optional[str]]]) -> None:
+    """
+    Add (id, text) of messages to full-text index table created by migration #3
+    """
+    rows = [(message_id, text) for message_id, text in messages if text]
+
+    if not rows:
+        return
+
+    cursor = db.get_connection().cursor()
+
+    if db.provider_name == "postgres":
+        cursor.executemany(
+            "INSERT INTO message_fts (id, tsv) VALUES (%s, to_tsvector(%s, %s))",
+            [(message_id, SEARCH_TS_CONFIG, text) for message_id, text in rows],
+        )
+    else:
+        cursor.executemany("INSERT INTO message_fts (rowid, text) VALUES (?, ?)", rows)
+
+
+PendingRow = t.Union[PendingMessage, PendingAIUsage]
+StoredRow = t.Union[StoredMessage, int]
+
+
+@db_session
+def store_batch(rows: t.Sequence[PendingRow]) -> t.List[StoredRow]:
+    """
+    Write all rows in single transaction.
+    Returns StoredMessage for each PendingMessage and AIUsage id for each PendingAIUsage, in the same order
+    """
+    logger.debug(f"Storing batch of {len(rows)} rows")
+
+    # Chats and models looked up or created in this transaction.
+    # They go to identity cache only after commit, so rolled back rows never leak there
+    resolved = {}
+    inserted = []
+
+    try:
+        for row in rows:
+            if isinstance(row, PendingAIUsage):
+                inserted.append(_insert_ai_usage(row, resolved))
+            else:
+                inserted.append(_insert_message(row, resolved))
+
+        messages = [(entity, row.text) for row, (entity, _) in zip(rows, inserted) if isinstance(entity, Message)]
+        _update_calendar([message for message, _ in messages])
+        flush()
+        # Text is taken from pending row, as stored one may be compressed
+        index_for_search([(message.id, text) for message, text in messages])
+        _update_summaries(messages)
+        commit()
+    except Exception:
+        identity_cache.clear()
+        raise
+
+    chats = {}
+
+    for key, entity in resolved.items():
+        if isinstance(entity, Chat):
+            chats[entity.id] = _chat_info(entity)
+            _cache_chat(chats[entity.id])
+        else:
+            identity_cache.set(key, entity.id)
+
+    result = []
+
+    for row, (entity, chat) in zip(rows, inserted):
+        if isinstance(row, PendingAIUsage):
+            result.append(entity.id)
+        else:
+            chat = chats[chat.id] if isinstance(chat, Chat) else chat
+            result.append(_detach_message(entity, chat, row))
+
+    return result
+
+
+def store_message(message: aioxmpp.Message, outgoing=False) -> StoredMessage:
+    logger.debug(f"Storing message {message}")
+    return store_batch([make_message(message, outgoing)])[0]
+
+
+def store_muc_message(message: aioxmpp.Message, member: aioxmpp.muc.Occupant, outgoing=False) -> StoredMessage:
+    logger.debug(f"Storing MUC message {message}")
+    return store_batch([make_muc_message(message, member, outgoing)])[0]
+
+
+def store_message_for_ai(message: aioxmpp.Message, is_muc: bool) -> StoredMessage:
+    return store_batch([make_message_for_ai(message, is_muc)])[0]
+
+
+def store_muc_user_join(occupant: aioxmpp.muc.Occupant) -> StoredMessage:
+    return store_batch([make_muc_user_join(occupant)])[0]
+
+
+def store_muc_user_leave(
+    occupant: aioxmpp.muc.Occupant, muc_leave_mode: t.Optional[aioxmpp.muc.LeaveMode]
+) -> StoredMessage:
+    return store_batch([make_muc_user_leave(occupant, muc_leave_mode)])[0]
+
+
+def store_muc_topic(member: aioxmpp.muc.ServiceMember, new_topic) -> StoredMessage:
+    return store_batch([make_muc_topic(member, new_topic)])[0]
+
+
+def store_muc_privmsg(message: aioxmpp.Message, outgoing=False) -> StoredMessage:
+    return store_batch([make_muc_privmsg(message, outgoing)])[0]
+
+
+def store_ai_usage(prompt_message_id: int, completion_message_id: int, ai_model: str, usage_info: AIUsageInfo) -> int:
+    return store_batch([make_ai_usage(prompt_message_id, completion_message_id, ai_model, usage_info)])[0]
+
+
+def get_chat(chat_id: int) -> ChatInfo:
+    chat = identity_cache.get(("chat_id", chat_id))
+
+    if chat is None:
+        with db_session:
+            chat = _chat_info(Chat[chat_id])
+
+        _cache_chat(chat)
+
+    return chat
 
 
 @db_session
+def _load_blocked_users() -> t.Set[str]:
+    return set(select(u.jid_or_nick for u in BlockedUsers))
+
+
+@db_session
+def _load_nick_colors() -> t.Dict[str, dict]:
+    return {nc.nick: nc.to_dict() for nc in NickColor.select()}
+
+
+blocked_users: CachedTable[t.Set[str]] = CachedTable("blocklist", _load_blocked_users)
+nick_colors: CachedTable[t.Dict[str, dict]] = CachedTable("nick_colors", _load_nick_colors)
+
+
 def is_user_blocked(jid_or_nick: str) -> bool:
-    return BlockedUsers.select(jid_or_nick=jid_or_nick).exists()
+    return jid_or_nick in blocked_users.get()
 
 
 @db_session
@@ -340,6 +729,8 @@ def add_user_in_blocklist(jid_or_nick: str) -> None:
     BlockedUsers(jid_or_nick=jid_or_nick)
     commit()
 
+    blocked_users.update(lambda users: users.add(jid_or_nick))
+
 
 @db_session
 def remove_user_from_blocklist(jid_or_nick: str) -> bool:
@@ -351,9 +742,28 @@ def remove_user_from_blocklist(jid_or_nick: str) -> bool:
     u.delete()
     commit()
 
+    blocked_users.update(lambda users: users.discard(jid_or_nick))
     return True
 
 
-@db_session
 def get_blocked_users() -> t.List[str]:
-    return list(select(u.jid_or_nick for u in BlockedUsers))
+    return sorted(blocked_users.get())
+
+
+@db_session
+def set_nick_color(nick: str, color: str) -> None:
+    nc = NickColor.get(nick=nick)
+
+    if nc:
+        nc.color = color
+    else:
+        nc = NickColor(nick=nick, color=color)
+
+    commit()
+
+    nick_color = nc.to_dict()
+    nick_colors.update(lambda colors: colors.__setitem__(nick, nick_color))
+
+
+def get_nick_colors() -> t.List[dict]:
+    return list(nick_colors.get().values())
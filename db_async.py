@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import logging
+import time
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from config import settings
+from util import stats
+
+logger = logging.getLogger(__name__)
+
+# SQLite allows only one writer at a time, so extra threads would mostly wait for the lock
+DEFAULT_MAX_WORKERS = {"sqlite": 2, "postgres": 8}
+
+T = t.TypeVar("T")
+
+
+def _get_max_workers() -> int:
+    provider = settings.database.provider
+    return settings.get("database_executor.max_workers", DEFAULT_MAX_WORKERS.get(provider, 4))
+
+
+class DatabaseExecutor:
+    """
+    Runs blocking database code on a dedicated thread pool and collects per-call latency
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        self.max_workers = max_workers
+        self.latency = stats.LatencyStats()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+
+    def _timed(self, func: t.Callable[..., T], name: str, *args, **kwargs) -> T:
+        started = time.perf_counter()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.latency.record(name, time.perf_counter() - started)
+
+    async def run(self, func: t.Callable[..., T], *args, **kwargs) -> T:
+        name = getattr(func, "__qualname__", repr(func))
+        call = functools.partial(self._timed, func, name, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+class AsyncDatabase:
+    """
+    Async facade over db module: `await async_db.is_user_blocked(nick)` runs db.is_user_blocked on executor
+    """
+
+    def __init__(self, executor: DatabaseExecutor) -> None:
+        self.executor = executor
+
+    async def run(self, func: t.Callable[..., T], *args, **kwargs) -> T:
+        return await self.executor.run(func, *args, **kwargs)
+
+    def __getattr__(self, name: str) -> t.Callable[..., t.Awaitable]:
+        func = getattr(db, name)
+
+        if not callable(func):
+            raise AttributeError(f"db.{name} is not callable")
+
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            return await self.executor.run(func, *args, **kwargs)
+
+        return call
+
+
+executor = DatabaseExecutor(max_workers=_get_max_workers())
+async_db = AsyncDatabase(executor)
+
+stats.register("db", executor.latency.snapshot)
@@ -0,0 +1,146 @@
+"""
+Pool of read-only database connections for web UI and report queries
+
+With `database_read.enabled`, reads go to a separate set of connections, so they don't compete with
+ingest writes done through Pony:
+  - on Postgres, to a read replica given in [database_read.replica] (defaults to primary database)
+  - on SQLite, to read-only connections of the same file; database is switched to WAL mode, so readers
+    aren't blocked by the single writer
+Otherwise reads use Pony's connection of the current thread inside of db_session.
+"""
+import logging
+import sqlite3
+import threading
+import time
+import typing as t
+from contextlib import contextmanager
+
+from config import settings
+from db import db, db_session, raw_connection
+from util import stats
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ReadPool:
+    def __init__(self, enabled: bool, max_size: int, timeout: float) -> None:
+        self.enabled = enabled
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait = stats.LatencyStats()
+
+        self._condition = threading.Condition()
+        self._idle: t.List[t.Any] = []
+        self._size = 0
+
+    def open(self) -> None:
+        """
+        Prepare database for readers. Called after database is bound
+        """
+        if not self.enabled:
+            return
+
+        if db.provider_name == "sqlite":
+            connection = raw_connection()
+            (mode,) = connection.execute("PRAGMA journal_mode=WAL").fetchone()
+            connection.close()
+            logger.info(f"SQLite journal mode: {mode}")
+
+        logger.info(f"Read pool enabled: up to {self.max_size} connections")
+
+    def _connect(self):
+        if db.provider_name == "postgres":
+            import psycopg2
+
+            params = {k: v for k, v in settings.database.items() if k != "provider"}
+            params.update(settings.get("database_read.replica", {}))
+
+            connection = psycopg2.connect(**params)
+            connection.set_session(readonly=True, autocommit=True)
+            return connection
+
+        # Connection is used by one thread at a time, but not always by the one which opened it
+        uri = f"file:{db.provider.pool.filename}?mode=ro"
+        return sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False)
+
+    def _checkout(self):
+        started = time.perf_counter()
+        deadline = started + self.timeout
+
+        with self._condition:
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.perf_counter()
+
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    self.timeouts += 1
+                    raise PoolTimeout(f"No free read connection in {self.timeout}s")
+
+            self.checkouts += 1
+            self.wait.record("checkout", time.perf_counter() - started)
+
+            if self._idle:
+                return self._idle.pop()
+
+            self._size += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, connection) -> None:
+        with self._condition:
+            if connection is None:
+                self._size -= 1
+            else:
+                self._idle.append(connection)
+
+            self._condition.notify()
+
+    @contextmanager
+    def cursor(self):
+        if not self.enabled:
+            with db_session:
+                yield db.get_connection().cursor()
+            return
+
+        connection = self._checkout()
+
+        try:
+            yield connection.cursor()
+        except Exception:
+            # Connection may be broken, open a new one next time
+            connection.close()
+            self._release(None)
+            raise
+
+        self._release(connection)
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {
+            "enabled": self.enabled,
+            "size": self._size,
+            "idle": len(self._idle),
+            "in_use": self._size - len(self._idle),
+            "max_size": self.max_size,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait": self.wait.snapshot().get("checkout"),
+        }
+
+
+read_pool = ReadPool(
+    enabled=settings.get("database_read.enabled", False),
+    max_size=settings.get("database_read.pool_size", 4),
+    timeout=settings.get("database_read.timeout", 5),
+)
+
+stats.register("read_pool", read_pool.stats)
@@ -0,0 +1,514 @@
+"""
+Read-only queries of web UI, AI context and reports. They run as plain SQL on connections from read pool,
+see db_pool.py, and return plain tuples or records instead of Pony entities. SQL of hot ones is built by
+*_query() functions, which HOT_QUERIES of migrations.py check for index use
+
+Usage:
+    python db_read.py benchmark [--seed N]  # compare with ORM reads, optionally on N seeded messages
+"""
+import argparse
+import random
+import sys
+import time
+import typing as t
+from datetime import datetime, timedelta
+
+import pytz
+
+from compression import unpack_text
+from db import SEARCH_TS_CONFIG, MessageType, db, from_db_datetime, raw_connection, raw_sql, to_db_datetime
+from db_pool import read_pool
+
+MESSAGE_COLUMNS = ("id", "chat", "utctime", "msg_type", "nick", "text", "outgoing", "text_compressed")
+MESSAGE_TYPE_NAMES = {message_type.value: message_type.name for message_type in MessageType}
+
+SQLQuery = t.Tuple[str, t.List[t.Any]]  # qmark-style SQL and its parameters
+
+
+def _fetch(sql: str, params: t.Sequence = ()) -> t.List[tuple]:
+    with read_pool.cursor() as cursor:
+        cursor.execute(raw_sql(sql), params)
+        return cursor.fetchall()
+
+
+class MessageRecord:
+    """
+    Message row in MESSAGE_COLUMNS order
+    """
+
+    __slots__ = ("id", "chat", "utctime", "msg_type", "nick", "text", "outgoing")
+
+    def __init__(self, row: t.Sequence) -> None:
+        self.id, self.chat, utctime, self.msg_type, self.nick, text, outgoing, text_compressed = row[:8]
+        self.utctime = from_db_datetime(utctime)
+        self.text = unpack_text(text, text_compressed)
+        self.outgoing = bool(outgoing)
+
+    def to_dict(self) -> t.Dict[str, t.Any]:
+        """
+        Same as MessageModel(...).dict(), without validation
+        """
+        utctime = self.utctime if self.utctime.tzinfo else pytz.utc.localize(self.utctime)
+
+        return {
+            "id": self.id,
+            "chat": self.chat,
+            "utctime": int(utctime.timestamp() * 1000),
+            "msg_type": MESSAGE_TYPE_NAMES[self.msg_type],
+            "nick": self.nick,
+            "text": self.text or "",
+            "outgoing": self.outgoing,
+        }
+
+
+class AIContextRecord:
+    __slots__ = ("nick", "text", "outgoing", "model")
+
+    def __init__(self, nick: str, text: str, outgoing: bool, model: t.Optional[str]) -> None:
+        self.nick = nick
+        self.text = text
+        self.outgoing = outgoing
+        self.model = model  # None if message has no AI usage
+
+
+CHAT_LIST_COLUMNS = (
+    "id",
+    "jid",
+    "name",
+    "is_muc",
+    "last_message_id",
+    "last_utctime",
+    "last_nick",
+    "preview",
+    "message_count",
+)
+
+
+def _like_pattern(query: str) -> str:
+    escaped = query.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def get_chat_list(
+    query: t.Optional[str] = None, is_muc: t.Optional[bool] = None, limit: t.Optional[int] = None, offset: int = 0
+) -> t.List[t.Dict[str, t.Any]]:
+    """
+    Chats with their summaries, most recently active first. `query` is a substring of name or JID
+    """
+    filters, params = [], []
+
+    if query:
+        filters.append("(lower(c.name) LIKE ? ESCAPE '\\' OR lower(c.jid) LIKE ? ESCAPE '\\')")
+        params += [_like_pattern(query)] * 2
+    if is_muc is not None:
+        filters.append("c.is_muc = ?")
+        params.append(is_muc)
+
+    where = f" WHERE {' AND '.join(filters)}" if filters else ""
+    sql = (
+        "SELECT c.id, c.jid, c.name, c.is_muc, s.last_message_id, s.last_utctime, s.last_nick, s.preview,"
+        f" coalesce(s.message_count, 0) FROM chat c LEFT JOIN chatsummary s ON s.chat = c.id{where}"
+        " ORDER BY coalesce(s.last_message_id, 0) DESC, c.id DESC"
+    )
+
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+
+    chats = []
+
+    for row in _fetch(sql, params):
+        chat = dict(zip(CHAT_LIST_COLUMNS, row))
+        chat["is_muc"] = bool(chat["is_muc"])
+
+        if chat["last_utctime"] is not None:
+            chat["last_utctime"] = from_db_datetime(chat["last_utctime"])
+
+        chats.append(chat)
+
+    return chats
+
+
+def messages_query(chat_id: int, start: datetime, stop: datetime, with_archive: bool) -> SQLQuery:
+    columns = ", ".join(MESSAGE_COLUMNS)
+    arm = f"SELECT {columns} FROM {{table}} WHERE chat = ? AND utctime >= ? AND utctime < ?"
+    params = [chat_id, to_db_datetime(start), to_db_datetime(stop)]
+
+    if with_archive:
+        sql = f"{arm.format(table='archivedmessage')} UNION ALL {arm.format(table='message')} ORDER BY id"
+        params *= 2
+    else:
+        sql = f"{arm.format(table='message')} ORDER BY id"
+
+    return sql, params
+
+
+def get_messages(chat_id: int, start: datetime, stop: datetime, with_archive: bool) -> t.List[MessageRecord]:
+    """
+    Messages of chat in [start, stop) time range; archived ones go first
+    """
+    return [MessageRecord(row) for row in _fetch(*messages_query(chat_id, start, stop, with_archive))]
+
+
+def _encode_cursor(row: t.Sequence) -> str:
+    # Raw utctime keeps exact stored value, so comparison with it is exact on both providers
+    return f"{row[0]},{row[2]}"
+
+
+def _decode_cursor(cursor: str) -> t.Tuple[int, str]:
+    message_id, utctime = cursor.split(",", 1)
+    return int(message_id), utctime
+
+
+def messages_page_query(chat_id: int, limit: int, before: t.Optional[str], after: t.Optional[str]) -> SQLQuery:
+    """
+    Up to `limit` + 1 messages next to cursor, nearest first. The extra row tells whether there is more
+    """
+    if after is not None:
+        cursor, op, order = after, ">", "ASC"
+    else:
+        cursor, op, order = before, "<", "DESC"
+
+    filters, params = "chat = ?", [chat_id]
+
+    if cursor is not None:
+        message_id, utctime = _decode_cursor(cursor)
+        # Redundant range on utctime alone lets index seek right to the cursor
+        filters += f" AND utctime {op}= ? AND (utctime {op} ? OR id {op} ?)"
+        params += [utctime, utctime, message_id]
+
+    columns = ", ".join(MESSAGE_COLUMNS)
+    ordering = f"ORDER BY utctime {order}, id {order}"
+    arm = f"SELECT * FROM (SELECT {columns} FROM {{table}} WHERE {filters} {ordering} LIMIT ?) AS {{table}}_page"
+    sql = f"{arm.format(table='message')} UNION ALL {arm.format(table='archivedmessage')} {ordering} LIMIT ?"
+
+    return sql, [*params, limit + 1, *params, limit + 1, limit + 1]
+
+
+def get_messages_page(
+    chat_id: int, limit: int, before: t.Optional[str] = None, after: t.Optional[str] = None
+) -> t.Dict[str, t.Any]:
+    """
+    Page of chat history in chronological order, keyset-paginated on (utctime, id) over hot and archived messages.
+    `before` and `after` are cursors returned by previous call; without them the latest page is returned
+    """
+    rows = _fetch(*messages_page_query(chat_id, limit, before, after))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if after is None:
+        rows.reverse()
+
+    return {
+        "messages": [MessageRecord(row) for row in rows],
+        "before": _encode_cursor(rows[0]) if rows else before,
+        "after": _encode_cursor(rows[-1]) if rows else after,
+        "has_older": has_more if after is None else True,
+        "has_newer": has_more if after is not None else before is not None,
+    }
+
+
+def messages_after_query(chat_id: int, message_id: int, limit: int) -> SQLQuery:
+    columns = ", ".join(MESSAGE_COLUMNS)
+    # Not by utctime: delayed history may be stored after the last seen message with older time. Range of ids
+    # only covers messages stored since then
+    sql = f"SELECT {columns} FROM message WHERE id > ? AND chat = ? ORDER BY id LIMIT ?"
+    return sql, [message_id, chat_id, limit]
+
+
+def get_messages_after(chat_id: int, message_id: int, limit: int) -> t.Optional[t.List[MessageRecord]]:
+    """
+    Up to `limit` hot messages of chat stored after `message_id`, oldest first. None if `message_id` isn't a hot
+    message of chat, then there is no telling what is newer
+    """
+    if not _fetch("SELECT id FROM message WHERE id = ? AND chat = ?", [message_id, chat_id]):
+        return None
+
+    return [MessageRecord(row) for row in _fetch(*messages_after_query(chat_id, message_id, limit))]
+
+
+def last_messages_for_ai_query(chat_id: int, n: int) -> SQLQuery:
+    model = (
+        "(SELECT am.name FROM aiusage u JOIN aimodel am ON am.id = u.model"
+        " WHERE u.{column} = m.id ORDER BY u.id LIMIT 1)"
+    )
+    sql = (
+        "SELECT m.nick, m.text, m.text_compressed, m.outgoing,"
+        f" CASE WHEN m.outgoing THEN {model.format(column='completion')} ELSE {model.format(column='prompt')} END"
+        " FROM message m WHERE m.chat = ? AND m.msg_type IN (?, ?) ORDER BY m.utctime DESC, m.id DESC LIMIT ?"
+    )
+    return sql, [chat_id, MessageType.USER.value, MessageType.FOR_AI.value, n]
+
+
+def get_last_messages_for_ai(chat_id: int, n: int) -> t.List[AIContextRecord]:
+    """
+    Last `n` user and for-AI messages of chat, oldest first, with name of AI model which got or answered them
+    """
+    rows = _fetch(*last_messages_for_ai_query(chat_id, n))
+
+    return [
+        AIContextRecord(nick, unpack_text(text, text_compressed), bool(outgoing), model)
+        for nick, text, text_compressed, outgoing, model in reversed(rows)
+    ]
+
+
+def calendar_hours_query(chat_id: t.Optional[int], since_hour: t.Optional[int]) -> SQLQuery:
+    filters, params = [], []
+
+    if chat_id is not None:
+        filters.append("chat = ?")
+        params.append(chat_id)
+    if since_hour is not None:
+        filters.append("hour > ?")
+        params.append(since_hour)
+
+    where = f" WHERE {' AND '.join(filters)}" if filters else ""
+    return f"SELECT chat, hour FROM chatday{where} ORDER BY hour", params
+
+
+def get_calendar_hours(
+    chat_id: t.Optional[int] = None, since_hour: t.Optional[int] = None
+) -> t.List[t.Tuple[int, int]]:
+    """
+    (chat id, UTC hour) pairs of ChatDay index, ordered by hour. `since_hour` is exclusive
+    """
+    return _fetch(*calendar_hours_query(chat_id, since_hour))
+
+
+def get_latest_calendar_hours() -> t.List[t.Tuple[int, int, int]]:
+    """
+    (chat id, latest UTC hour, number of hours) of ChatDay index for every chat
+    """
+    return _fetch("SELECT chat, max(hour), count(*) FROM chatday GROUP BY chat")
+
+
+def usage_query(days: t.Optional[int], chat_id: t.Optional[int]) -> SQLQuery:
+    filters, params = [], []
+
+    if days is not None:
+        start_day = (datetime.now().astimezone(pytz.utc) - timedelta(days=days)).date()
+        filters.append("u.day >= ?")
+        params.append(start_day.isoformat())
+
+    if chat_id:
+        filters.append("u.chat = ?")
+        params.append(chat_id)
+
+    where = f" WHERE {' AND '.join(filters)}" if filters else ""
+    sql = (
+        "SELECT c.name, u.nick, m.name, sum(u.completion_tokens), sum(u.prompt_tokens), sum(u.total_tokens)"
+        " FROM aiusagedaily u JOIN chat c ON c.id = u.chat JOIN aimodel m ON m.id = u.model"
+        f"{where} GROUP BY c.name, u.nick, m.name"
+    )
+    return sql, params
+
+
+def get_usage_for_last_n_days(days: t.Optional[int], chat_id: int = None):
+    """
+    Returns (chat name, nick, model, completion tokens, prompt tokens, total tokens) per chat, nick and model,
+    for AI answers to user and for-AI messages. Read from daily rollup, so the period is whole UTC days: it starts
+    at midnight of the day `days` days ago, not exactly `days` * 24 hours ago. `days` is None means all time
+    """
+    return _fetch(*usage_query(days, chat_id))
+
+
+def _sqlite_match_expression(query: str) -> str:
+    # Every word is quoted, so user input can't be interpreted as FTS5 query syntax
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+def search_messages(
+    query: str,
+    chat_id: t.Optional[int] = None,
+    nick: t.Optional[str] = None,
+    since: t.Optional[datetime] = None,
+    until: t.Optional[datetime] = None,
+    msg_types: t.Optional[t.Sequence[MessageType]] = None,
+    limit: int = 50,
+    offset: int = 0,
+) -> t.List[t.Dict[str, t.Any]]:
+    """
+    Full-text search over hot and archived messages, best matches first
+    """
+    filters, filter_params = [], []
+
+    if chat_id is not None:
+        filters.append("m.chat = ?")
+        filter_params.append(chat_id)
+    if nick is not None:
+        filters.append("m.nick = ?")
+        filter_params.append(nick)
+    if since is not None:
+        filters.append("m.utctime >= ?")
+        filter_params.append(to_db_datetime(since))
+    if until is not None:
+        filters.append("m.utctime < ?")
+        filter_params.append(to_db_datetime(until))
+    if msg_types:
+        filters.append(f"m.msg_type IN ({', '.join('?' * len(msg_types))})")
+        filter_params.extend(msg_type.value for msg_type in msg_types)
+
+    if db.provider_name == "postgres":
+        source = "message_fts f JOIN {table} m ON m.id = f.id"
+        match, match_params = "f.tsv @@ plainto_tsquery(?, ?)", [SEARCH_TS_CONFIG, query]
+        rank, rank_params = "ts_rank(f.tsv, plainto_tsquery(?, ?))", [SEARCH_TS_CONFIG, query]
+    else:
+        source = "message_fts JOIN {table} m ON m.id = message_fts.rowid"
+        match, match_params = "message_fts MATCH ?", [_sqlite_match_expression(query)]
+        rank, rank_params = "-bm25(message_fts)", []
+
+    columns = ", ".join(f"m.{column}" for column in MESSAGE_COLUMNS)
+    where = "".join(f" AND {f}" for f in filters)
+    # Requested page is within the first offset + limit matches of either table, so the rest isn't sorted
+    arm = (
+        f"SELECT * FROM (SELECT {columns}, {rank} AS rank FROM {source} WHERE {match}{where}"
+        " ORDER BY rank DESC, m.id DESC LIMIT ?) AS {table}_found"
+    )
+
+    sql = (
+        f"{arm.format(table='message')} UNION ALL {arm.format(table='archivedmessage')}"
+        " ORDER BY rank DESC, id DESC LIMIT ? OFFSET ?"
+    )
+    params = [*rank_params, *match_params, *filter_params, offset + limit] * 2 + [limit, offset]
+
+    return [MessageRecord(row) for row in _fetch(sql, params)]
+
+
+def _seed(messages: int, chats: int = 20) -> None:
+    """
+    Fill empty database with `messages` random messages, every tenth one is AI answer with usage
+    """
+    words = "hello world bot chat message today ugu please answer why what how maybe yes no".split()
+    start = datetime.now().astimezone(pytz.utc) - timedelta(seconds=messages * 10)
+    connection = raw_connection()
+    cursor = connection.cursor()
+
+    cursor.execute("SELECT count(*) FROM message")
+
+    if cursor.fetchone()[0]:
+        raise RuntimeError("Seeding needs empty database, point [database] settings to a scratch one")
+
+    def insert(table: str, columns: t.Sequence[str], rows: t.List[tuple]) -> None:
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        cursor.execute("BEGIN")
+        cursor.executemany(raw_sql(sql), rows)
+        cursor.execute("COMMIT")
+
+    insert(
+        "chat",
+        ("id", "jid", "name", "is_muc"),
+        [(i, f"bench{i}@conference.example.com", f"bench{i}", i % 2 == 0) for i in range(1, chats + 1)],
+    )
+    insert("aimodel", ("id", "name"), [(1, "bench-model")])
+
+    for offset in range(0, messages, 10_000):
+        batch, usage = [], []
+
+        for i in range(offset + 1, min(offset + 10_000, messages) + 1):
+            outgoing = i % 10 == 0
+            text = " ".join(random.choices(words, k=random.randint(1, 40)))
+            utctime = to_db_datetime(start + timedelta(seconds=i * 10))
+            batch.append((i, i % chats + 1, utctime, MessageType.USER.value, f"user{i % 50}", text, outgoing))
+
+            if outgoing:
+                usage.append((i // 10, 1, i - 1, i, 10, 20, 30))
+
+        insert("message", MESSAGE_COLUMNS[:-1], batch)
+        insert(
+            "aiusage",
+            ("id", "model", "prompt", "completion", "completion_tokens", "prompt_tokens", "total_tokens"),
+            usage,
+        )
+
+    if db.provider_name == "postgres":
+        for table in ("chat", "aimodel", "message", "aiusage"):
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), max(id)) FROM {table}")
+
+    connection.close()
+
+
+def _orm_messages(chat_id: int, start: datetime, stop: datetime) -> t.List[dict]:
+    from pony.orm import db_session, select
+
+    from db import Message
+    from models import MessageModel
+
+    with db_session:
+        query = select(m for m in Message if m.utctime >= start and m.utctime < stop and m.chat.id == chat_id)
+        return [MessageModel.from_orm(m).dict() for m in query]
+
+
+def _orm_ai_context(n: int) -> int:
+    from pony.orm import db_session, desc
+
+    from db import Chat, Message
+
+    types = MessageType.USER.value, MessageType.FOR_AI.value
+    loaded = 0
+
+    with db_session:
+        for chat in Chat.select():
+            messages = chat.messages.select(lambda m: m.msg_type in types).order_by(desc(Message.utctime)).limit(n)
+
+            for msg in reversed(messages):
+                usage = (msg.ai_usage if msg.outgoing else msg.user_usage).select().first()
+                loaded += len(msg.get_text()) + len(usage.model.name if usage else "")
+
+    return loaded
+
+
+def _sql_ai_context(n: int) -> int:
+    return sum(
+        len(msg.text) + len(msg.model or "")
+        for chat in get_chat_list()
+        for msg in get_last_messages_for_ai(chat["id"], n)
+    )
+
+
+def benchmark(repeat: int = 5) -> None:
+    def measure(name: str, run: t.Callable[[], t.Any]) -> None:
+        timings = []
+
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+
+        print(f"  {name}: best {min(timings) * 1000:.1f} ms, mean {sum(timings) / repeat * 1000:.1f} ms")
+
+    (messages,) = _fetch("SELECT count(*) FROM message")[0]
+    (chat_id, last), *_ = _fetch("SELECT chat, max(utctime) FROM message GROUP BY chat ORDER BY count(*) DESC")
+    stop = from_db_datetime(last).astimezone(pytz.utc)
+    start = stop - timedelta(days=1)
+    day = get_messages(chat_id, start, stop, with_archive=False)
+
+    print(f"{messages} messages; chat #{chat_id} has {len(day)} messages on the last day")
+
+    print("get_messages, serialized:")
+    measure("ORM", lambda: _orm_messages(chat_id, start, stop))
+    measure("SQL", lambda: [m.to_dict() for m in get_messages(chat_id, start, stop, with_archive=False)])
+
+    print("AI context of all chats, 300 messages each:")
+    measure("ORM", lambda: _orm_ai_context(300))
+    measure("SQL", lambda: _sql_ai_context(300))
+
+
+def main(argv: t.List[str]) -> int:
+    from db import db_init
+
+    parser = argparse.ArgumentParser(description="Read path benchmark")
+    parser.add_argument("command", choices=("benchmark",))
+    parser.add_argument("--seed", type=int, metavar="N", help="seed empty database with N messages first")
+    args = parser.parse_args(argv[1:])
+
+    db_init()
+
+    if args.seed:
+        _seed(args.seed)
+
+    benchmark()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
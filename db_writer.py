@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import typing as t
+
+import db
+from config import settings
+from db_async import executor
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedWriter:
+    """
+    Write-behind stage for db.store_batch()
+
+    Rows are buffered and written in one transaction every `batch_size` rows or every `flush_interval` seconds,
+    whichever comes first. Each store() call resolves with its own StoredMessage (or AIUsage id) once the batch
+    containing it is committed.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._pending: t.List[t.Tuple[db.PendingRow, asyncio.Future]] = []
+        self._wakeup: t.Optional[asyncio.Event] = None
+        self._flush_lock: t.Optional[asyncio.Lock] = None
+        self._task: t.Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closed
+
+    def start(self) -> None:
+        self._closed = False
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Batched writer started: {self.batch_size} rows / {self.flush_interval * 1000:.0f} ms")
+
+    def submit(self, row: db.PendingRow) -> asyncio.Future:
+        """
+        Put row into buffer. The returned future resolves after the row is committed
+        """
+        if not self.running:
+            raise RuntimeError("Batched writer is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+        return future
+
+    async def store(self, row: db.PendingRow) -> db.StoredRow:
+        return await self.submit(row)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[: self.batch_size]
+                self._pending = self._pending[self.batch_size :]
+                await self._write(batch)
+
+    async def close(self) -> None:
+        """
+        Stop accepting new rows and drain the buffer
+        """
+        if self._task is None:
+            return
+
+        self._closed = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+        logger.info("Batched writer is stopped, all pending rows are written")
+
+    async def _run(self) -> None:
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Batched writer flush failed")
+
+        await self.flush()
+
+    async def _write(self, batch: t.List[t.Tuple[db.PendingRow, asyncio.Future]]) -> None:
+        rows = [row for row, _ in batch]
+
+        try:
+            results = await executor.run(db.store_batch, rows)
+        except Exception:
+            logger.exception(f"Failed to store batch of {len(rows)} rows, retrying one by one")
+            await self._write_one_by_one(batch)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _write_one_by_one(self, batch: t.List[t.Tuple[db.PendingRow, asyncio.Future]]) -> None:
+        for row, future in batch:
+            try:
+                result = (await executor.run(db.store_batch, [row]))[0]
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+
+            if not future.done():
+                future.set_result(result)
+
+
+writer = BatchedWriter(
+    batch_size=settings.get("ingest.batch_size", 100),
+    flush_interval=settings.get("ingest.flush_interval_ms", 50) / 1000,
+)
+
+
+def benchmark(n_rows: int = 5000, n_chats: int = 10) -> None:
+    """
+    Compare one-transaction-per-row store path against BatchedWriter on a throwaway SQLite database
+    """
+    import os
+    import tempfile
+    import time
+
+    fd, filename = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+
+    db.db.bind(provider="sqlite", filename=filename)
+    db.db.generate_mapping(create_tables=True)
+
+    def make_rows():
+        return [
+            db.PendingMessage(
+                chat_jid=f"room{i % n_chats}@conference.example.com",
+                chat_name=f"room{i % n_chats}",
+                is_muc=True,
+                msg_type=db.MessageType.USER,
+                nick=f"user{i % 37}",
+                text=f"benchmark message #{i}",
+            )
+            for i in range(n_rows)
+        ]
+
+    rows = make_rows()
+    started = time.perf_counter()
+
+    for row in rows:
+        db.store_batch([row])
+
+    direct = time.perf_counter() - started
+
+    async def run_batched():
+        batched_writer = BatchedWriter(writer.batch_size, writer.flush_interval)
+        batched_writer.start()
+        await asyncio.gather(*(batched_writer.store(row) for row in make_rows()))
+        await batched_writer.close()
+
+    started = time.perf_counter()
+    asyncio.run(run_batched())
+    batched = time.perf_counter() - started
+
+    os.unlink(filename)
+
+    print(f"{n_rows} rows, batch size {writer.batch_size}, flush interval {writer.flush_interval * 1000:.0f} ms")
+    print(f"  one commit per row: {direct:.2f}s ({n_rows / direct:.0f} rows/s)")
+    print(f"  batched writer:     {batched:.2f}s ({n_rows / batched:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,358 @@
+"""
+Bulk export and import of chat history
+
+Usage:
+    python dump.py export <directory> [--resume]
+    python dump.py import <directory> [--resume]
+
+Dump is a directory of gzip-compressed JSONL chunks named `<table>.<chunk>.jsonl.gz`, each holding up to
+`dump.chunk_rows` rows ordered by id. First line of a chunk is a header with table and column names, every next
+line is a JSON array of row values. Message texts are always plain, even if stored compressed. Rows keep their
+ids, so import expects tables which don't have these ids yet.
+
+Export streams rows with server-side cursor and writes each chunk to a temporary file, which is renamed once the
+chunk is complete; `--resume` continues after the last complete chunk. Import commits every `dump.batch_rows`
+rows (with COPY on Postgres); `--resume` skips rows whose ids are already in the target table. Derived tables
+(AI usage rollup, calendar and search indexes, chat summaries) are rebuilt after import.
+"""
+import argparse
+import glob
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import time
+import typing as t
+from dataclasses import dataclass
+from datetime import datetime
+
+import pytz
+
+from compression import unpack_text
+from config import settings
+from db import db, from_db_datetime, raw_connection, raw_sql
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = settings.get("dump.chunk_rows", 1_000_000)
+BATCH_ROWS = settings.get("dump.batch_rows", 10_000)
+FETCH_ROWS = 10_000
+REPORT_INTERVAL = 5  # seconds
+
+CHUNK_SUFFIX = ".jsonl.gz"
+
+
+@dataclass
+class Table:
+    name: str
+    columns: t.Tuple[str, ...]
+    datetime_columns: t.Tuple[str, ...] = ()
+    bool_columns: t.Tuple[str, ...] = ()
+    # `text` may be stored in `text_compressed` column; dumps always hold plain text
+    packed_text: bool = False
+
+    @property
+    def select_columns(self) -> t.Tuple[str, ...]:
+        return self.columns + ("text_compressed",) if self.packed_text else self.columns
+
+
+MESSAGE_COLUMNS = ("id", "chat", "utctime", "msg_type", "nick", "text", "outgoing")
+AI_USAGE_COLUMNS = ("id", "model", "prompt", "completion", "completion_tokens", "prompt_tokens", "total_tokens")
+
+# In order of foreign key dependencies
+TABLES: t.List[Table] = [
+    Table("chat", ("id", "jid", "name", "is_muc"), bool_columns=("is_muc",)),
+    Table("aimodel", ("id", "name")),
+    Table("aiprelude", ("id", "chat", "prelude")),
+    Table("message", MESSAGE_COLUMNS, datetime_columns=("utctime",), bool_columns=("outgoing",), packed_text=True),
+    Table(
+        "archivedmessage", MESSAGE_COLUMNS, datetime_columns=("utctime",), bool_columns=("outgoing",), packed_text=True
+    ),
+    Table("aiusage", AI_USAGE_COLUMNS),
+    Table("archivedaiusage", AI_USAGE_COLUMNS),
+    Table("nickcolor", ("id", "nick", "color")),
+    Table("blockedusers", ("id", "jid_or_nick")),
+]
+
+
+class Progress:
+    def __init__(self, action: str, table: str) -> None:
+        self.action = action
+        self.table = table
+        self.rows = 0
+        self.started = self.reported = time.monotonic()
+
+    def add(self, rows: int) -> None:
+        self.rows += rows
+        now = time.monotonic()
+
+        if now - self.reported >= REPORT_INTERVAL:
+            self.reported = now
+            logger.info(
+                f"{self.action} {self.rows} rows of {self.table} ({self.rows / (now - self.started):.0f} rows/s)"
+            )
+
+    def done(self) -> None:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        logger.info(
+            f"{self.action} {self.rows} rows of {self.table} in {elapsed:.1f}s ({self.rows / elapsed:.0f} rows/s)"
+        )
+
+
+def _to_utc_string(value: t.Union[datetime, str]) -> str:
+    # Same text format Pony uses for storing timezone-aware datetime in SQLite
+    value = from_db_datetime(value)
+
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+
+    return str(value.astimezone(pytz.utc))
+
+
+def _encode_row(table: Table, row: t.Sequence) -> list:
+    values = dict(zip(table.select_columns, row))
+
+    if table.packed_text:
+        values["text"] = unpack_text(values["text"], values.pop("text_compressed"))
+
+    for column in table.datetime_columns:
+        if values[column] is not None:
+            values[column] = _to_utc_string(values[column])
+
+    for column in table.bool_columns:
+        if values[column] is not None:
+            values[column] = bool(values[column])
+
+    return list(values.values())
+
+
+def _chunk_path(directory: str, table: Table, chunk: int) -> str:
+    return os.path.join(directory, f"{table.name}.{chunk:05d}{CHUNK_SUFFIX}")
+
+
+def _list_chunks(directory: str, table: Table) -> t.List[str]:
+    return sorted(glob.glob(os.path.join(directory, f"{table.name}.[0-9]*{CHUNK_SUFFIX}")))
+
+
+def _read_chunk(path: str, table: Table) -> t.Iterator[list]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(next(f))
+
+        if header["table"] != table.name or tuple(header["columns"]) != table.columns:
+            raise ValueError(f"{path}: expected columns of {table.name} {table.columns}, got {header}")
+
+        for line in f:
+            yield json.loads(line)
+
+
+def _stream(connection, sql: str, params: t.Sequence):
+    if db.provider_name == "postgres":
+        # Named cursor is server-side, rows are fetched by FETCH_ROWS at a time
+        cursor = connection.cursor(name="dump_export")
+        cursor.itersize = FETCH_ROWS
+    else:
+        cursor = connection.cursor()
+
+    cursor.execute(raw_sql(sql), params)
+    return cursor
+
+
+def export_table(connection, directory: str, table: Table) -> None:
+    chunks = _list_chunks(directory, table)
+    last_id = 0
+
+    if chunks:
+        for row in _read_chunk(chunks[-1], table):
+            last_id = row[0]
+
+        logger.info(f"Resuming export of {table.name} after id {last_id}")
+
+    chunk = len(chunks)
+    progress = Progress("Exported", table.name)
+    sql = f"SELECT {', '.join(table.select_columns)} FROM {table.name} WHERE id > ? ORDER BY id LIMIT ?"
+
+    while True:
+        path = _chunk_path(directory, table, chunk)
+        partial_path = f"{path}.partial"
+        written = 0
+        cursor = _stream(connection, sql, (last_id, CHUNK_ROWS))
+
+        with gzip.open(partial_path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps({"table": table.name, "columns": table.columns}) + "\n")
+
+            for row in cursor:
+                row = _encode_row(table, row)
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                last_id = row[0]
+                written += 1
+
+                if written % FETCH_ROWS == 0:
+                    progress.add(FETCH_ROWS)
+
+        cursor.close()
+        progress.add(written % FETCH_ROWS)
+
+        if not written:
+            os.unlink(partial_path)
+            break
+
+        os.replace(partial_path, path)
+        chunk += 1
+
+        if written < CHUNK_ROWS:
+            break
+
+    progress.done()
+
+
+def export_all(directory: str, resume: bool) -> None:
+    os.makedirs(directory, exist_ok=True)
+
+    if not resume and any(_list_chunks(directory, table) for table in TABLES):
+        raise FileExistsError(f"{directory} already contains a dump, use --resume to continue it")
+
+    connection = raw_connection()
+
+    try:
+        if db.provider_name == "postgres":
+            # One read-only transaction gives consistent snapshot and allows server-side cursors
+            connection.autocommit = False
+            connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+
+        for table in TABLES:
+            export_table(connection, directory, table)
+    finally:
+        connection.close()
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+
+    if isinstance(value, bool):
+        return "t" if value else "f"
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _insert_batch(connection, table: Table, rows: t.List[list]) -> None:
+    cursor = connection.cursor()
+
+    if db.provider_name == "postgres":
+        buffer = io.StringIO()
+
+        for row in rows:
+            buffer.write("\t".join(map(_copy_value, row)) + "\n")
+
+        buffer.seek(0)
+        # Connection is in autocommit mode, so each COPY is committed on its own
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(table.columns)}) FROM STDIN", buffer)
+    else:
+        placeholders = ", ".join("?" * len(table.columns))
+        cursor.execute("BEGIN")
+        cursor.executemany(f"INSERT INTO {table.name} ({', '.join(table.columns)}) VALUES ({placeholders})", rows)
+        cursor.execute("COMMIT")
+
+    cursor.close()
+
+
+def _max_id(connection, table: Table) -> int:
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT max(id) FROM {table.name}")
+    (max_id,) = cursor.fetchone()
+    cursor.close()
+    return max_id or 0
+
+
+def import_table(connection, directory: str, table: Table, resume: bool) -> None:
+    chunks = _list_chunks(directory, table)
+
+    if not chunks:
+        return
+
+    skip_to = _max_id(connection, table) if resume else 0
+
+    if skip_to:
+        logger.info(f"Resuming import of {table.name} after id {skip_to}")
+
+    progress = Progress("Imported", table.name)
+    batch = []
+
+    for path in chunks:
+        for row in _read_chunk(path, table):
+            if row[0] <= skip_to:
+                continue
+
+            batch.append(row)
+
+            if len(batch) >= BATCH_ROWS:
+                _insert_batch(connection, table, batch)
+                progress.add(len(batch))
+                batch = []
+
+    if batch:
+        _insert_batch(connection, table, batch)
+        progress.add(len(batch))
+
+    progress.done()
+
+
+def _reset_sequences(connection) -> None:
+    cursor = connection.cursor()
+
+    for table in TABLES:
+        # Archive tables don't have sequence, pg_get_serial_sequence() returns NULL for them
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), max(id)) FROM {table.name}"
+            " HAVING max(id) IS NOT NULL"
+        )
+
+    cursor.close()
+
+
+def import_all(directory: str, resume: bool) -> None:
+    from migrations import backfill_chat_calendar, backfill_chat_summary, backfill_search_index, backfill_usage_rollup
+
+    if not any(_list_chunks(directory, table) for table in TABLES):
+        raise FileNotFoundError(f"{directory} doesn't contain a dump")
+
+    connection = raw_connection()
+
+    try:
+        for table in TABLES:
+            import_table(connection, directory, table, resume)
+
+        if db.provider_name == "postgres":
+            _reset_sequences(connection)
+    finally:
+        connection.close()
+
+    backfill_usage_rollup()
+    backfill_chat_calendar()
+    backfill_search_index()
+    backfill_chat_summary()
+
+
+def main(argv: t.List[str]) -> int:
+    from db import db_init
+
+    parser = argparse.ArgumentParser(description="Bulk export and import of chat history")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("directory")
+    parser.add_argument("--resume", action="store_true", help="continue interrupted export or import")
+    args = parser.parse_args(argv[1:])
+
+    db_init()
+
+    if args.command == "export":
+        export_all(args.directory, args.resume)
+    else:
+        import_all(args.directory, args.resume)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
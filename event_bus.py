@@ -0,0 +1,246 @@
+"""
+Publish/subscribe bus between bot and web UI workers
+
+Events are dicts published to a topic:
+  - WS_TOPIC: notifications for websocket clients. Every web worker subscribes and fans them out to its own sockets
+  - OUTGOING_TOPIC: messages sent from web UI, which the bot sends to XMPP
+
+With Redis, every topic is a Redis stream, so the bot and any number of web workers may run in separate processes.
+Without it, an in-process bus is used and everything must run in one process.
+
+Both keep `event_bus.max_length` latest events of every topic. Events get increasing ids, and `replay()` returns
+events published after given id, so clients reconnecting to a restarted worker can catch up on what they missed.
+"""
+import asyncio
+import logging
+import typing as t
+from collections import deque
+
+from config import settings
+from redis_cache import BACKOFF_MAX, BACKOFF_MIN, ENABLED, connection_params, redis
+from serialization import decode, encode
+from util import stats
+
+logger = logging.getLogger(__name__)
+
+WS_TOPIC = "ws"
+OUTGOING_TOPIC = "outgoing"
+
+STREAM_PREFIX = "ugubot:events:"
+# How long XREAD waits for new events before asking again
+BLOCK_MS = 5000
+READ_COUNT = 100
+
+Event = t.Dict[str, t.Any]
+
+
+class EventBus:
+    def __init__(self, max_length: int) -> None:
+        self.max_length = max_length
+        self.published: t.Dict[str, int] = {}
+        self.received: t.Dict[str, int] = {}
+
+    async def publish(self, topic: str, event: Event) -> t.Optional[str]:
+        """
+        Returns id of published event, or None if it couldn't be published
+        """
+        raise NotImplementedError
+
+    async def replay(self, topic: str, after: str) -> t.List[t.Tuple[str, Event]]:
+        """
+        Stored events published after event `after`, oldest first
+        """
+        raise NotImplementedError
+
+    def subscribe(self, topic: str) -> t.AsyncIterator[t.Tuple[str, Event]]:
+        """
+        (id, event) pairs of events published after subscribing
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    def _count(self, counter: t.Dict[str, int], topic: str, n: int = 1) -> None:
+        counter[topic] = counter.get(topic, 0) + n
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {
+            "backend": type(self).__name__,
+            "max_length": self.max_length,
+            "published": dict(self.published),
+            "received": dict(self.received),
+        }
+
+
+class MemoryEventBus(EventBus):
+    """
+    Bus of single process, event ids are sequential numbers
+    """
+
+    def __init__(self, max_length: int) -> None:
+        super().__init__(max_length)
+        self._events: t.Dict[str, "deque[t.Tuple[int, Event]]"] = {}
+        self._last_id: t.Dict[str, int] = {}
+        # Set and replaced on every publish, created on first use so it belongs to the running event loop
+        self._published: t.Dict[str, asyncio.Event] = {}
+
+    def _signal(self, topic: str) -> asyncio.Event:
+        if topic not in self._published:
+            self._published[topic] = asyncio.Event()
+
+        return self._published[topic]
+
+    def _after(self, topic: str, after: int) -> t.List[t.Tuple[str, Event]]:
+        events = self._events.get(topic, ())
+        return [(str(event_id), event) for event_id, event in events if event_id > after]
+
+    async def publish(self, topic: str, event: Event) -> t.Optional[str]:
+        event_id = self._last_id.get(topic, 0) + 1
+        self._last_id[topic] = event_id
+
+        self._events.setdefault(topic, deque(maxlen=self.max_length)).append((event_id, event))
+        self._count(self.published, topic)
+
+        self._signal(topic).set()
+        self._published[topic] = asyncio.Event()
+
+        return str(event_id)
+
+    async def replay(self, topic: str, after: str) -> t.List[t.Tuple[str, Event]]:
+        try:
+            after_id = int(after)
+        except ValueError:
+            # Id of other bus, e.g. from before Redis was enabled
+            return []
+
+        return self._after(topic, after_id)
+
+    async def subscribe(self, topic: str) -> t.AsyncIterator[t.Tuple[str, Event]]:
+        last_id = self._last_id.get(topic, 0)
+
+        while True:
+            signal = self._signal(topic)
+            events = self._after(topic, last_id)
+
+            if not events:
+                await signal.wait()
+                continue
+
+            self._count(self.received, topic, len(events))
+
+            for event in events:
+                yield event
+
+            last_id = int(events[-1][0])
+
+
+class RedisEventBus(EventBus):
+    """
+    Bus of Redis streams, event ids are stream entry ids. Subscribers resume from the last received id after
+    connection errors, so they only miss events trimmed from the stream in the meantime. Events published while
+    Redis is unreachable are dropped
+    """
+
+    def __init__(self, max_length: int) -> None:
+        super().__init__(max_length)
+        self._client: t.Optional["redis.asyncio.Redis"] = None
+        self.failures = 0
+
+    def _get_client(self) -> "redis.asyncio.Redis":
+        # Own client, as subscribers block on XREAD for longer than command timeout of async_cache
+        if self._client is None:
+            params = connection_params()
+            params["socket_timeout"] = params["socket_timeout"] + BLOCK_MS / 1000
+            self._client = redis.asyncio.Redis(**params)
+
+        return self._client
+
+    @staticmethod
+    def _decode(entries: t.List) -> t.List[t.Tuple[str, Event]]:
+        events = []
+
+        for entry_id, fields in entries:
+            event = decode(fields.get(b"event"))
+
+            if event is not None:
+                events.append((entry_id.decode(), event))
+
+        return events
+
+    async def publish(self, topic: str, event: Event) -> t.Optional[str]:
+        try:
+            entry_id = await self._get_client().xadd(
+                STREAM_PREFIX + topic, {"event": encode(event)}, maxlen=self.max_length, approximate=True
+            )
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.failures += 1
+            logger.warning(f"Couldn't publish {topic} event: {e}")
+            return None
+
+        self._count(self.published, topic)
+        return entry_id.decode()
+
+    async def replay(self, topic: str, after: str) -> t.List[t.Tuple[str, Event]]:
+        try:
+            result = await self._get_client().xread({STREAM_PREFIX + topic: after}, count=self.max_length)
+        except redis.ResponseError:
+            # Not a stream entry id, e.g. from before Redis was enabled
+            return []
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.failures += 1
+            logger.warning(f"Couldn't replay {topic} events: {e}")
+            return []
+
+        return self._decode(result[0][1]) if result else []
+
+    async def subscribe(self, topic: str) -> t.AsyncIterator[t.Tuple[str, Event]]:
+        stream = STREAM_PREFIX + topic
+        last_id = None
+        backoff = BACKOFF_MIN
+
+        while True:
+            try:
+                client = self._get_client()
+
+                if last_id is None:
+                    # Not "$", which would skip events published between two XREADs
+                    latest = await client.xrevrange(stream, count=1)
+                    last_id = latest[0][0].decode() if latest else "0-0"
+
+                result = await client.xread({stream: last_id}, count=READ_COUNT, block=BLOCK_MS)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                self.failures += 1
+                logger.warning(f"Couldn't read {topic} events ({e}), retrying in {backoff:.1f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+                continue
+
+            backoff = BACKOFF_MIN
+
+            if not result:
+                continue
+
+            entries = result[0][1]
+            last_id = entries[-1][0].decode()
+            events = self._decode(entries)
+            self._count(self.received, topic, len(events))
+
+            for event in events:
+                yield event
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {**super().stats(), "failures": self.failures}
+
+
+_max_length = settings.get("event_bus.max_length", 10000)
+event_bus: EventBus = RedisEventBus(_max_length) if ENABLED else MemoryEventBus(_max_length)
+
+stats.register("event_bus", event_bus.stats)
+
+__all__ = ["event_bus", "WS_TOPIC", "OUTGOING_TOPIC"]
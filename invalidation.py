@@ -0,0 +1,279 @@
+"""
+In-memory copies of Redis keys and of small, rarely changed tables, kept in sync between processes
+
+Writers change the local copy in place and publish table name (or changed keys) to Redis channel; other processes
+reload their copy of table or drop their copy of keys when they receive it. Without Redis, copies are only kept
+in sync within one process.
+"""
+import copy
+import logging
+import threading
+import time
+import typing as t
+from collections import Counter
+from uuid import uuid4
+
+from config import settings
+from redis_cache import LocalCache, async_cache, cache
+from serialization import IntSeries
+from util import stats
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "ugubot:invalidate"
+# Lets listener skip changes published by this process, local copy is already up to date
+INSTANCE_ID = uuid4().hex
+# Message payload of changed keys is "keys:<key>\n<key>..."
+KEYS_PREFIX = "keys:"
+
+T = t.TypeVar("T")
+
+_tables: t.Dict[str, "CachedTable"] = {}
+
+
+class CachedTable(t.Generic[T]):
+    """
+    Loaded on first use with `load` and held in memory until invalidated
+    """
+
+    def __init__(self, name: str, load: t.Callable[[], T]) -> None:
+        self.name = name
+        self._load = load
+        self._lock = threading.Lock()
+        self._data: t.Optional[T] = None
+
+        _tables[name] = self
+
+    @property
+    def loaded(self) -> bool:
+        return self._data is not None
+
+    def get(self) -> T:
+        data = self._data
+
+        if data is not None:
+            return data
+
+        with self._lock:
+            if self._data is None:
+                self._data = self._load()
+                logger.debug(f"Cached table {self.name} is loaded")
+
+            return self._data
+
+    def update(self, change: t.Callable[[T], None]) -> None:
+        """
+        Apply committed change to local copy and notify other processes
+        """
+        with self._lock:
+            if self._data is not None:
+                # Copy on write: readers may iterate over current copy without lock
+                data = copy.copy(self._data)
+                change(data)
+                self._data = data
+
+        publish(self.name)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._data = None
+
+    def reload(self) -> None:
+        data = self._load()
+
+        with self._lock:
+            self._data = data
+
+
+class TieredCache:
+    """
+    Bounded in-process LRU with TTL in front of async_cache. Values are kept deserialized, so callers must not
+    modify them. Writes go to Redis, then invalidate the keys in other processes; TTL bounds staleness if an
+    invalidation is lost. Stats are kept per namespace, which is the part of key before the first ":"
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.ttl = ttl
+        self._local = LocalCache(max_size)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so values fetched before it aren't stored locally after it
+        self._generation = 0
+        self._stats: t.Dict[str, Counter] = {}
+
+    @staticmethod
+    def _namespace(key: str) -> str:
+        return key.split(":", 1)[0]
+
+    def _count(self, key: str, event: str, n: int = 1) -> None:
+        self._stats.setdefault(self._namespace(key), Counter())[event] += n
+
+    def _get_local(self, key: str) -> t.Any:
+        with self._lock:
+            value = self._local.get(key)
+            self._count(key, "hits" if value is not None else "misses")
+            return value
+
+    def _set_local(self, values: t.Mapping[str, t.Any], generation: t.Optional[int] = None) -> None:
+        """
+        Store values fetched at `generation`, or written by this process if it's None
+        """
+        with self._lock:
+            if generation is None:
+                # Written values supersede ones which are being fetched
+                self._generation += 1
+            elif generation != self._generation:
+                return
+
+            for key, value in values.items():
+                if value is None:
+                    continue
+
+                for evicted in self._local.set(key, value, self.ttl):
+                    self._count(evicted, "evictions")
+
+    def invalidate(self, keys: t.Optional[t.Iterable[str]] = None) -> None:
+        """
+        Drop local copies of `keys`, or of all keys
+        """
+        with self._lock:
+            self._generation += 1
+
+            if keys is None:
+                self._local.clear()
+                return
+
+            for key in keys:
+                self._local.delete(key)
+                self._count(key, "invalidations")
+
+    async def get(self, key: str) -> t.Any:
+        return (await self.mget([key]))[0]
+
+    async def mget(self, keys: t.Sequence[str]) -> t.List[t.Any]:
+        """
+        Values of `keys`, missing local ones are fetched from Redis in one round-trip
+        """
+        values = [self._get_local(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+
+        if not missing:
+            return values
+
+        generation = self._generation
+        fetched = dict(zip(missing, await async_cache.mget(missing)))
+        self._set_local(fetched, generation)
+
+        return [fetched[key] if value is None else value for key, value in zip(keys, values)]
+
+    async def set(self, key: str, value: t.Any, ex: t.Optional[int] = None) -> None:
+        await self.mset({key: value}, ex)
+
+    async def mset(self, mapping: t.Mapping[str, t.Any], ex: t.Optional[int] = None) -> None:
+        if not mapping:
+            return
+
+        await async_cache.mset(mapping, ex)
+        self._set_local(mapping)
+        await publish_keys(mapping)
+
+    async def append_series(self, key: str, values: t.Sequence[int], latest_key: str, last: int) -> bool:
+        """
+        See AsyncCache.append_series()
+        """
+        if not await async_cache.append_series(key, values, latest_key, last):
+            self.invalidate([key, latest_key])
+            return False
+
+        with self._lock:
+            current = self._local.get(key)
+
+        self._set_local(
+            {key: IntSeries(current + list(values)) if current is not None else None, latest_key: values[-1]}
+        )
+        await publish_keys([key, latest_key])
+        return True
+
+    async def delete(self, *keys: str) -> None:
+        # Nothing to tell other processes either
+        if not keys:
+            return
+
+        await async_cache.delete(*keys)
+        self.invalidate(keys)
+        await publish_keys(keys)
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        with self._lock:
+            namespaces = {namespace: dict(counter) for namespace, counter in self._stats.items()}
+
+        return {"size": len(self._local), "ttl": self.ttl, "namespaces": namespaces}
+
+
+tiered_cache = TieredCache(
+    max_size=settings.get("cache.local_size", 10000),
+    ttl=settings.get("cache.local_ttl", 300),
+)
+
+stats.register("tiered_cache", tiered_cache.stats)
+
+
+async def publish_keys(keys: t.Iterable[str]) -> None:
+    if not async_cache.available:
+        return
+
+    await async_cache.publish(CHANNEL, f"{INSTANCE_ID}:{KEYS_PREFIX}" + "\n".join(keys))
+
+
+def publish(name: str) -> None:
+    if not cache.available:
+        return
+
+    try:
+        cache.publish(CHANNEL, f"{INSTANCE_ID}:{name}")
+    except Exception:
+        logger.exception(f"Couldn't publish invalidation of {name}")
+
+
+def _on_message(message: dict) -> None:
+    instance_id, _, name = message["data"].decode().partition(":")
+
+    if instance_id == INSTANCE_ID:
+        return
+
+    if name.startswith(KEYS_PREFIX):
+        tiered_cache.invalidate(name[len(KEYS_PREFIX) :].split("\n"))
+        return
+
+    table = _tables.get(name)
+
+    if table is None:
+        return
+
+    logger.info(f"Cached table {name} is changed by another process, reloading")
+
+    try:
+        table.reload()
+    except Exception:
+        logger.exception(f"Couldn't reload cached table {name}")
+        table.invalidate()
+
+
+def _on_error(error: Exception, pubsub, thread) -> None:
+    # Signals may be lost while disconnected, so all copies are reloaded on next use
+    logger.warning(f"Invalidation listener error: {error}")
+
+    for table in _tables.values():
+        table.invalidate()
+
+    tiered_cache.invalidate()
+
+    time.sleep(1)
+
+
+def start_listener() -> None:
+    if not cache.available:
+        logger.info("Redis is not available, cached tables are not synchronized between processes")
+        return
+
+    cache.subscribe(CHANNEL, _on_message, _on_error)
+    logger.info(f"Listening for cached table changes on {CHANNEL}")
@@ -0,0 +1,566 @@
+"""
+Versioned schema migrations applied on top of tables created by Pony's generate_mapping()
+
+Usage:
+    python migrations.py migrate    # apply pending migrations
+    python migrations.py status     # show applied and pending migrations
+    python migrations.py check      # EXPLAIN hot queries on seeded rows, exit with code 1 if any does a full scan
+    python migrations.py backfill-usage  # rebuild AI usage daily rollup from history
+    python migrations.py backfill-calendar  # rebuild per-chat calendar index from history
+    python migrations.py backfill-search  # rebuild full-text search index
+    python migrations.py backfill-summary  # rebuild chat list summaries
+"""
+import json
+import logging
+import re
+import sys
+import typing as t
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+import pytz
+
+import db_read
+from compression import unpack_text
+from db import (
+    PREVIEW_LENGTH,
+    SEARCH_TS_CONFIG,
+    USAGE_PROMPT_TYPES,
+    MessageType,
+    SchemaMigration,
+    db,
+    db_session,
+    index_for_search,
+    raw_sql,
+    rollback,
+    to_db_datetime,
+    to_utc_hour,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    # Statements per provider; "*" is used when there is no provider-specific list
+    statements: t.Dict[str, t.List[str]] = field(default_factory=dict)
+    # Run after statements, in the same transaction
+    functions: t.List[t.Callable[[], None]] = field(default_factory=list)
+
+    def get_statements(self, provider: str) -> t.List[str]:
+        return self.statements.get(provider, self.statements.get("*", []))
+
+
+# Same rows as db._update_usage_rollup() maintains
+_USAGE_ROLLUP_BACKFILL = (
+    "INSERT INTO aiusagedaily (day, chat, nick, model, prompt_tokens, completion_tokens, total_tokens)"
+    " SELECT {day}, m.chat, m.nick, u.model, sum(coalesce(u.prompt_tokens, 0)), sum(coalesce(u.completion_tokens, 0)),"
+    " sum(coalesce(u.total_tokens, 0))"
+    " FROM (SELECT id, chat, nick, utctime, msg_type FROM message"
+    "  UNION ALL SELECT id, chat, nick, utctime, msg_type FROM archivedmessage) AS m"
+    " JOIN (SELECT model, prompt, prompt_tokens, completion_tokens, total_tokens FROM aiusage"
+    "  UNION ALL SELECT model, prompt, prompt_tokens, completion_tokens, total_tokens FROM archivedaiusage) AS u"
+    " ON u.prompt = m.id"
+    f" WHERE m.msg_type IN ({', '.join(map(str, USAGE_PROMPT_TYPES))})"
+    " GROUP BY 1, m.chat, m.nick, u.model"
+)
+
+# Full-text index side table, keyed by message id (rowid on SQLite). Archived messages keep their ids,
+# so the same table indexes both Message and ArchivedMessage
+SEARCH_INDEX_BACKFILL = {
+    "sqlite": [
+        "DELETE FROM message_fts",
+        "INSERT INTO message_fts (rowid, text)"
+        " SELECT id, text FROM message WHERE text <> ''"
+        " UNION ALL SELECT id, text FROM archivedmessage WHERE text <> ''",
+    ],
+    "postgres": [
+        "DELETE FROM message_fts",
+        "INSERT INTO message_fts (id, tsv)"
+        " SELECT id, to_tsvector($SEARCH_TS_CONFIG, text) FROM message WHERE text <> ''"
+        " UNION ALL SELECT id, to_tsvector($SEARCH_TS_CONFIG, text) FROM archivedmessage WHERE text <> ''",
+    ],
+}
+
+SEARCH_INDEX = {
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5 (text)",
+        *SEARCH_INDEX_BACKFILL["sqlite"],
+    ],
+    "postgres": [
+        "CREATE TABLE IF NOT EXISTS message_fts (id INTEGER PRIMARY KEY, tsv TSVECTOR NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_message_fts__tsv ON message_fts USING GIN (tsv)",
+        *SEARCH_INDEX_BACKFILL["postgres"],
+    ],
+}
+
+USAGE_ROLLUP_BACKFILL = {
+    "sqlite": ["DELETE FROM aiusagedaily", _USAGE_ROLLUP_BACKFILL.format(day="date(m.utctime)")],
+    "postgres": ["DELETE FROM aiusagedaily", _USAGE_ROLLUP_BACKFILL.format(day="CAST(m.utctime AS DATE)")],
+}
+
+_CHAT_CALENDAR_BACKFILL = (
+    "INSERT INTO chatday (chat, hour, message_count)"
+    " SELECT m.chat, {hour}, count(*)"
+    " FROM (SELECT chat, utctime FROM message UNION ALL SELECT chat, utctime FROM archivedmessage) AS m"
+    " GROUP BY 1, 2"
+)
+
+CHAT_CALENDAR_BACKFILL = {
+    "sqlite": [
+        "DELETE FROM chatday",
+        _CHAT_CALENDAR_BACKFILL.format(hour="CAST(strftime('%s', m.utctime) AS INTEGER) / 3600"),
+    ],
+    "postgres": [
+        "DELETE FROM chatday",
+        _CHAT_CALENDAR_BACKFILL.format(hour="CAST(floor(extract(epoch FROM m.utctime) / 3600) AS INTEGER)"),
+    ],
+}
+
+
+CHAT_SUMMARY_BACKFILL = {
+    "*": [
+        "DELETE FROM chatsummary",
+        "INSERT INTO chatsummary (chat, last_message_id, last_utctime, last_nick, preview, message_count)"
+        " SELECT c.chat, c.last_id, coalesce(m.utctime, a.utctime), coalesce(m.nick, a.nick),"
+        f" substr(coalesce(m.text, a.text), 1, {PREVIEW_LENGTH}), c.message_count"
+        " FROM (SELECT chat, max(id) AS last_id, count(*) AS message_count"
+        " FROM (SELECT chat, id FROM message UNION ALL SELECT chat, id FROM archivedmessage) AS ids GROUP BY chat) AS c"
+        " LEFT JOIN message m ON m.id = c.last_id LEFT JOIN archivedmessage a ON a.id = c.last_id",
+    ],
+}
+
+
+def fill_compressed_previews() -> None:
+    """
+    Previews of compressed last messages, which CHAT_SUMMARY_BACKFILL leaves empty
+    """
+    rows = db.select(
+        "SELECT s.id, coalesce(m.text_compressed, a.text_compressed) FROM chatsummary s"
+        " LEFT JOIN message m ON m.id = s.last_message_id LEFT JOIN archivedmessage a ON a.id = s.last_message_id"
+        " WHERE m.text_compressed IS NOT NULL OR a.text_compressed IS NOT NULL"
+    )
+
+    for summary_id, compressed in rows:
+        preview = unpack_text(None, compressed)[:PREVIEW_LENGTH]
+        db.execute("UPDATE chatsummary SET preview = $preview WHERE id = $summary_id")
+
+
+def add_column(table: str, column: str, types: t.Dict[str, str]) -> t.Callable[[], None]:
+    """
+    Migration function adding column unless it exists: tables created from scratch already have it
+    """
+
+    def apply() -> None:
+        if db.provider_name == "postgres":
+            db.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {types['postgres']}")
+            return
+
+        if column not in [row[1] for row in db.execute(f"PRAGMA table_info({table})")]:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {types['sqlite']}")
+
+    return apply
+
+
+def run_statements(statements: t.Dict[str, t.List[str]]) -> t.Callable[[], None]:
+    """
+    Migration function running statements per provider, for ones which have to go after other functions
+    """
+
+    def apply() -> None:
+        for statement in statements[db.provider_name]:
+            db.execute(statement)
+
+    return apply
+
+
+# Pony lowercases table names on Postgres, while SQLite identifiers are case-insensitive,
+# so unquoted lowercase names work for both
+MIGRATIONS: t.List[Migration] = [
+    Migration(
+        version=1,
+        description="Composite indexes for message history queries",
+        statements={
+            "*": [
+                "CREATE INDEX IF NOT EXISTS idx_message__chat_utctime ON message (chat, utctime)",
+                "CREATE INDEX IF NOT EXISTS idx_message__chat_msg_type_utctime ON message (chat, msg_type, utctime)",
+                "CREATE INDEX IF NOT EXISTS idx_message__msg_type_utctime ON message (msg_type, utctime)",
+            ],
+        },
+    ),
+    Migration(
+        version=2,
+        description="Backfill AI usage daily rollup",
+        statements=USAGE_ROLLUP_BACKFILL,
+    ),
+    Migration(
+        version=3,
+        description="Full-text search index for messages",
+        statements=SEARCH_INDEX,
+    ),
+    Migration(
+        version=4,
+        description="Backfill per-chat calendar index",
+        statements=CHAT_CALENDAR_BACKFILL,
+    ),
+    Migration(
+        version=5,
+        description="Indexes for keyset pagination of message history",
+        # On SQLite id is rowid, which is already the last column of every index
+        statements={
+            "postgres": [
+                "CREATE INDEX IF NOT EXISTS idx_message__chat_utctime_id ON message (chat, utctime, id)",
+                "CREATE INDEX IF NOT EXISTS idx_archivedmessage__chat_utctime_id ON archivedmessage (chat, utctime, id)",
+            ],
+        },
+    ),
+    Migration(
+        version=6,
+        description="Compressed message text column",
+        functions=[
+            add_column("message", "text_compressed", {"sqlite": "BLOB", "postgres": "BYTEA"}),
+            add_column("archivedmessage", "text_compressed", {"sqlite": "BLOB", "postgres": "BYTEA"}),
+        ],
+    ),
+    Migration(
+        version=7,
+        description="Chat list summaries",
+        statements=CHAT_SUMMARY_BACKFILL,
+        functions=[fill_compressed_previews],
+    ),
+    Migration(
+        version=8,
+        description="Total tokens in AI usage daily rollup, prompts of reported types only",
+        functions=[
+            add_column(
+                "aiusagedaily",
+                "total_tokens",
+                {"sqlite": "INTEGER NOT NULL DEFAULT 0", "postgres": "INTEGER NOT NULL DEFAULT 0"},
+            ),
+            run_statements(USAGE_ROLLUP_BACKFILL),
+        ],
+    ),
+]
+
+
+def get_applied_versions() -> t.Set[int]:
+    with db_session:
+        return {m.version for m in SchemaMigration.select()}
+
+
+def migrate() -> None:
+    applied = get_applied_versions()
+
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        if migration.version in applied:
+            continue
+
+        logger.info(f"Applying migration #{migration.version}: {migration.description}")
+
+        with db_session:
+            for statement in migration.get_statements(db.provider_name):
+                db.execute(statement)
+
+            for function in migration.functions:
+                function()
+
+            SchemaMigration(
+                version=migration.version,
+                description=migration.description,
+                applied_at=datetime.now().astimezone(pytz.utc),
+            )
+
+    logger.info("Database schema is up to date")
+
+
+@dataclass
+class HotQuery:
+    name: str
+    # SQL built by db_read.py for parameters of seeded rows, see _seed_plan_check()
+    build: t.Callable[[t.Dict[str, t.Any]], db_read.SQLQuery]
+
+
+# Queries which must be served by index
+HOT_QUERIES: t.List[HotQuery] = [
+    HotQuery(
+        name="get_messages (messages of chat for day)",
+        build=lambda p: db_read.messages_query(p["chat_id"], p["start"], p["stop"], with_archive=False),
+    ),
+    HotQuery(
+        name="get_messages (messages of chat for day, with archive)",
+        build=lambda p: db_read.messages_query(p["chat_id"], p["start"], p["stop"], with_archive=True),
+    ),
+    HotQuery(
+        name="get_messages_page (latest)",
+        build=lambda p: db_read.messages_page_query(p["chat_id"], 100, before=None, after=None),
+    ),
+    HotQuery(
+        name="get_messages_page (older than cursor)",
+        build=lambda p: db_read.messages_page_query(p["chat_id"], 100, before=p["cursor"], after=None),
+    ),
+    HotQuery(
+        name="get_messages_page (newer than cursor)",
+        build=lambda p: db_read.messages_page_query(p["chat_id"], 100, before=None, after=p["cursor"]),
+    ),
+    HotQuery(
+        name="get_messages_after (resume of websocket client)",
+        build=lambda p: db_read.messages_after_query(p["chat_id"], p["message_id"], 500),
+    ),
+    HotQuery(
+        name="get_last_messages_for_ai",
+        build=lambda p: db_read.last_messages_for_ai_query(p["chat_id"], 300),
+    ),
+    HotQuery(
+        name="get_usage_for_last_n_days (one chat)",
+        build=lambda p: db_read.usage_query(30, p["chat_id"]),
+    ),
+    HotQuery(
+        name="get_usage_for_last_n_days (all chats)",
+        build=lambda p: db_read.usage_query(30, None),
+    ),
+    HotQuery(
+        name="get_calendar_hours (new hours of chat)",
+        build=lambda p: db_read.calendar_hours_query(p["chat_id"], p["start_hour"]),
+    ),
+]
+
+# Plans of SQLite 3.36+ and older ones. Scan of a whole index is still a full scan
+_SQLITE_FULL_SCAN = re.compile(r"^SCAN (TABLE )?(\S+)( USING (COVERING )?INDEX \S+)?$")
+# Scan of a subquery reads only rows it produced
+_SQLITE_SUBQUERY = re.compile(r"^(CO-ROUTINE|MATERIALIZE) (SUBQUERY \d+|\S+)")
+
+# Size of history seeded for the check, a year of it
+PLAN_CHECK_MESSAGES = 20000
+PLAN_CHECK_CHATS = 20
+PLAN_CHECK_MODELS = 5
+
+
+def _explain_sqlite(cursor, sql: str, params: t.List[t.Any]) -> t.Tuple[t.List[str], t.List[str]]:
+    cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+    plan = [row[-1] for row in cursor.fetchall()]
+    subqueries = {match.group(2) for match in map(_SQLITE_SUBQUERY.match, plan) if match}
+    full_scans = [
+        detail
+        for detail, match in zip(plan, map(_SQLITE_FULL_SCAN.match, plan))
+        if match and match.group(2) not in subqueries
+    ]
+    return plan, full_scans
+
+
+def _explain_postgres(cursor, sql: str, params: t.List[t.Any]) -> t.Tuple[t.List[str], t.List[str]]:
+    # Tables of a freshly seeded database are small enough for planner to prefer sequential scan anyway
+    cursor.execute("SET LOCAL enable_seqscan = off")
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {raw_sql(sql)}", params)
+
+    (raw_plan,) = cursor.fetchone()
+    raw_plan = json.loads(raw_plan) if isinstance(raw_plan, str) else raw_plan
+
+    plan, full_scans = [], []
+    nodes = [raw_plan[0]["Plan"]]
+
+    while nodes:
+        node = nodes.pop()
+        detail = f"{node['Node Type']} {node.get('Relation Name', '')}".strip()
+        plan.append(detail)
+
+        if node["Node Type"] == "Seq Scan":
+            full_scans.append(detail)
+
+        nodes.extend(node.get("Plans", []))
+
+    return plan, full_scans
+
+
+def _seed_plan_check(now: datetime) -> t.Dict[str, t.Any]:
+    """
+    Insert a year of history into every table of hot queries and ANALYZE them, so planner chooses plans it would
+    choose for a real database: on empty tables, or ones without statistics, it may as well scan them.
+    Ids go after existing ones, caller rolls everything back. Returns ids of seeded chat and message to query,
+    and page cursor of that message
+    """
+    cursor = db.get_connection().cursor()
+
+    def next_id(table: str) -> int:
+        cursor.execute(f"SELECT coalesce(max(id), 0) + 1 FROM {table}")
+        return cursor.fetchone()[0]
+
+    def insert(table: str, columns: t.Sequence[str], rows: t.List[tuple]) -> None:
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        cursor.executemany(raw_sql(sql), rows)
+
+    chat_id, model_id = next_id("chat"), next_id("aimodel")
+    # Archived messages keep their ids, so both tables share the range
+    message_id = max(next_id("message"), next_id("archivedmessage"))
+    chats = range(chat_id, chat_id + PLAN_CHECK_CHATS)
+    models = range(model_id, model_id + PLAN_CHECK_MODELS)
+    year = timedelta(days=365)
+    step = year / PLAN_CHECK_MESSAGES
+    start = now - year
+
+    insert("chat", ("id", "jid", "name", "is_muc"), [(i, f"{i}@plan-check", str(i), True) for i in chats])
+    insert("aimodel", ("id", "name"), [(i, f"plan-check-{i}") for i in models])
+
+    messages, archived, usage, days, hours = [], [], [], set(), set()
+
+    for i in range(PLAN_CHECK_MESSAGES):
+        chat = chats[i % len(chats)]
+        utctime = start + step * i
+        outgoing = i % 10 == 0
+        row = (chat, MessageType.USER.value, f"user{i % 50}", "")
+        messages.append((message_id + i, to_db_datetime(utctime), outgoing, *row))
+        # Year before that is archived
+        archived.append((message_id + PLAN_CHECK_MESSAGES + i, to_db_datetime(utctime - year), False, *row))
+
+        if outgoing and i:
+            usage.append((models[i % len(models)], message_id + i - 1, message_id + i, 10, 20, 30))
+
+        days.add((utctime.date(), chat, f"user{i % 3}", models[i % len(models)]))
+        hours.add((chat, to_utc_hour(utctime)))
+
+    columns = ("id", "utctime", "outgoing", "chat", "msg_type", "nick", "text")
+    insert("message", columns, messages)
+    insert("archivedmessage", columns, archived)
+    insert("aiusage", ("model", "prompt", "completion", "completion_tokens", "prompt_tokens", "total_tokens"), usage)
+    insert(
+        "aiusagedaily",
+        ("day", "chat", "nick", "model", "prompt_tokens", "completion_tokens", "total_tokens"),
+        [(day.isoformat(), chat, nick, model, 20, 10, 30) for day, chat, nick, model in days],
+    )
+    insert("chatday", ("chat", "hour", "message_count"), [(chat, hour, 1) for chat, hour in hours])
+
+    cursor.execute("ANALYZE")
+
+    # Chat of the middle message is the first seeded one
+    middle = PLAN_CHECK_MESSAGES // 2
+    _, utctime, *_ = messages[middle]
+    return {"chat_id": chat_id, "message_id": message_id + middle, "cursor": f"{message_id + middle},{utctime}"}
+
+
+def explain_hot_queries() -> t.List[t.Tuple[HotQuery, t.List[str], t.List[str]]]:
+    """
+    EXPLAIN every hot query on representative rows seeded into configured database in a transaction which is
+    rolled back. Returns plan of every query and steps of it which are full table scans
+    """
+    explain = _explain_postgres if db.provider_name == "postgres" else _explain_sqlite
+    now = datetime.now().astimezone(pytz.utc)
+    start = now - timedelta(days=30)
+    params = {"start": start, "stop": now, "start_hour": to_utc_hour(start)}
+    plans = []
+
+    with db_session:
+        params.update(_seed_plan_check(now))
+        cursor = db.get_connection().cursor()
+
+        for query in HOT_QUERIES:
+            plans.append((query, *explain(cursor, *query.build(params))))
+
+        rollback()
+
+    return plans
+
+
+def check_query_plans() -> bool:
+    """
+    Run EXPLAIN for every hot query and report ones which fall back to a full table scan
+    """
+    ok = True
+
+    for query, plan, full_scans in explain_hot_queries():
+        status = "FULL SCAN" if full_scans else "ok"
+        print(f"[{status}] {query.name}")
+
+        for detail in plan:
+            print(f"    {detail}")
+
+        ok = ok and not full_scans
+
+    return ok
+
+
+def backfill_usage_rollup() -> None:
+    with db_session:
+        for statement in USAGE_ROLLUP_BACKFILL[db.provider_name]:
+            db.execute(statement)
+
+    logger.info("AI usage daily rollup is rebuilt")
+
+
+def backfill_search_index() -> None:
+    with db_session:
+        for statement in SEARCH_INDEX_BACKFILL[db.provider_name]:
+            db.execute(statement)
+
+        # Compressed texts can't be indexed by SQL statement above
+        for table in ("message", "archivedmessage"):
+            rows = db.select(f"SELECT id, text_compressed FROM {table} WHERE text_compressed IS NOT NULL")
+            index_for_search([(message_id, unpack_text(None, compressed)) for message_id, compressed in rows])
+
+    logger.info("Search index is rebuilt")
+
+
+def backfill_chat_calendar() -> None:
+    with db_session:
+        for statement in CHAT_CALENDAR_BACKFILL[db.provider_name]:
+            db.execute(statement)
+
+    logger.info("Chat calendar index is rebuilt")
+
+
+def backfill_chat_summary() -> None:
+    with db_session:
+        for statement in CHAT_SUMMARY_BACKFILL["*"]:
+            db.execute(statement)
+
+        fill_compressed_previews()
+
+    logger.info("Chat list summaries are rebuilt")
+
+
+def main(argv: t.List[str]) -> int:
+    from db import db_init
+
+    command = argv[1] if len(argv) > 1 else "migrate"
+
+    if command not in (
+        "migrate",
+        "status",
+        "check",
+        "backfill-usage",
+        "backfill-calendar",
+        "backfill-search",
+        "backfill-summary",
+    ):
+        print(__doc__)
+        return 2
+
+    db_init()
+
+    if command == "status":
+        applied = get_applied_versions()
+
+        for migration in MIGRATIONS:
+            status = "applied" if migration.version in applied else "pending"
+            print(f"#{migration.version} [{status}] {migration.description}")
+
+    if command == "check":
+        return 0 if check_query_plans() else 1
+
+    if command == "backfill-usage":
+        backfill_usage_rollup()
+
+    if command == "backfill-calendar":
+        backfill_chat_calendar()
+
+    if command == "backfill-search":
+        backfill_search_index()
+
+    if command == "backfill-summary":
+        backfill_chat_summary()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
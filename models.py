@@ -1,3 +1,4 @@
+import typing as t
 from datetime import datetime
 
 import pytz
@@ -6,7 +7,17 @@ from pydantic import BaseModel, root_validator, validator
 from db import MessageType
 
 
+def to_timestamp(v: datetime) -> int:
+    if v.tzinfo:
+        dt_utc = pytz.utc.normalize(v.astimezone(pytz.utc))
+    else:
+        dt_utc = pytz.utc.normalize(pytz.utc.localize(v))
+
+    return int(dt_utc.timestamp() * 1000)
+
+
 class MessageModel(BaseModel):
+    id: int
     chat: int
     utctime: int
     msg_type: str
@@ -20,16 +31,11 @@ class MessageModel(BaseModel):
 
     @validator("utctime", pre=True)
     def get_timestamp(cls, v: datetime):
-        if v.tzinfo:
-            dt_utc = pytz.utc.normalize(v.astimezone(pytz.utc))
-        else:
-            dt_utc = pytz.utc.normalize(pytz.utc.localize(v))
-
-        return int(dt_utc.timestamp() * 1000)
+        return to_timestamp(v)
 
     @validator("chat", pre=True)
     def get_chat_id(cls, v):
-        return v.id
+        return v if isinstance(v, int) else v.id
 
     class Config:
         orm_mode = True
@@ -40,6 +46,15 @@ class ChatModel(BaseModel):
     jid: str
     name: str
     is_muc: bool
+    last_message_id: t.Optional[int] = None
+    last_utctime: t.Optional[int] = None
+    last_nick: t.Optional[str] = None
+    preview: t.Optional[str] = None
+    message_count: int = 0
+
+    @validator("last_utctime", pre=True)
+    def get_timestamp(cls, v: t.Optional[datetime]):
+        return to_timestamp(v) if v is not None else None
 
     @root_validator()
     def add_type(cls, values):
@@ -1,50 +1,285 @@
+"""
+Redis cache
+
+`async_cache` is the cache API for the event loop: a pooled `redis.asyncio` client with batched and pipelined
+multi-key operations. Values are serialized with typed codecs of serialization.py. When Redis is unreachable it
+backs off exponentially and serves operations from a small in-process cache meanwhile, so callers don't have to
+handle Redis outages. Local entries are dropped once Redis is back, as Redis may have been changed by other
+processes in the meantime.
+
+`cache` is a synchronous client for publishing and listening to invalidation messages from threads.
+"""
 import logging
-import pickle
+import time
 import typing as t
+from collections import OrderedDict
 
 from config import settings
+from serialization import decode, encode, encode_series_append
+from util import stats
 
 logger = logging.getLogger(__name__)
 
 try:
     import redis
+    import redis.asyncio
 except ImportError:
     logger.error("Redis package isn't installed")
     redis = None
 
-if redis and settings.redis.enabled:
-    try:
-        r = redis.Redis(
-            host=settings.redis.host,
-            port=settings.redis.port,
-            db=settings.redis.db,
-        )
-    except redis.ConnectionError as e:
-        logger.error("Couldn't connect to redis: {e}")
-        r = None
+ENABLED = bool(redis) and settings.get("redis.enabled", False)
+
+BACKOFF_MIN = 0.5  # seconds
+BACKOFF_MAX = 30
+
+
+def connection_params() -> t.Dict[str, t.Any]:
+    return {
+        "host": settings.redis.host,
+        "port": settings.redis.port,
+        "db": settings.redis.db,
+        "socket_timeout": settings.get("redis.timeout", 1),
+        "socket_connect_timeout": settings.get("redis.timeout", 1),
+    }
+
+
+r = redis.Redis(**connection_params()) if ENABLED else None
 
 
 class cache:
     available = bool(r)
 
     @staticmethod
-    def set(key: str, value: object) -> None:
-        value = pickle.dumps(value)
-        r.set(key, value)
+    def publish(channel: str, message: str) -> None:
+        r.publish(channel, message)
 
     @staticmethod
-    def get(key: str) -> object:
-        value = r.get(key)
+    def subscribe(channel: str, handler: t.Callable[[dict], None], error_handler: t.Callable = None):
+        """
+        Call `handler` for every message of `channel` on background thread
+        """
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: handler})
+        return pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=error_handler)
+
 
-        if value is None:
+class LocalCache:
+    """
+    Bounded in-process stand-in for Redis, least recently used entries are evicted first
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._data: "OrderedDict[str, t.Tuple[t.Any, t.Optional[float]]]" = OrderedDict()
+
+    def get(self, key: str) -> t.Any:
+        entry = self._data.get(key)
+
+        if entry is None:
             return None
 
-        return pickle.loads(value)
+        value, expires_at = entry
 
-    @staticmethod
-    def scan_keys(match: str) -> t.Generator[str, None, None]:
-        for key in r.scan_iter(match):
-            yield key.decode("ascii")
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: t.Any, ex: t.Optional[float] = None) -> t.List[str]:
+        """
+        Returns keys evicted to make room
+        """
+        self._data[key] = (value, time.monotonic() + ex if ex else None)
+        self._data.move_to_end(key)
+        evicted = []
+
+        while len(self._data) > self.max_size:
+            evicted.append(self._data.popitem(last=False)[0])
+
+        return evicted
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class AsyncCache:
+    def __init__(self, enabled: bool, pool_size: int, local_size: int) -> None:
+        self.available = enabled
+        self.pool_size = pool_size
+        self.local = LocalCache(local_size)
+
+        self._client: t.Optional["redis.asyncio.Redis"] = None
+        self._down = False
+        self._retry_at = 0.0
+        self._backoff = BACKOFF_MIN
+
+        self.failures = 0
+        self.fallbacks = 0
+
+    def _get_client(self) -> "redis.asyncio.Redis":
+        # Created on first use, so the pool belongs to the running event loop
+        if self._client is None:
+            pool = redis.asyncio.ConnectionPool(max_connections=self.pool_size, **connection_params())
+            self._client = redis.asyncio.Redis(connection_pool=pool)
+
+        return self._client
+
+    async def _call(self, operation: t.Callable[["redis.asyncio.Redis"], t.Awaitable], fallback: t.Callable[[], t.Any]):
+        # Local store is the only cache when Redis is disabled
+        if not self.available:
+            return fallback()
+
+        if self._down and time.monotonic() < self._retry_at:
+            self.fallbacks += 1
+            return fallback()
+
+        try:
+            result = await operation(self._get_client())
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.failures += 1
+            self.fallbacks += 1
+            self._retry_at = time.monotonic() + self._backoff
+            logger.warning(f"Redis is unavailable ({e}), using local cache for {self._backoff:.1f}s")
+            self._backoff = min(self._backoff * 2, BACKOFF_MAX)
+            self._down = True
+            return fallback()
+
+        if self._down:
+            logger.info("Redis connection is restored")
+            self._down = False
+            self._backoff = BACKOFF_MIN
+            self.local.clear()
+
+        return result
+
+    async def get(self, key: str) -> t.Any:
+        return decode(await self._call(lambda client: client.get(key), lambda: self.local.get(key)))
+
+    async def set(self, key: str, value: t.Any, ex: t.Optional[int] = None) -> None:
+        value = encode(value)
+        await self._call(lambda client: client.set(key, value, ex=ex), lambda: self.local.set(key, value, ex))
+
+    async def mget(self, keys: t.Sequence[str]) -> t.List[t.Any]:
+        """
+        Values of `keys` in one round-trip, None for missing ones
+        """
+        if not keys:
+            return []
+
+        values = await self._call(lambda client: client.mget(keys), lambda: [self.local.get(key) for key in keys])
+        return [decode(value) for value in values]
+
+    async def mset(self, mapping: t.Mapping[str, t.Any], ex: t.Optional[int] = None) -> None:
+        """
+        Set all keys in one round-trip. With `ex` every key gets expiration, so SETs are pipelined instead of MSET
+        """
+        if not mapping:
+            return
+
+        values = {key: encode(value) for key, value in mapping.items()}
+
+        async def operation(client: "redis.asyncio.Redis") -> None:
+            if ex is None:
+                await client.mset(values)
+                return
+
+            async with client.pipeline(transaction=False) as pipe:
+                for key, value in values.items():
+                    pipe.set(key, value, ex=ex)
+
+                await pipe.execute()
+
+        def fallback() -> None:
+            for key, value in values.items():
+                self.local.set(key, value, ex)
+
+        await self._call(operation, fallback)
+
+    async def delete(self, *keys: str) -> None:
+        if not keys:
+            return
+
+        def fallback() -> None:
+            for key in keys:
+                self.local.delete(key)
+
+        await self._call(lambda client: client.delete(*keys), fallback)
+
+    async def append_series(self, key: str, values: t.Sequence[int], latest_key: str, last: int) -> bool:
+        """
+        Append `values` to IntSeries stored in `key` and set `latest_key` to the last of them, provided `latest_key`
+        still holds `last`. Returns False if another writer changed it first, or if series doesn't exist
+        """
+        data = encode_series_append(values, last)
+        expected, latest = encode(last), encode(values[-1])
+
+        async def operation(client: "redis.asyncio.Redis") -> bool:
+            async with client.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(latest_key, key)
+
+                    if await pipe.get(latest_key) != expected or not await pipe.exists(key):
+                        return False
+
+                    pipe.multi()
+                    pipe.append(key, data)
+                    pipe.set(latest_key, latest)
+                    await pipe.execute()
+                    return True
+                except redis.WatchError:
+                    return False
+
+        def fallback() -> bool:
+            stored = self.local.get(key)
+
+            if self.local.get(latest_key) != expected or stored is None:
+                return False
+
+            self.local.set(key, stored + data)
+            self.local.set(latest_key, latest)
+            return True
+
+        return await self._call(operation, fallback)
+
+    async def incr(self, key: str) -> t.Optional[int]:
+        """
+        Increment shared counter. None while Redis is unavailable, as local counter would diverge from it
+        """
+        return await self._call(lambda client: client.incr(key), lambda: None)
+
+    async def publish(self, channel: str, message: str) -> None:
+        # Without Redis there are no subscribers to notify
+        await self._call(lambda client: client.publish(channel, message), lambda: None)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return {
+            "available": self.available,
+            "down": self._down,
+            "failures": self.failures,
+            "fallbacks": self.fallbacks,
+            "local_size": len(self.local),
+        }
+
+
+async_cache = AsyncCache(
+    enabled=ENABLED,
+    pool_size=settings.get("redis.pool_size", 10),
+    local_size=settings.get("redis.local_size", 10000),
+)
 
+stats.register("redis", async_cache.stats)
 
-__all__ = [cache]
+__all__ = ["cache", "async_cache"]
@@ -0,0 +1,219 @@
+"""
+Gap-free resume of websocket clients after reconnect
+
+Bot numbers new_message events of every chat: message gets `seq`, consecutive within chat, and event gets `epoch`,
+which changes whenever numbering starts over. Counters are kept in Redis, or in process memory without it.
+
+Every web worker keeps latest events of recently active chats in EventRing, filled as events are fanned out and
+preloaded on start from events the bus still has. Reconnected client sends `resume` command with last seen `seq`
+and message id of its chats. Missed messages are taken from the ring if it has all of them, otherwise messages
+newer than the last seen one are fetched from database. Chats which missed more than `webui.resume_fetch_limit`
+messages are to be reloaded by the client.
+"""
+import asyncio
+import logging
+import typing as t
+from collections import OrderedDict, deque
+from uuid import uuid4
+
+import db_read
+from config import settings
+from db_async import async_db
+from event_bus import WS_TOPIC, event_bus
+from redis_cache import async_cache
+
+logger = logging.getLogger(__name__)
+
+EPOCH_KEY = "seq:epoch"
+
+FETCH_LIMIT = settings.get("webui.resume_fetch_limit", 500)
+
+Message = t.Dict[str, t.Any]
+
+
+class Sequencer:
+    """
+    Numbers messages of every chat. Callers hold `lock(chat_id)` until the numbered event is published, so events
+    of chat reach the bus in order of their numbers. Taking it right after the message is stored, before awaiting
+    anything else, numbers messages in order of their ids: waiters get the lock first come, first served
+    """
+
+    def __init__(self) -> None:
+        self._locks: t.Dict[int, asyncio.Lock] = {}
+        # Chats are numbered concurrently, but epoch is started once for all of them
+        self._epoch_lock = asyncio.Lock()
+        self._epoch: t.Optional[str] = None
+        self._counters: t.Dict[int, int] = {}
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        if chat_id not in self._locks:
+            self._locks[chat_id] = asyncio.Lock()
+
+        return self._locks[chat_id]
+
+    async def _shared_epoch(self) -> str:
+        async with self._epoch_lock:
+            if self._epoch is None:
+                epoch = await async_cache.get(EPOCH_KEY)
+
+                if epoch is None:
+                    epoch = uuid4().hex[:8]
+                    await async_cache.set(EPOCH_KEY, epoch)
+
+                self._epoch = epoch
+
+            return self._epoch
+
+    async def _next_shared(self, chat_id: int) -> t.Tuple[str, t.Optional[int]]:
+        epoch = await self._shared_epoch()
+        seq = await async_cache.incr(f"seq:{epoch}:{chat_id}")
+
+        # New counter: either new chat, or Redis lost its data and numbering has to start over in new epoch
+        if seq == 1 and await async_cache.get(EPOCH_KEY) != epoch:
+            # Other chats may have noticed it too and started new epoch already
+            if self._epoch == epoch:
+                logger.info(f"Message numbering epoch {epoch} is gone from Redis, starting new one")
+                self._epoch = None
+
+            return await self._next_shared(chat_id)
+
+        return epoch, seq
+
+    async def next(self, chat_id: int) -> t.Tuple[str, t.Optional[int]]:
+        """
+        Returns (epoch, seq) for next message of chat; seq is None while Redis is unavailable
+        """
+        if async_cache.available:
+            return await self._next_shared(chat_id)
+
+        if self._epoch is None:
+            self._epoch = uuid4().hex[:8]
+
+        seq = self._counters[chat_id] = self._counters.get(chat_id, 0) + 1
+        return self._epoch, seq
+
+
+sequencer = Sequencer()
+
+
+async def publish_message(message: Message) -> None:
+    """
+    Publish new_message event of MessageModel dict for websocket clients. Caller holds `sequencer.lock()` of
+    message chat, see bot.send_message_to_ws_clients()
+    """
+    epoch, seq = await sequencer.next(message["chat"])
+
+    if seq is not None:
+        message = {**message, "seq": seq}
+
+    await event_bus.publish(WS_TOPIC, {"command": "new_message", "message": message, "epoch": epoch})
+
+
+class EventRing:
+    """
+    Latest consecutively numbered messages of recently active chats
+    """
+
+    def __init__(self, messages_per_chat: int, max_chats: int) -> None:
+        self.messages_per_chat = messages_per_chat
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[int, t.Tuple[str, deque[Message]]]" = OrderedDict()  # chat: (epoch, messages)
+
+    def add(self, event: t.Dict[str, t.Any]) -> None:
+        if event.get("command") != "new_message":
+            return
+
+        message, epoch = event["message"], event.get("epoch")
+        chat, seq = message["chat"], message.get("seq")
+        entry = self._chats.get(chat)
+
+        if seq is None:
+            # Numbering is interrupted, missed messages can't be told from the ring
+            self._chats.pop(chat, None)
+            return
+
+        if entry is not None and entry[0] == epoch and seq <= entry[1][-1]["seq"]:
+            return
+
+        if entry is None or entry[0] != epoch or seq != entry[1][-1]["seq"] + 1:
+            entry = self._chats[chat] = (epoch, deque(maxlen=self.messages_per_chat))
+
+        entry[1].append(message)
+        self._chats.move_to_end(chat)
+
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+    def missed(self, chat: int, epoch: t.Optional[str], seq: t.Optional[int]) -> t.Optional[t.List[Message]]:
+        """
+        Messages of chat after `seq`, or None if the ring doesn't have all of them
+        """
+        entry = self._chats.get(chat)
+
+        if entry is None or seq is None or entry[0] != epoch:
+            return None
+
+        messages = entry[1]
+
+        if not messages[0]["seq"] - 1 <= seq <= messages[-1]["seq"]:
+            return None
+
+        return [message for message in messages if message["seq"] > seq]
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+
+ring = EventRing(
+    messages_per_chat=settings.get("webui.resume_messages_per_chat", 200),
+    max_chats=settings.get("webui.resume_chats", 1000),
+)
+
+
+async def preload() -> None:
+    """
+    Fill the ring with events the bus still has, e.g. after restart of this worker
+    """
+    for _, event in await event_bus.replay(WS_TOPIC, "0"):
+        ring.add(event)
+
+    logger.info(f"Resume buffer is preloaded with messages of {len(ring)} chats")
+
+
+def _fetch_after(positions: t.Dict[int, int], limit: int) -> t.Dict[int, t.Optional[t.List[db_read.MessageRecord]]]:
+    return {chat: db_read.get_messages_after(chat, message_id, limit) for chat, message_id in positions.items()}
+
+
+async def resume(
+    epoch: t.Optional[str], positions: t.Dict[int, t.Tuple[t.Optional[int], t.Optional[int]]]
+) -> t.Dict[str, t.Any]:
+    """
+    Messages missed by client whose last seen (seq, message id) of every chat are `positions`, oldest first,
+    and chats client has to reload
+    """
+    messages, to_fetch, resync = [], {}, []
+    from_ring = 0
+
+    for chat, (seq, message_id) in positions.items():
+        missed = ring.missed(chat, epoch, seq)
+
+        if missed is not None:
+            messages += missed
+            from_ring += 1
+        elif message_id is not None:
+            to_fetch[chat] = message_id
+        else:
+            resync.append(chat)
+
+    if to_fetch:
+        # One extra row tells whether client missed too much
+        fetched = await async_db.run(_fetch_after, to_fetch, FETCH_LIMIT + 1)
+
+        for chat, records in fetched.items():
+            if records is None or len(records) > FETCH_LIMIT:
+                resync.append(chat)
+            else:
+                messages += [record.to_dict() for record in records]
+
+    messages.sort(key=lambda message: message["id"])
+    return {"messages": messages, "resync": resync, "from_ring": from_ring}
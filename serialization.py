@@ -0,0 +1,104 @@
+"""
+Typed codecs of cached values
+
+Every value starts with format version and codec bytes. Values of unknown version or codec, like ones pickled by
+older releases, decode to None and are treated as missing, so nothing from shared Redis is ever unpickled.
+
+Codecs:
+  - IntSeries: zigzag varints of deltas between consecutive ints, so series of close timestamps take a byte or two
+    per item. New items can be encoded separately with encode_series_append() and APPENDed to stored value
+  - record: everything else, with msgpack if `msgpack` package is installed, JSON otherwise
+"""
+import json
+import typing as t
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMAT_VERSION = 1
+
+CODEC_INT_SERIES = 1
+CODEC_MSGPACK = 2
+CODEC_JSON = 3
+
+
+class IntSeries(list):
+    """
+    List of ints stored with series codec
+    """
+
+
+def _header(codec: int) -> bytes:
+    return bytes((FORMAT_VERSION, codec))
+
+
+def _pack_deltas(values: t.Iterable[int], last: int) -> bytes:
+    out = bytearray()
+
+    for value in values:
+        delta = value - last
+        last = value
+        zigzag = delta * 2 if delta >= 0 else -delta * 2 - 1
+
+        while zigzag >= 0x80:
+            out.append(zigzag & 0x7F | 0x80)
+            zigzag >>= 7
+
+        out.append(zigzag)
+
+    return bytes(out)
+
+
+def _unpack_deltas(data: bytes) -> IntSeries:
+    values = IntSeries()
+    last = zigzag = shift = 0
+
+    for byte in data:
+        zigzag |= (byte & 0x7F) << shift
+        shift += 7
+
+        if byte & 0x80:
+            continue
+
+        last += zigzag >> 1 if not zigzag & 1 else -((zigzag + 1) >> 1)
+        values.append(last)
+        zigzag = shift = 0
+
+    return values
+
+
+def encode(value: t.Any) -> bytes:
+    if isinstance(value, IntSeries):
+        return _header(CODEC_INT_SERIES) + _pack_deltas(value, 0)
+
+    if msgpack is not None:
+        return _header(CODEC_MSGPACK) + msgpack.packb(value, use_bin_type=True)
+
+    return _header(CODEC_JSON) + json.dumps(value, separators=(",", ":")).encode()
+
+
+def encode_series_append(values: t.Sequence[int], last: int) -> bytes:
+    """
+    Bytes to append to encoded IntSeries whose last item is `last`
+    """
+    return _pack_deltas(values, last)
+
+
+def decode(data: t.Optional[bytes]) -> t.Any:
+    if not data or len(data) < 2 or data[0] != FORMAT_VERSION:
+        return None
+
+    codec, payload = data[1], data[2:]
+
+    if codec == CODEC_INT_SERIES:
+        return _unpack_deltas(payload)
+
+    if codec == CODEC_MSGPACK:
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False) if msgpack is not None else None
+
+    if codec == CODEC_JSON:
+        return json.loads(payload)
+
+    return None
@@ -0,0 +1,32 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# config reads settings.toml from working directory on import, so tests run with example settings, a scratch
+# SQLite database and without Redis
+_workdir = tempfile.mkdtemp(prefix="ugubot-tests-")
+shutil.copy(os.path.join(ROOT, "settings.toml.example"), os.path.join(_workdir, "settings.toml"))
+os.chdir(_workdir)
+# Pony resolves relative SQLite paths against directory of db.py, not working directory
+os.environ["UGUBOT_DATABASE__FILENAME"] = os.path.join(_workdir, "history.db")
+os.environ["UGUBOT_REDIS__ENABLED"] = "false"
+# Not set in example settings, needed to import app
+os.environ["UGUBOT_WEBUI__SIGNING_KEY"] = "tests"
+sys.path.insert(0, ROOT)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def database():
+    import db
+
+    db.db_init()
+    return db
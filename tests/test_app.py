@@ -0,0 +1,27 @@
+import importlib
+
+import pytest
+
+from conftest import ROOT
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # Static files are mounted from webui/ relative to working directory
+    monkeypatch.chdir(ROOT)
+    return importlib.import_module("app")
+
+
+def test_single_worker_may_run_bot_without_redis(app):
+    app.check_workers(1, run_bot=True)
+
+
+def test_several_workers_must_not_run_bot(app):
+    with pytest.raises(RuntimeError, match="run_bot"):
+        app.check_workers(4, run_bot=True)
+
+
+def test_several_workers_need_redis(app):
+    # Tests run with Redis disabled, so the bus is in-process
+    with pytest.raises(RuntimeError, match="redis.enabled"):
+        app.check_workers(4, run_bot=False)
@@ -0,0 +1,54 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytz
+
+NOW = datetime.now().astimezone(pytz.utc)
+
+
+def store(database, utctime):
+    return database.store_batch(
+        [
+            database.PendingMessage(
+                chat_jid="calendar@muc.example",
+                chat_name="calendar",
+                is_muc=True,
+                msg_type=database.MessageType.USER,
+                nick="nick",
+                text="hello",
+                utctime=utctime,
+            )
+        ]
+    )[0]
+
+
+def cached_hours(chat_id):
+    from ws_handler import DatesHandler
+
+    hours_by_chat = asyncio.run(DatesHandler({"client_timezone": "UTC"}).update_cache_if_needed())
+    return sorted(hours_by_chat[chat_id])
+
+
+def index_hours(database, chat_id):
+    with database.db_session:
+        return sorted(database.select(d.hour for d in database.ChatDay if d.chat.id == chat_id))
+
+
+def test_cached_hours_follow_calendar_index(database):
+    chat_id = store(database, NOW - timedelta(days=1)).chat.id
+    assert cached_hours(chat_id) == index_hours(database, chat_id)
+
+    store(database, NOW)
+    assert cached_hours(chat_id) == index_hours(database, chat_id)
+
+    # Backdated message, e.g. delayed MUC history: its hour is older than the latest cached one. Newer than
+    # archive cutoffs of other tests
+    store(database, NOW - timedelta(days=3))
+    assert cached_hours(chat_id) == index_hours(database, chat_id)
+
+    # Oldest hour is pruned
+    with database.db_session:
+        database.ChatDay.select(lambda d: d.chat.id == chat_id).order_by(database.ChatDay.hour).first().delete()
+
+    assert len(cached_hours(chat_id)) == 2
+    assert cached_hours(chat_id) == index_hours(database, chat_id)
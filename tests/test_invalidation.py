@@ -0,0 +1,98 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+# Noon of a day which has ended in any timezone, newer than archive cutoffs of other tests
+DAY = (datetime.now(pytz.utc) - timedelta(days=2)).replace(hour=12, minute=0, second=0, microsecond=0)
+
+
+def notify(name, instance_id="other"):
+    # As the listener receives change published by process `instance_id`
+    import invalidation
+
+    invalidation._on_message({"data": f"{instance_id}:{name}".encode()})
+
+
+def keys(*keys):
+    import invalidation
+
+    return invalidation.KEYS_PREFIX + "\n".join(keys)
+
+
+def test_blocklist_changes_are_seen_at_once(database):
+    assert not database.is_user_blocked("spammer")
+
+    database.add_user_in_blocklist("spammer")
+    assert database.is_user_blocked("spammer")
+
+    assert database.remove_user_from_blocklist("spammer")
+    assert not database.is_user_blocked("spammer")
+
+
+@pytest.mark.parametrize("own", [False, True])
+def test_table_is_reloaded_on_change_of_another_process(database, own):
+    import invalidation
+
+    nick = f"painted-{own}"
+    database.get_nick_colors()
+
+    # Written by another process; own changes are applied in place before publishing
+    with database.db_session:
+        database.NickColor(nick=nick, color="#123456")
+
+    notify("nick_colors", invalidation.INSTANCE_ID if own else "other")
+
+    assert (nick in {c["nick"] for c in database.get_nick_colors()}) is not own
+
+
+def test_keys_changed_by_another_process_are_dropped():
+    from invalidation import tiered_cache
+    from redis_cache import async_cache
+
+    async def main():
+        await tiered_cache.set("test:greeting", "hello")
+        # Written by another process
+        await async_cache.set("test:greeting", "bye")
+        assert await tiered_cache.get("test:greeting") == "hello"
+
+        notify(keys("test:other", "test:greeting"))
+        return await tiered_cache.get("test:greeting")
+
+    assert asyncio.run(main()) == "bye"
+
+
+def get_messages(chat_id, client_timezone):
+    from ws_handler import ChatMessagesHandler
+
+    message = {"chat_id": chat_id, "date": DAY.strftime("%Y/%m/%d"), "client_timezone": client_timezone}
+    return [m["text"] for m in json.loads(str(asyncio.run(ChatMessagesHandler(message).handle(**message))))]
+
+
+def test_delayed_message_drops_cached_days(database):
+    import bot
+
+    def store(text, utctime):
+        pending = database.PendingMessage(
+            chat_jid="delayed@muc.example",
+            chat_name="delayed",
+            is_muc=True,
+            msg_type=database.MessageType.USER,
+            nick="nick",
+            text=text,
+            utctime=utctime,
+        )
+        return database.store_batch([pending])[0]
+
+    chat_id = store("on time", DAY).chat.id
+    timezones = ("UTC", "Asia/Kolkata", "Asia/Tokyo")
+
+    for client_timezone in timezones:
+        assert get_messages(chat_id, client_timezone) == ["on time"]
+
+    asyncio.run(bot.send_message_to_ws_clients(store("delayed", DAY + timedelta(hours=1))))
+
+    for client_timezone in timezones:
+        assert get_messages(chat_id, client_timezone) == ["on time", "delayed"]
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+NOW = datetime.now().astimezone(pytz.utc).replace(microsecond=0)
+
+# Days ago of every message in storage order. Messages of the same time share utctime; the last one is delayed
+# history stored after newer messages
+AGES = [20, 19, 18, 18, 17, 16, 4, 3, 2, 2, 2, 1, 3.5]
+
+
+@pytest.fixture(scope="module")
+def history(database):
+    import archive
+
+    stored = database.store_batch(
+        [
+            database.PendingMessage(
+                chat_jid="pages@muc.example",
+                chat_name="pages",
+                is_muc=True,
+                msg_type=database.MessageType.USER,
+                nick="nick",
+                text=str(age),
+                utctime=NOW - timedelta(days=age),
+            )
+            for age in AGES
+        ]
+    )
+    # Old messages of other tests are newer than cutoff
+    assert archive.archive_batch(NOW - timedelta(days=12)) == 6
+
+    chat_id = stored[0].chat.id
+    chronological = [m.id for m in sorted(stored, key=lambda m: (m.utctime, m.id))]
+    return chat_id, chronological
+
+
+def get_page(chat_id, page_size, before=None, after=None):
+    from ws_handler import MessagesPageHandler
+
+    message = {"chat_id": chat_id, "before": before, "after": after, "page_size": page_size}
+    page = MessagesPageHandler(message).handle(**message)
+    page["ids"] = [m["id"] for m in page["messages"]]
+    return page
+
+
+def test_archived_and_hot_messages_are_paged_together(database, history):
+    chat_id, chronological = history
+
+    with database.db_session:
+        archived = {m.id for m in database.ArchivedMessage.select(lambda m: m.chat == chat_id)}
+
+    assert set(chronological[:6]) == archived
+    assert get_page(chat_id, 4, before=get_page(chat_id, 5)["before"])["ids"] == chronological[4:8]
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 5, 20])
+def test_pages_backwards(history, page_size):
+    chat_id, chronological = history
+    page = get_page(chat_id, page_size)
+    pages = [page["ids"]]
+
+    assert not page["has_newer"]
+
+    while page["has_older"]:
+        page = get_page(chat_id, page_size, before=page["before"])
+        pages.insert(0, page["ids"])
+
+    assert [message_id for ids in pages for message_id in ids] == chronological
+    assert get_page(chat_id, page_size, before=page["before"])["ids"] == []
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 5, 20])
+def test_pages_forwards(history, page_size):
+    chat_id, chronological = history
+    page = get_page(chat_id, page_size)
+
+    while page["has_older"]:
+        page = get_page(chat_id, page_size, before=page["before"])
+
+    pages = [page["ids"]]
+
+    while True:
+        page = get_page(chat_id, page_size, after=page["after"])
+
+        if not page["ids"]:
+            break
+
+        pages.append(page["ids"])
+
+    assert [message_id for ids in pages for message_id in ids] == chronological
@@ -0,0 +1,51 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytz
+
+NOW = datetime.now().astimezone(pytz.utc)
+# Older than messages of other tests, so only these are archived and pruned
+SENT_AT = NOW - timedelta(days=40)
+
+
+def get_messages(chat_id):
+    from ws_handler import ChatMessagesHandler
+
+    message = {"chat_id": chat_id, "date": SENT_AT.strftime("%Y/%m/%d"), "client_timezone": "UTC"}
+    return str(asyncio.run(ChatMessagesHandler(message).handle(**message)))
+
+
+def get_hours(chat_id):
+    from ws_handler import DatesHandler
+
+    return asyncio.run(DatesHandler({"client_timezone": "UTC"}).update_cache_if_needed()).get(chat_id)
+
+
+def test_pruned_messages_are_not_served_from_cache(database, monkeypatch):
+    import archive
+
+    stored = database.store_batch(
+        [
+            database.PendingMessage(
+                chat_jid="pruned@muc.example",
+                chat_name="pruned",
+                is_muc=True,
+                msg_type=database.MessageType.USER,
+                nick="nick",
+                text=text,
+                utctime=utctime,
+            )
+            for text, utctime in (("expired", SENT_AT), ("kept", NOW))
+        ]
+    )
+    chat_id = stored[0].chat.id
+
+    assert "expired" in get_messages(chat_id)
+    assert len(get_hours(chat_id)) == 2
+
+    monkeypatch.setattr(archive, "HOT_DAYS", 30)
+    monkeypatch.setattr(archive, "RETENTION_DAYS", 30)
+    asyncio.run(archive.invalidate_pruned(archive.run_maintenance()))
+
+    assert "expired" not in get_messages(chat_id)
+    assert get_hours(chat_id) == [database.to_utc_hour(NOW)]
@@ -0,0 +1,23 @@
+import pytest
+
+import migrations
+
+
+@pytest.fixture(scope="module")
+def plans(database):
+    return {query.name: (plan, full_scans) for query, plan, full_scans in migrations.explain_hot_queries()}
+
+
+@pytest.mark.parametrize("name", [query.name for query in migrations.HOT_QUERIES])
+def test_hot_query_uses_index(plans, name):
+    plan, full_scans = plans[name]
+
+    assert not full_scans, "\n".join(plan)
+
+
+def test_full_scan_is_reported(database):
+    with database.db_session:
+        cursor = database.db.get_connection().cursor()
+        plan, full_scans = migrations._explain_sqlite(cursor, "SELECT id FROM message WHERE nick = ?", ["alice"])
+
+    assert full_scans == plan
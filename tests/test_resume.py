@@ -0,0 +1,82 @@
+import asyncio
+import random
+from datetime import datetime
+
+import pytz
+
+
+def test_messages_are_numbered_in_storage_order(database, monkeypatch):
+    import bot
+    from event_bus import WS_TOPIC, event_bus
+
+    async def slow_invalidate(chat_id, utctime):
+        await asyncio.sleep(random.random() / 100)
+
+    monkeypatch.setattr(bot.ChatMessagesHandler, "invalidate", slow_invalidate)
+    chat = database.ChatInfo(id=1001, jid="ordered@muc.example", name="ordered", is_muc=True)
+
+    async def handler(stored):
+        # Like bot handlers: await writer, then send to websocket clients
+        await bot.send_message_to_ws_clients(await stored)
+
+    async def main():
+        futures = [asyncio.get_running_loop().create_future() for _ in range(20)]
+        tasks = [asyncio.create_task(handler(future)) for future in futures]
+        await asyncio.sleep(0)
+
+        for i, future in enumerate(futures):
+            message = database.StoredMessage(
+                id=100000 + i,
+                chat=chat,
+                utctime=datetime.now(pytz.utc),
+                msg_type=database.MessageType.USER.value,
+                nick="nick",
+                text="text",
+                outgoing=False,
+            )
+            future.set_result(message)
+
+        await asyncio.gather(*tasks)
+        return await event_bus.replay(WS_TOPIC, "0")
+
+    messages = [event["message"] for _, event in asyncio.run(main()) if event["message"]["chat"] == chat.id]
+
+    assert [m["id"] for m in messages] == list(range(100000, 100020))
+    assert [m["seq"] for m in messages] == list(range(1, 21))
+
+
+def test_slow_chat_does_not_hold_other_chats(database, monkeypatch):
+    import bot
+
+    blocked = database.ChatInfo(id=1002, jid="blocked@muc.example", name="blocked", is_muc=True)
+    free = database.ChatInfo(id=1003, jid="free@muc.example", name="free", is_muc=True)
+
+    def stored(chat, message_id):
+        return database.StoredMessage(
+            id=message_id,
+            chat=chat,
+            utctime=datetime.now(pytz.utc),
+            msg_type=database.MessageType.USER.value,
+            nick="nick",
+            text="text",
+            outgoing=False,
+        )
+
+    async def main():
+        unblock = asyncio.Event()
+
+        async def invalidate(chat_id, utctime):
+            if chat_id == blocked.id:
+                await unblock.wait()
+
+        monkeypatch.setattr(bot.ChatMessagesHandler, "invalidate", invalidate)
+        slow = asyncio.create_task(bot.send_message_to_ws_clients(stored(blocked, 200000)))
+        await asyncio.sleep(0)
+
+        await asyncio.wait_for(bot.send_message_to_ws_clients(stored(free, 200001)), 1)
+        assert not slow.done()
+
+        unblock.set()
+        await slow
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+NOW = datetime.now().astimezone(pytz.utc)
+ARCHIVED_AT = NOW - timedelta(days=10)
+
+
+def pending(database, chat, nick, text, msg_type=None, utctime=NOW):
+    return database.PendingMessage(
+        chat_jid=f"{chat}@search.example",
+        chat_name=chat,
+        is_muc=True,
+        msg_type=msg_type or database.MessageType.USER,
+        nick=nick,
+        text=text,
+        utctime=utctime,
+    )
+
+
+@pytest.fixture(scope="module")
+def found(database):
+    import archive
+
+    stored = database.store_batch(
+        [
+            pending(database, "lake", "alice", "quokka quokka quokka"),
+            pending(database, "lake", "bob", "a quokka was seen near the lake yesterday evening, or so they say"),
+            pending(database, "lake", "bob", "quokka is the new topic", database.MessageType.TOPIC),
+            pending(database, "forest", "alice", "quokka in the forest"),
+            pending(database, "lake", "carol", "old quokka story", utctime=ARCHIVED_AT),
+        ]
+    )
+    # Only the old message is older than cutoff, hot messages of other tests are newer
+    assert archive.archive_batch(NOW - timedelta(days=5)) == 1
+
+    return {message.text: message for message in stored}
+
+
+def search(query, **kwargs):
+    import db_read
+
+    return [(m.text, m.chat) for m in db_read.search_messages(query, **kwargs)]
+
+
+def test_best_match_goes_first(found):
+    assert search("quokka")[0] == ("quokka quokka quokka", found["quokka quokka quokka"].chat.id)
+
+
+def test_filter_by_chat(found):
+    forest = found["quokka in the forest"].chat.id
+
+    assert search("quokka", chat_id=forest) == [("quokka in the forest", forest)]
+
+
+def test_filter_by_nick(found):
+    assert {text for text, _ in search("quokka", nick="alice")} == {"quokka quokka quokka", "quokka in the forest"}
+
+
+def test_filter_by_time(found):
+    assert [text for text, _ in search("quokka", until=NOW - timedelta(days=1))] == ["old quokka story"]
+    assert "old quokka story" not in [text for text, _ in search("quokka", since=NOW - timedelta(days=1))]
+
+
+def test_filter_by_message_type(database, found):
+    assert [text for text, _ in search("quokka", msg_types=[database.MessageType.TOPIC])] == ["quokka is the new topic"]
+
+
+def test_archived_messages_are_found(database, found):
+    message_id = found["old quokka story"].id
+
+    with database.db_session:
+        assert not database.Message.exists(id=message_id)
+        assert database.ArchivedMessage.exists(id=message_id)
+
+    assert ("old quokka story", found["old quokka story"].chat.id) in search("story")
+
+
+def test_pages_cover_all_matches_once(found):
+    everything = search("quokka")
+    pages = [search("quokka", limit=2, offset=offset) for offset in range(0, len(everything), 2)]
+
+    assert len(everything) == 5
+    assert [row for page in pages for row in page] == everything
@@ -0,0 +1,77 @@
+import pickle
+
+import pytest
+
+import serialization
+from serialization import IntSeries, decode, encode, encode_series_append
+
+SERIES = [
+    [],
+    [0],
+    [-1, -2, -300, 5],
+    [1700000000, 1700003600, 1700007200, 1699999999],
+    [2**62, -(2**62), 0, 2**40 + 1],
+]
+
+RECORD = {"chats": {"1": [2024, "Jan", ["01", "02"]]}, "text": "привет", "n": -5, "ok": True, "none": None}
+
+
+@pytest.mark.parametrize("values", SERIES)
+def test_int_series_round_trip(values):
+    decoded = decode(encode(IntSeries(values)))
+
+    assert isinstance(decoded, IntSeries)
+    assert decoded == values
+
+
+def test_int_series_of_close_values_is_compact():
+    hours = IntSeries(range(470000, 470100))
+
+    # Header, first value and a byte per delta
+    assert len(encode(hours)) == 2 + 3 + 99
+
+
+@pytest.mark.parametrize("values", SERIES[1:])
+def test_int_series_append(values):
+    head, tail = values[:1], values[1:]
+
+    assert decode(encode(IntSeries(head)) + encode_series_append(tail, head[-1])) == values
+
+
+def test_msgpack_record_round_trip():
+    pytest.importorskip("msgpack")
+    data = encode(RECORD)
+
+    assert data[1] == serialization.CODEC_MSGPACK
+    assert decode(data) == RECORD
+
+
+def test_json_record_round_trip(monkeypatch):
+    monkeypatch.setattr(serialization, "msgpack", None)
+    data = encode(RECORD)
+
+    assert data[1] == serialization.CODEC_JSON
+    assert decode(data) == RECORD
+
+
+def test_msgpack_record_without_msgpack_is_missing(monkeypatch):
+    pytest.importorskip("msgpack")
+    data = encode(RECORD)
+    monkeypatch.setattr(serialization, "msgpack", None)
+
+    assert decode(data) is None
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        None,
+        b"",
+        b"\x01",
+        bytes((serialization.FORMAT_VERSION + 1,)) + encode(RECORD)[1:],
+        bytes((serialization.FORMAT_VERSION, 99)) + b"{}",
+        pickle.dumps(RECORD),
+    ],
+)
+def test_unknown_values_are_missing(data):
+    assert decode(data) is None
@@ -0,0 +1,132 @@
+from types import SimpleNamespace
+
+import aioxmpp
+import aioxmpp.muc
+
+
+def occupant(nick):
+    return SimpleNamespace(conversation_jid=aioxmpp.JID.fromstr(f"room@muc.example/{nick}"), nick=nick)
+
+
+def test_batch_with_join_and_leave(database):
+    message = aioxmpp.Message(type_=aioxmpp.MessageType.GROUPCHAT)
+    message.body[None] = "  hello  "
+
+    rows = [
+        database.make_muc_user_join(occupant("alice")),
+        database.make_muc_message(message, occupant("alice")),
+        database.make_muc_user_leave(occupant("alice"), aioxmpp.muc.LeaveMode.NORMAL),
+        database.make_muc_user_leave(occupant("bob"), None),
+    ]
+    stored = database.store_batch(rows)
+
+    assert [m.msg_type for m in stored] == [
+        database.MessageType.PART_JOIN.value,
+        database.MessageType.USER.value,
+        database.MessageType.PART_LEAVE.value,
+        database.MessageType.PART_LEAVE.value,
+    ]
+    assert [m.text for m in stored] == ["", "hello", "NORMAL", ""]
+    assert len({m.chat.id for m in stored}) == 1
+    assert stored[0].id < stored[1].id < stored[2].id < stored[3].id
+
+
+def test_store_muc_user_join(database):
+    stored = database.store_muc_user_join(occupant("carol"))
+
+    assert stored.text == ""
+    assert stored.nick == "carol"
+
+
+def test_stored_text_is_broadcast(database, monkeypatch):
+    from compression import unpack_text
+    from models import MessageModel
+
+    monkeypatch.setattr("compression.ENABLED", True)
+    monkeypatch.setattr("compression.MIN_LENGTH", 16)
+    text = " lorem ipsum dolor sit amet " * 20
+    message = aioxmpp.Message(type_=aioxmpp.MessageType.GROUPCHAT)
+    message.body[None] = text
+
+    stored = database.store_batch([database.make_muc_message(message, occupant("dave"))])[0]
+
+    with database.db_session:
+        row = database.Message[stored.id]
+        assert row.text_compressed is not None
+        assert stored.text == unpack_text(row.text, row.text_compressed) == text.strip()
+
+    assert MessageModel.from_orm(stored).text == text.strip()
+
+
+def test_in_flight_handlers_are_stored_before_writer_closes(database):
+    import asyncio
+
+    from db_writer import BatchedWriter
+    from xmpp import Handler, XMPPClient
+
+    writer = BatchedWriter(batch_size=100, flush_interval=0.01)
+    stored = []
+
+    async def on_join(member):
+        await asyncio.sleep(0.05)
+        stored.append(await writer.store(database.make_muc_user_join(member)))
+
+    async def run():
+        client = XMPPClient(jid="bot@example.com", password="", ssl_verify=False)
+        client.register_handler(Handler.MUC_USER_JOIN)(on_join)
+        writer.start()
+        client._call_handlers(Handler.MUC_USER_JOIN, occupant("erin"))
+        client.stop()
+        await client.wait_handlers()
+        await writer.close()
+
+    asyncio.run(run())
+
+    assert [m.nick for m in stored] == ["erin"]
+
+
+def test_usage_rollup_matches_backfill(database):
+    from datetime import timedelta
+
+    import migrations
+
+    def prompt(msg_type, days_ago=0):
+        return database.PendingMessage(
+            chat_jid="usage@muc.example",
+            chat_name="usage",
+            is_muc=True,
+            msg_type=msg_type,
+            nick="frank",
+            text="prompt",
+            utctime=database.utcnow() - timedelta(days=days_ago),
+        )
+
+    def usage(prompt_id, answer_id, total):
+        return database.make_ai_usage(prompt_id, answer_id, "gpt-test", database.AIUsageInfo(10, 20, total))
+
+    types = database.MessageType
+    prompts = database.store_batch(
+        [prompt(types.USER), prompt(types.FOR_AI), prompt(types.USER, days_ago=2), prompt(types.TOPIC)]
+    )
+    # Answers are the prompts themselves, it doesn't matter for rollup
+    database.store_batch([usage(m.id, m.id, 35 + i) for i, m in enumerate(prompts)])
+
+    def rollup():
+        rows = database.select(
+            (r.day, r.chat.id, r.nick, r.model.id, r.prompt_tokens, r.completion_tokens, r.total_tokens)
+            for r in database.AIUsageDaily
+        )
+        return sorted(rows)
+
+    with database.db_session:
+        stored = rollup()
+
+        for statement in migrations.USAGE_ROLLUP_BACKFILL[database.db.provider_name]:
+            database.db.execute(statement)
+
+        assert rollup() == stored
+        database.rollback()
+
+    frank = [row for row in stored if row[2] == "frank"]
+    # Both of today's prompts, without the topic one
+    assert [row[4:] for row in frank] == [(10, 20, 37), (20, 40, 71)]
@@ -0,0 +1,22 @@
+import asyncio
+
+import pytest
+
+
+@pytest.mark.parametrize("argument", ["1000000", "99999999999999999999", "²"])
+def test_usage_report_for_any_number_of_days(database, argument):
+    from ai.middleware.usage_command import UsageCommandMiddleware
+    from ai.types import IncomingMessage, OutgoingMessage
+
+    message = IncomingMessage(
+        database_id=1,
+        chat_id=1,
+        chat_jid="usage@muc.example",
+        is_muc=True,
+        text=f"~usage {argument}",
+        sender_nick="nick",
+        commands=["usage"],
+    )
+    answer = asyncio.run(UsageCommandMiddleware().incoming(message))
+
+    assert isinstance(answer, OutgoingMessage)
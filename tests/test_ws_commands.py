@@ -0,0 +1,37 @@
+import asyncio
+import json
+
+from ws_handler import WebSocketCommandHandler, WebSocketRouter
+
+
+class UnencodableHandler(WebSocketCommandHandler):
+    command = "unencodable"
+
+    async def handle(self) -> object:
+        return object()
+
+
+router = WebSocketRouter(handlers=(UnencodableHandler,))
+
+
+def respond(message):
+    return json.loads(asyncio.run(router.respond(message)))
+
+
+def test_frame_which_is_not_object_gets_error():
+    assert respond(["command", "unencodable"]) == {"command": "", "error": "Command must be a JSON object"}
+
+
+def test_unknown_command_keeps_request_id():
+    assert respond({"command": "nope", "request_id": 7}) == {
+        "command": "nope",
+        "error": "No such command",
+        "request_id": 7,
+    }
+
+
+def test_result_which_fails_to_encode_gets_error():
+    response = respond({"command": "unencodable", "request_id": "abc"})
+
+    assert response["request_id"] == "abc"
+    assert response["error"].startswith("TypeError")
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import ws_protocol
+from ws_handler import RawJSON, encode_response
+
+
+def decode_column(column, length):
+    # Same as decodeColumn() of ugubot-frontend/src/protocol.js
+    if isinstance(column, list):
+        return [decode_columnar(value) for value in column]
+
+    if "$d" in column:
+        values, last = [], 0
+
+        for delta in column["$d"][:length]:
+            last += delta
+            values.append(last)
+
+        return values
+
+    if "$k" in column:
+        return [column["$k"][i] for i in column["$i"]]
+
+    return column
+
+
+def decode_columnar(data):
+    if isinstance(data, list):
+        return [decode_columnar(value) for value in data]
+
+    if not isinstance(data, dict):
+        return data
+
+    if "$cols" in data and "$n" in data:
+        columns = {key: decode_column(column, data["$n"]) for key, column in data["$cols"].items()}
+        return [{key: values[i] for key, values in columns.items()} for i in range(data["$n"])]
+
+    return {key: decode_columnar(value) for key, value in data.items()}
+
+
+MESSAGES = [
+    {
+        "id": 100 + i * 3 - (i == 4) * 50,
+        "chat": 7,
+        "utctime": 1700000000000 + i * 1000,
+        "msg_type": "USER" if i % 3 else "PART_JOIN",
+        "nick": "alice" if i % 2 else "bob",
+        "text": f"message {i}",
+        "outgoing": i == 5,
+    }
+    for i in range(10)
+]
+
+EXAMPLES = [
+    {"command": "new_messages", "messages": MESSAGES, "epoch": "abc"},
+    {"command": "get_chat_list", "result": [{"id": 1, "name": "a", "last": None}, {"id": 2, "name": "b", "last": 5}]},
+    {"command": "resume", "result": {"messages": MESSAGES[:1], "resync": [1, 2, 3]}},
+    {"command": "flags", "result": [{"on": True}, {"on": 1}, {"on": True}, {"on": 1}, {"on": False}]},
+    {"command": "ragged", "result": [{"a": 1}, {"b": 2}, {"a": [{"x": 1}, {"x": 2}]}]},
+]
+
+
+@pytest.mark.parametrize("data", EXAMPLES)
+def test_columnar_decodes_to_plain_json(data):
+    plain = json.loads(ws_protocol.encode(data, ws_protocol.JSON))
+    columnar = json.loads(ws_protocol.encode(data, ws_protocol.COLUMNAR))
+
+    assert plain == data
+    # As text, since True == 1 in Python, but not in JSON
+    assert json.dumps(decode_columnar(columnar)) == json.dumps(plain)
+
+
+@pytest.mark.parametrize("protocol", [None, ws_protocol.JSON, ws_protocol.COLUMNAR])
+def test_raw_json_response_decodes_to_plain_json(protocol):
+    # Like cached get_messages result: encoded with protocol of the connection beforehand
+    data = {"command": "get_messages", "chat_id": 7, "result": RawJSON(ws_protocol.encode(MESSAGES, protocol))}
+    decoded = json.loads(encode_response(data, protocol))
+
+    if protocol == ws_protocol.COLUMNAR:
+        decoded = decode_columnar(decoded)
+
+    assert json.dumps(decoded) == json.dumps({"command": "get_messages", "chat_id": 7, "result": MESSAGES})
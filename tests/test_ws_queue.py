@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from ws_queue import RESYNC_COMMAND, ClientQueue, EncodedEvent, encode_events
+
+
+def event(n, chat=1):
+    return EncodedEvent({"command": "new_message", "message": {"id": n, "chat": chat}}, [chat], [str(n)])
+
+
+def bus_events(ids):
+    return [(str(n), {"command": "new_message", "message": {"id": n, "chat": 1}}) for n in ids]
+
+
+def drain(queue):
+    items = []
+
+    while len(queue):
+        items.append(asyncio.run(queue.get()))
+
+    return items
+
+
+def test_drop_oldest_recovers_after_drain():
+    queue = ClientQueue(3, "drop_oldest")
+
+    for n in range(10):
+        queue.put_event(event(n))
+
+    assert [item.event["message"]["id"] for item in drain(queue)] == [7, 8, 9]
+    assert queue.dropped == 7
+
+    for n in range(10, 13):
+        queue.put_event(event(n))
+
+    assert [item.event["message"]["id"] for item in drain(queue)] == [10, 11, 12]
+    assert queue.dropped == 7
+
+
+def test_drop_oldest_keeps_responses():
+    queue = ClientQueue(1, "drop_oldest")
+    queue.put_event(event(1))
+    queue.put_response({"result": "ok"})
+    queue.put_event(event(2))
+
+    items = drain(queue)
+    assert items[0] == {"result": "ok"}
+    assert items[1].event["message"]["id"] == 2
+
+
+def test_resync_recovers_after_drain():
+    queue = ClientQueue(2, "resync")
+
+    for n in range(5):
+        queue.put_event(event(n, chat=n % 2))
+
+    assert drain(queue) == [{"command": RESYNC_COMMAND, "chats": [0, 1]}]
+
+    queue.put_event(event(5))
+    queue.put_event(event(6))
+    assert [item.event["message"]["id"] for item in drain(queue)] == [5, 6]
+
+
+def test_disconnect():
+    queue = ClientQueue(1, "disconnect")
+    queue.put_event(event(1))
+    queue.put_event(event(2))
+
+    assert queue.disconnected
+    assert asyncio.run(queue.get()) is None
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        ClientQueue(1, "block")
+
+
+def test_missed_events_go_first_once():
+    queue = ClientQueue(10, "resync")
+    queue.put_response({"result": "ok"})
+    # Fanned out while missed events were read, the first two of them packed into one frame
+    for frame in encode_events(bus_events([4, 5]), pack=True) + encode_events(bus_events([6])):
+        queue.put_event(frame)
+
+    queue.put_missed(encode_events(bus_events([2, 3, 4, 5])))
+
+    items = drain(queue)
+    assert items[0] == {"result": "ok"}
+    assert [[m["id"] for m in item.event.get("messages", [item.event.get("message")])] for item in items[1:]] == [
+        [2],
+        [3],
+        [4, 5],
+        [6],
+    ]
+
+
+def test_missed_events_overflow():
+    queue = ClientQueue(2, "resync")
+    queue.put_event(event(3))
+
+    queue.put_missed(encode_events(bus_events([1, 2])))
+
+    assert drain(queue) == [{"command": RESYNC_COMMAND, "chats": [1]}]
@@ -0,0 +1,55 @@
+// Websocket wire formats, see ws_protocol.py
+export const PROTOCOLS = ["ugubot.columnar", "ugubot.json"]
+
+function decodeColumn(column, length) {
+    if (Array.isArray(column)) {
+        return column.some(value => value !== null && typeof value === "object") ? column.map(decodeColumnar) : column
+    }
+
+    if ("$d" in column) {
+        const values = new Array(length)
+        let last = 0
+        for (let i = 0; i < length; i++) {
+            last += column.$d[i]
+            values[i] = last
+        }
+        return values
+    }
+
+    if ("$k" in column) {
+        return column.$i.map(i => column.$k[i])
+    }
+
+    return column
+}
+
+function decodeColumnar(data) {
+    if (Array.isArray(data)) return data.map(decodeColumnar)
+    if (data === null || typeof data !== "object") return data
+
+    if ("$cols" in data && "$n" in data) {
+        const keys = Object.keys(data.$cols)
+        const columns = keys.map(key => decodeColumn(data.$cols[key], data.$n))
+        const records = new Array(data.$n)
+
+        for (let i = 0; i < data.$n; i++) {
+            const record = {}
+            for (let k = 0; k < keys.length; k++) {
+                record[keys[k]] = columns[k][i]
+            }
+            records[i] = record
+        }
+        return records
+    }
+
+    const result = {}
+    for (const key in data) {
+        result[key] = decodeColumnar(data[key])
+    }
+    return result
+}
+
+export function decodeMessage(text, protocol) {
+    const data = JSON.parse(text)
+    return protocol === "ugubot.columnar" ? decodeColumnar(data) : data
+}
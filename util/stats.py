@@ -0,0 +1,66 @@
+import bisect
+import threading
+import typing as t
+
+# Upper bounds of latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_providers: t.Dict[str, t.Callable[[], t.Any]] = {}
+
+
+class LatencyStats:
+    """
+    Thread-safe per-name latency counters with histogram
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats: t.Dict[str, t.Dict[str, t.Any]] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        ms = seconds * 1000
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, ms)
+
+        with self._lock:
+            stat = self._stats.get(name)
+
+            if stat is None:
+                stat = self._stats[name] = {
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                }
+
+            stat["count"] += 1
+            stat["total_ms"] += ms
+            stat["max_ms"] = max(stat["max_ms"], ms)
+            stat["histogram"][bucket] += 1
+
+    def snapshot(self) -> t.Dict[str, t.Dict[str, t.Any]]:
+        """
+        Returns stats sorted by total time spent, slowest first
+        """
+        with self._lock:
+            items = [(name, dict(stat, histogram=list(stat["histogram"]))) for name, stat in self._stats.items()]
+
+        items.sort(key=lambda item: item[1]["total_ms"], reverse=True)
+        result = {}
+
+        for name, stat in items:
+            stat["avg_ms"] = stat["total_ms"] / stat["count"]
+            stat["histogram"] = dict(zip((*map(str, LATENCY_BUCKETS_MS), "inf"), stat["histogram"]))
+            result[name] = stat
+
+        return result
+
+
+def register(name: str, provider: t.Callable[[], t.Any]) -> None:
+    """
+    Register callable which returns stats for `name` section of snapshot()
+    """
+    _providers[name] = provider
+
+
+def snapshot() -> t.Dict[str, t.Any]:
+    return {name: provider() for name, provider in _providers.items()}
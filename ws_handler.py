@@ -1,18 +1,44 @@
-import asyncio
+import inspect
 import logging
+import time
 import typing as t
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from datetime import datetime, timedelta
 
 import pytz
 from pydantic import BaseModel
 
-from db import Chat, Message, NickColor, db_session, select
-from models import ChatModel, MessageModel
-from redis_cache import cache
+import archive
+import db_read
+import resume
+import ws_protocol
+from config import settings
+from db import MessageType, get_nick_colors, nick_colors, set_nick_color
+from db_async import async_db
+from event_bus import OUTGOING_TOPIC, event_bus
+from invalidation import tiered_cache
+from models import ChatModel, to_timestamp
+from redis_cache import async_cache
+from serialization import IntSeries
+from util import stats
 
 logger = logging.getLogger(__name__)
-outgoing_queue = asyncio.Queue()
+
+
+class RawJSON(str):
+    """
+    Handler result which is already encoded with protocol of the connection
+    """
+
+
+def encode_response(data: dict, protocol: t.Optional[str] = None) -> str:
+    result = data.get("result")
+
+    if not isinstance(result, RawJSON):
+        return ws_protocol.encode(data, protocol)
+
+    rest = ws_protocol.encode({key: value for key, value in data.items() if key != "result"}, protocol)
+    return f'{rest[:-1]}{"," if len(rest) > 2 else ""}"result":{result}}}'
 
 
 @dataclass
@@ -24,18 +50,33 @@ class OutgoingMessage:
 
 
 class WebSocketCommandHandler:
+    """
+    Base websocket command handler.
+    `handle` may be either coroutine or regular function; regular functions do blocking database work
+    and are run on database executor
+    """
+
     command: str = ""
 
     class Schema(BaseModel):
         pass
 
-    def __init__(self, message):
+    def __init__(self, message, protocol: t.Optional[str] = None):
         self.message = message
+        # Wire format of the connection, for handlers which return RawJSON
+        self.protocol = protocol
+
+    async def execute(self):
+        data = {}
 
-    def execute(self):
         try:
             data = self.Schema.parse_obj(self.message).dict()
-            data["result"] = self.handle(**data)
+
+            if inspect.iscoroutinefunction(self.handle):
+                data["result"] = await self.handle(**data)
+            else:
+                data["result"] = await async_db.run(self.handle, **data)
+
             data["command"] = self.command
             return data
         except Exception as e:
@@ -49,131 +90,322 @@ class WebSocketCommandHandler:
 
 
 class ChatListHandler(WebSocketCommandHandler):
+    """
+    Chats, most recently active first. Without `page_size` all matching chats are returned
+    """
+
     command = "get_chat_list"
+    max_page_size = 500
 
-    def handle(self) -> dict:
-        with db_session:
-            return [ChatModel.from_orm(c).dict() for c in Chat.select()]
+    class Schema(BaseModel):
+        query: t.Optional[str] = None  # substring of name or JID
+        type: t.Optional[str] = None  # "muc" or "user"
+        page: int = 0
+        page_size: t.Optional[int] = None
+
+    def handle(self, query: t.Optional[str], type: t.Optional[str], page: int, page_size: t.Optional[int]) -> dict:
+        limit = min(max(page_size, 1), self.max_page_size) if page_size is not None else None
+        chats = db_read.get_chat_list(
+            query=query.strip() if query else None,
+            is_muc={"muc": True, "user": False}.get(type),
+            limit=limit,
+            offset=max(page, 0) * limit if limit else 0,
+        )
+        return [ChatModel(**c).dict() for c in chats]
 
 
 class ChatMessagesHandler(WebSocketCommandHandler):
+    """
+    Messages of a day in client timezone. Days which have ended don't change, so their encoded responses are
+    cached by chat and UTC start of day, locally and in Redis. Clients with the same UTC offset share them
+    """
+
     command = "get_messages"
+    cache_enabled = settings.get("cache.day_pages", True)
+    cache_ttl = settings.get("cache.day_page_ttl", 7 * 24 * 3600)
+    cache_max_bytes = settings.get("cache.day_page_max_bytes", 1024 * 1024)
+    # Timezone offsets are multiples of 15 minutes, days starting off this grid aren't cached
+    cache_grid_ms = 15 * 60 * 1000
 
     class Schema(BaseModel):
         chat_id: int
         date: str  # YYYY/MM/DD
         client_timezone: str
 
-    def handle(self, chat_id: int, date: str, client_timezone: str) -> dict:
+    @staticmethod
+    def cache_key(chat_id: int, start_ms: int, protocol: t.Optional[str]) -> str:
+        # Plain JSON keeps key of the times before protocols
+        return f"day:{chat_id}:{start_ms}" + (f":{protocol}" if protocol not in (None, ws_protocol.JSON) else "")
+
+    @classmethod
+    async def invalidate(cls, chat_id: int, utctime: datetime) -> None:
+        """
+        Drop cached days containing message time. Only ended days are cached, so new messages drop nothing
+        unless they are dated back, e.g. delayed ones
+        """
+        if not cls.cache_enabled:
+            return
+
+        message_ms = to_timestamp(utctime)
+        await cls._delete_days(chat_id, cls._day_starts(message_ms, message_ms))
+
+    @classmethod
+    async def invalidate_hours(cls, chat_id: int, hours: t.Iterable[int]) -> None:
+        """
+        Drop cached days overlapping any of UTC hours, e.g. hours pruned from calendar index
+        """
+        if not cls.cache_enabled:
+            return
+
+        hour_ms = 3600 * 1000
+        starts = set()
+
+        for hour in hours:
+            starts.update(cls._day_starts(hour * hour_ms, (hour + 1) * hour_ms - 1))
+
+        await cls._delete_days(chat_id, sorted(starts))
+
+    @classmethod
+    def _day_starts(cls, first_ms: int, last_ms: int) -> range:
+        day_ms = 24 * 3600 * 1000
+        # Ended days overlapping [first, last] start within (first - day, min(last, now - day)]
+        last_start = min(last_ms, to_timestamp(datetime.now(pytz.utc)) - day_ms)
+        start = first_ms - day_ms + cls.cache_grid_ms - first_ms % cls.cache_grid_ms
+        return range(start, last_start + 1, cls.cache_grid_ms)
+
+    @classmethod
+    async def _delete_days(cls, chat_id: int, starts: t.Iterable[int]) -> None:
+        keys = [cls.cache_key(chat_id, start_ms, protocol) for start_ms in starts for protocol in ws_protocol.PROTOCOLS]
+        await tiered_cache.delete(*keys)
+
+    @staticmethod
+    def load(chat_id: int, start_date: datetime, stop_date: datetime, protocol: t.Optional[str]) -> str:
+        messages = db_read.get_messages(chat_id, start_date, stop_date, with_archive=start_date < archive.hot_cutoff())
+        return ws_protocol.encode([m.to_dict() for m in messages], protocol)
+
+    async def handle(self, chat_id: int, date: str, client_timezone: str) -> RawJSON:
         tz = pytz.timezone(client_timezone)
         start_date = tz.normalize(tz.localize(datetime.strptime(date, "%Y/%m/%d")))
         start_date = start_date.astimezone(pytz.utc)
         stop_date = start_date + timedelta(days=1)
 
-        with db_session:
-            query = select(
-                m for m in Message if m.utctime >= start_date and m.utctime < stop_date and m.chat.id == chat_id
-            )
-            return [MessageModel.from_orm(m).dict() for m in query]
+        start_ms = to_timestamp(start_date)
+        key = self.cache_key(chat_id, start_ms, self.protocol)
+        cacheable = self.cache_enabled and stop_date <= datetime.now(pytz.utc) and start_ms % self.cache_grid_ms == 0
+
+        if cacheable:
+            cached = await tiered_cache.get(key)
+
+            if cached is not None:
+                return RawJSON(cached)
+
+        result = await async_db.run(self.load, chat_id, start_date, stop_date, self.protocol)
+
+        if cacheable and len(result) <= self.cache_max_bytes:
+            await tiered_cache.set(key, result, ex=self.cache_ttl)
+
+        return RawJSON(result)
+
+
+class MessagesPageHandler(WebSocketCommandHandler):
+    """
+    Scrollable chat history: pass `before` cursor of a page to get older messages, `after` to get newer ones
+    """
+
+    command = "get_messages_page"
+    default_page_size = settings.get("webui.page_size", 100)
+    max_page_size = settings.get("webui.max_page_size", 500)
+
+    class Schema(BaseModel):
+        chat_id: int
+        before: t.Optional[str] = None
+        after: t.Optional[str] = None
+        page_size: t.Optional[int] = None
+
+    def handle(self, chat_id: int, before: t.Optional[str], after: t.Optional[str], page_size: t.Optional[int]) -> dict:
+        page_size = min(max(page_size or self.default_page_size, 1), self.max_page_size)
+        page = db_read.get_messages_page(chat_id, page_size, before=before, after=after)
+        page["messages"] = [m.to_dict() for m in page["messages"]]
+        return page
+
+
+class SearchMessagesHandler(WebSocketCommandHandler):
+    command = "search_messages"
+    max_page_size = 200
+
+    class Schema(BaseModel):
+        query: str
+        chat_id: t.Optional[int] = None
+        nick: t.Optional[str] = None
+        since: t.Optional[int] = None  # UTC timestamp in ms, inclusive
+        until: t.Optional[int] = None  # UTC timestamp in ms, exclusive
+        msg_types: t.Optional[t.List[str]] = None  # MessageType names
+        page: int = 0
+        page_size: int = 50
+
+    def handle(
+        self,
+        query: str,
+        chat_id: t.Optional[int],
+        nick: t.Optional[str],
+        since: t.Optional[int],
+        until: t.Optional[int],
+        msg_types: t.Optional[t.List[str]],
+        page: int,
+        page_size: int,
+    ) -> dict:
+        if not query.strip():
+            return {"messages": [], "has_more": False}
+
+        page_size = min(max(page_size, 1), self.max_page_size)
+
+        # One extra row tells whether there is a next page
+        found = db_read.search_messages(
+            query,
+            chat_id=chat_id,
+            nick=nick,
+            since=datetime.fromtimestamp(since / 1000, pytz.utc) if since is not None else None,
+            until=datetime.fromtimestamp(until / 1000, pytz.utc) if until is not None else None,
+            msg_types=[MessageType[name] for name in msg_types] if msg_types else None,
+            limit=page_size + 1,
+            offset=max(page, 0) * page_size,
+        )
+
+        return {
+            "messages": [m.to_dict() for m in found[:page_size]],
+            "has_more": len(found) > page_size,
+        }
 
 
 class DatesHandler(WebSocketCommandHandler):
+    """
+    Calendar of days with messages for every chat, built from hour buckets of ChatDay index
+    """
+
     command = "get_dates"
 
     class Schema(BaseModel):
         client_timezone: str
 
-    def handle(self, client_timezone: str) -> dict:
+    async def handle(self, client_timezone: str) -> dict:
         tz = pytz.timezone(client_timezone)
 
-        if not cache.available:
-            return self.get_all_dates_from_db(tz)
+        if not async_cache.available:
+            return await async_db.run(self.get_all_dates_from_db, tz)
 
-        return self.get_all_dates_from_cache(tz)
+        return await self.get_all_dates_from_cache(tz)
 
-    @db_session
-    def get_all_dates_from_db(self, timezone: pytz.BaseTzInfo) -> dict:
-        result = {}
-        all_dates = select((m.chat.id, m.utctime) for m in Message)
+    @staticmethod
+    def add_hour(result: dict, chat_id: int, hour: int, timezone: pytz.BaseTzInfo) -> None:
+        start = datetime.fromtimestamp(hour * 3600, pytz.utc)
 
-        for chat_id, date in all_dates:
-            dt_utc = pytz.utc.normalize(pytz.utc.localize(date))
+        # For timezones with non-whole-hour offset one UTC hour spans two local days
+        for dt_utc in (start, start + timedelta(seconds=3599)):
             dt_loc = dt_utc.astimezone(timezone)
 
             year, month, day = dt_loc.strftime("%Y,%b,%d").split(",")
-
-            days = result.setdefault(int(chat_id), {}).setdefault(year, {}).setdefault(month, [])
+            days = result.setdefault(chat_id, {}).setdefault(year, {}).setdefault(month, [])
 
             if day not in days:
                 days.append(day)
 
-        return result
-
-    def get_all_dates_from_cache(self, timezone: pytz.BaseTzInfo) -> dict:
+    def get_all_dates_from_db(self, timezone: pytz.BaseTzInfo) -> dict:
         result = {}
 
-        self.update_cache_if_needed()
+        for chat_id, hour in db_read.get_calendar_hours():
+            self.add_hour(result, chat_id, hour, timezone)
 
-        for key in cache.scan_keys("chat_dates:*"):
-            if key.endswith("_latest"):
-                continue
+        return result
 
-            chat_id = int(key.split(":")[-1])
-            chat_dates = map(datetime.fromtimestamp, cache.get(key))
+    async def get_all_dates_from_cache(self, timezone: pytz.BaseTzInfo) -> dict:
+        result = {}
+        hours_by_chat = await self.update_cache_if_needed()
 
-            for date in chat_dates:
-                dt_utc = pytz.utc.normalize(pytz.utc.localize(date))
-                dt_loc = dt_utc.astimezone(timezone)
+        for chat_id, hours in hours_by_chat.items():
+            for hour in hours:
+                self.add_hour(result, chat_id, hour, timezone)
 
-                year, month, day = dt_loc.strftime("%Y,%b,%d").split(",")
-                days = result.setdefault(chat_id, {}).setdefault(year, {}).setdefault(month, [])
+        return result
 
-                if day not in days:
-                    days.append(day)
+    async def update_cache_if_needed(self) -> t.Dict[int, t.List[int]]:
+        """
+        Returns hours of every chat, bringing cached ones up to date with ChatDay index.
+        Cache is read with one batched call; new hours are appended to cached series, missing series are written
+        with one batched call. Series which don't add up to the number of hours in the index, e.g. after backdated
+        messages were stored or old hours were pruned, are read anew
+        """
+        latest = await async_db.run(db_read.get_latest_calendar_hours)
+        chat_ids = [chat_id for chat_id, _, _ in latest]
+        counts = {chat_id: count for chat_id, _, count in latest}
+
+        cached = await tiered_cache.mget(
+            [f"chat_hours:{chat_id}_latest" for chat_id in chat_ids] + [f"chat_hours:{chat_id}" for chat_id in chat_ids]
+        )
+        cached_latest, cached_hours = cached[: len(chat_ids)], cached[len(chat_ids) :]
+
+        hours_by_chat, stale = {}, {}
+
+        for (chat_id, db_last_hour, db_count), cache_last_hour, hours in zip(latest, cached_latest, cached_hours):
+            if cache_last_hour is None or hours is None or cache_last_hour > db_last_hour or len(hours) > db_count:
+                hours_by_chat[chat_id], stale[chat_id] = [], None
+            else:
+                hours_by_chat[chat_id] = hours
 
-        return result
+                if cache_last_hour != db_last_hour or len(hours) != db_count:
+                    stale[chat_id] = cache_last_hour
 
-    @db_session
-    def update_cache_if_needed(self) -> None:
-        dates_db = select((c.id, max(m.utctime)) for c in Chat for m in Message if m.chat.id == c.id)
+        if not stale:
+            return hours_by_chat
 
-        for chat_id, db_last_date in dates_db:
-            cache_last_date = cache.get(f"chat_dates:{chat_id}_latest")
+        logger.info(f"Update dates cache for {len(stale)} chats")
+        new_hours = await async_db.run(self.get_new_hours, stale)
+        rebuild = {
+            chat_id: None
+            for chat_id, hours in new_hours.items()
+            if stale[chat_id] is not None and len(hours_by_chat[chat_id]) + len(hours) != counts[chat_id]
+        }
 
-            if not cache_last_date:
-                self.update_dates_cache_for_chat(chat_id)
-            elif cache_last_date != db_last_date:
-                self.update_dates_cache_for_chat(chat_id, since=cache_last_date)
+        if rebuild:
+            new_hours.update(await async_db.run(self.get_new_hours, rebuild))
+            stale.update(rebuild)
+            hours_by_chat.update((chat_id, []) for chat_id in rebuild)
 
-    @db_session
-    def update_dates_cache_for_chat(self, chat_id: int, since: t.Optional[datetime] = None) -> None:
-        logger.info(f"Update dates cache for chat #{chat_id} since <{since}>")
+        updates = {}
 
-        dates_in_cache: list = cache.get(f"chat_dates:{chat_id}") or []
+        for chat_id, hours in new_hours.items():
+            if not hours:
+                continue
 
-        if since:
-            db_chat_dates = select(m.utctime for m in Chat[chat_id].messages if m.utctime > since)
-        else:
-            db_chat_dates = select(m.utctime for m in Chat[chat_id].messages)
+            since = stale[chat_id]
+            hours_by_chat[chat_id] = hours_by_chat[chat_id] + hours
 
-        for date in db_chat_dates:
-            dates_in_cache.append(int(date.timestamp()))
-        else:
-            cache.set(f"chat_dates:{chat_id}", dates_in_cache)
-            logger.info(f"  -> done without updates")
-            return
+            if since is None:
+                updates[f"chat_hours:{chat_id}"] = IntSeries(hours)
+                updates[f"chat_hours:{chat_id}_latest"] = hours[-1]
+            else:
+                # Skipped if another process has just updated it, next call catches up
+                await tiered_cache.append_series(f"chat_hours:{chat_id}", hours, f"chat_hours:{chat_id}_latest", since)
 
-        cache.set(f"chat_dates:{chat_id}", dates_in_cache)
-        cache.set(f"chat_dates:{chat_id}_latest", date)
-        logger.info(f"  -> done")
+        await tiered_cache.mset(updates)
+        logger.info(f"  -> done, {sum(map(len, new_hours.values()))} new hours")
+        return hours_by_chat
+
+    @staticmethod
+    def get_new_hours(since_by_chat: t.Dict[int, t.Optional[int]]) -> t.Dict[int, t.List[int]]:
+        return {
+            chat_id: [hour for _, hour in db_read.get_calendar_hours(chat_id, since_hour=since)]
+            for chat_id, since in since_by_chat.items()
+        }
 
 
 class GetNickColorsHandler(WebSocketCommandHandler):
     command = "get_nick_colors"
 
-    def handle(self):
-        with db_session:
-            return [nc.to_dict() for nc in NickColor.select()]
+    async def handle(self):
+        if nick_colors.loaded:
+            return get_nick_colors()
+
+        return await async_db.get_nick_colors()
 
 
 class SetNickColorHandler(WebSocketCommandHandler):
@@ -184,15 +416,29 @@ class SetNickColorHandler(WebSocketCommandHandler):
         color: str
 
     def handle(self, nick: str, color: str):
-        with db_session:
-            nc = NickColor.select(lambda n: n.nick == nick)
+        set_nick_color(nick, color)
+        return "OK"
 
-            if nc.exists():
-                nc.first().color = color
-            else:
-                NickColor(nick=nick, color=color)
 
-        return "OK"
+class ResumePosition(BaseModel):
+    seq: t.Optional[int] = None
+    id: t.Optional[int] = None
+
+
+class ResumeHandler(WebSocketCommandHandler):
+    """
+    Messages missed while client was disconnected, see resume.py. `positions` are last seen `seq` and message
+    `id` by chat; client sends it right after reconnect and holds new_message events until the result comes
+    """
+
+    command = "resume"
+
+    class Schema(BaseModel):
+        epoch: t.Optional[str] = None
+        positions: t.Dict[int, ResumePosition] = {}
+
+    async def handle(self, epoch: t.Optional[str], positions: t.Dict[int, dict]) -> dict:
+        return await resume.resume(epoch, {chat: (p["seq"], p["id"]) for chat, p in positions.items()})
 
 
 class SendMessageHandler(WebSocketCommandHandler):
@@ -202,9 +448,8 @@ class SendMessageHandler(WebSocketCommandHandler):
         chat_id: int
         text: str
 
-    def handle(self, chat_id, text: str) -> dict:
-        with db_session:
-            chat = Chat[chat_id]
+    async def handle(self, chat_id, text: str) -> dict:
+        chat = await async_db.get_chat(chat_id)
 
         for_ai = text.startswith("!!")
 
@@ -213,31 +458,102 @@ class SendMessageHandler(WebSocketCommandHandler):
 
         msg = OutgoingMessage(jid=chat.jid, is_muc=chat.is_muc, text=text, for_ai=for_ai)
         # msg = create_message(chat.jid, text, chat.is_muc)
-        outgoing_queue.put_nowait(msg)
+        # Bot may run in another process
+        if await event_bus.publish(OUTGOING_TOPIC, asdict(msg)) is None:
+            raise RuntimeError("Message couldn't be queued for sending")
+
         return "OK"
 
 
+class UsageHandler(WebSocketCommandHandler):
+    command = "get_usage"
+
+    class Schema(BaseModel):
+        days: t.Optional[int] = 30  # None for all time
+        chat_id: t.Optional[int] = None
+
+    def handle(self, days: t.Optional[int], chat_id: t.Optional[int]) -> list:
+        return [
+            {
+                "chat": chat_name,
+                "nick": nick,
+                "model": model,
+                "completion_tokens": completion_tokens,
+                "prompt_tokens": prompt_tokens,
+                "total_tokens": total_tokens,
+            }
+            for chat_name, nick, model, completion_tokens, prompt_tokens, total_tokens in db_read.get_usage_for_last_n_days(
+                days, chat_id
+            )
+        ]
+
+
+class StatsHandler(WebSocketCommandHandler):
+    command = "get_stats"
+
+    async def handle(self) -> dict:
+        return stats.snapshot()
+
+
 class WebSocketRouter:
     def __init__(self, handlers: t.Tuple[WebSocketCommandHandler]) -> None:
         self.handlers = {handler.command: handler for handler in handlers}
+        self.latency = stats.LatencyStats()
+
+    async def execute(self, message, protocol: t.Optional[str] = None) -> dict:
+        """
+        Result of command, with `request_id` of the message if client set it. `protocol` is the wire format
+        result is going to be encoded with
+        """
+        if not isinstance(message, dict):
+            return {"command": "", "error": "Command must be a JSON object"}
 
-    def execute(self, message) -> dict:
         command = message.get("command", "")
         handler = self.handlers.get(command, None)
 
         if not handler:
-            return {"command": command, "error": "No such command"}
+            result = {"command": command, "error": "No such command"}
+        else:
+            started = time.perf_counter()
+            result = await handler(message, protocol).execute()
+            self.latency.record(command, time.perf_counter() - started)
 
-        return handler(message).execute()
+        if "request_id" in message:
+            result["request_id"] = message["request_id"]
+
+        return result
+
+    async def respond(self, message, protocol: t.Optional[str] = None) -> str:
+        """
+        Encoded result of command. Never fails, so client waiting for `request_id` always gets a reply
+        """
+        try:
+            return encode_response(await self.execute(message, protocol), protocol)
+        except Exception as e:
+            logger.exception("Command failed")
+            message = message if isinstance(message, dict) else {}
+            result = {"command": message.get("command", ""), "error": f"{e.__class__.__name__}: {e}"}
+
+            if "request_id" in message:
+                result["request_id"] = message["request_id"]
+
+            return ws_protocol.encode(result, protocol)
 
 
 command_router = WebSocketRouter(
     handlers=(
         ChatListHandler,
         ChatMessagesHandler,
+        MessagesPageHandler,
+        SearchMessagesHandler,
         DatesHandler,
+        ResumeHandler,
         SendMessageHandler,
         GetNickColorsHandler,
         SetNickColorHandler,
+        UsageHandler,
+        StatsHandler,
     )
 )
+
+stats.register("ws_commands", command_router.latency.snapshot)
@@ -0,0 +1,70 @@
+"""
+Websocket wire formats, negotiated with Sec-WebSocket-Protocol header
+
+  - "ugubot.json": plain JSON, also used when client doesn't ask for any protocol
+  - "ugubot.columnar": JSON where lists of records with the same keys, like messages, are sent column by column:
+    {"$n": <length>, "$cols": {<key>: <column>}}. Columns of ints are delta-encoded as {"$d": [first, delta...]},
+    columns with few distinct values are dictionary-encoded as {"$k": [value...], "$i": [index...]}, other
+    columns are plain lists. Keys aren't repeated for every record, and the rest compresses better with
+    permessage-deflate. See ugubot-frontend/src/protocol.js for decoder
+"""
+import json
+import typing as t
+
+JSON = "ugubot.json"
+COLUMNAR = "ugubot.columnar"
+# In order of preference
+PROTOCOLS = (COLUMNAR, JSON)
+
+
+def negotiate(requested: t.Sequence[str]) -> t.Optional[str]:
+    """
+    Protocol to accept among the ones requested by client, None for plain JSON without a protocol
+    """
+    for protocol in PROTOCOLS:
+        if protocol in requested:
+            return protocol
+
+    return None
+
+
+def _encode_column(values: t.List[t.Any]) -> t.Any:
+    if all(type(value) is int for value in values):
+        return {"$d": [values[0]] + [b - a for a, b in zip(values, values[1:])]}
+
+    if all(value is None or isinstance(value, (str, bool, int, float)) for value in values):
+        index: t.Dict[t.Any, int] = {}
+        # bool and int keys would collide in dict: True == 1
+        codes = [index.setdefault((type(value), value), len(index)) for value in values]
+
+        if len(index) * 2 <= len(values):
+            return {"$k": [value for _, value in index], "$i": codes}
+
+    return values
+
+
+def to_columnar(data: t.Any) -> t.Any:
+    if isinstance(data, dict):
+        return {key: to_columnar(value) for key, value in data.items()}
+
+    if not isinstance(data, list):
+        return data
+
+    data = [to_columnar(value) for value in data]
+
+    if len(data) < 2 or not all(isinstance(value, dict) for value in data):
+        return data
+
+    keys = list(data[0])
+
+    if not keys or any(len(value) != len(keys) or any(key not in value for key in keys) for value in data):
+        return data
+
+    return {"$n": len(data), "$cols": {key: _encode_column([value[key] for value in data]) for key in keys}}
+
+
+def encode(data: t.Any, protocol: t.Optional[str]) -> str:
+    if protocol == COLUMNAR:
+        data = to_columnar(data)
+
+    return json.dumps(data, separators=(",", ":"))
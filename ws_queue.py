@@ -0,0 +1,345 @@
+"""
+Bounded outbound queues of websocket clients
+
+Command responses are always queued. A command counts against `webui.max_inflight_commands` until its response is
+sent, and no more commands are read meanwhile, so queued responses are bounded by that limit. Events are bounded by
+`webui.client_queue_size`; when a client doesn't keep up, `webui.client_overflow` policy applies:
+  - "resync": queued events collapse into one resync_required marker listing affected chats, and further events
+    are folded into it until it is sent. Client reloads those chats
+  - "drop_oldest": oldest queued event is dropped
+  - "disconnect": client is disconnected, it reconnects and loads everything anew
+
+Broadcast events are encoded once per protocol and the same EncodedEvent is queued to every client. With
+`webui.event_batch_ms` window, new_message events arriving within it are packed into one new_messages frame.
+
+Usage:
+    python ws_queue.py benchmark [--clients N] [--events N] [--batch N]  # compare delivery costs on simulated clients
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+import typing as t
+from collections import Counter, deque
+
+import ws_protocol
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("resync", "drop_oldest", "disconnect")
+RESYNC_COMMAND = "resync_required"
+
+# Counters of all clients, including disconnected ones
+totals: Counter = Counter()
+
+
+class EncodedEvent:
+    """
+    Event encoded once for all clients of the same protocol, with chats it touches and ids of bus events it carries
+    """
+
+    __slots__ = ("event", "chats", "ids", "_texts")
+
+    def __init__(self, event: t.Dict[str, t.Any], chats: t.Iterable[int], ids: t.Iterable[str] = ()) -> None:
+        self.event = event
+        self.chats = tuple(chats)
+        self.ids = tuple(ids)
+        self._texts: t.Dict[t.Optional[str], str] = {}
+
+    def text(self, protocol: t.Optional[str] = None) -> str:
+        text = self._texts.get(protocol)
+
+        if text is None:
+            text = self._texts[protocol] = ws_protocol.encode(self.event, protocol)
+
+        return text
+
+
+def _chat_of(event: t.Mapping[str, t.Any]) -> t.Optional[int]:
+    message = event.get("message")
+    return message.get("chat") if isinstance(message, dict) else None
+
+
+def _pack(batch: t.List[t.Dict[str, t.Any]]) -> t.List[EncodedEvent]:
+    if len(batch) < 2:
+        return [EncodedEvent(event, [_chat_of(event)], [event["event_id"]]) for event in batch]
+
+    messages = [event["message"] for event in batch]
+    frame = {
+        "command": "new_messages",
+        "messages": messages,
+        "event_id": batch[-1]["event_id"],
+        "epoch": batch[-1].get("epoch"),
+    }
+    chats = dict.fromkeys(message["chat"] for message in messages)
+    return [EncodedEvent(frame, chats, [event["event_id"] for event in batch])]
+
+
+def encode_events(events: t.Iterable[t.Tuple[str, t.Dict[str, t.Any]]], pack: bool = False) -> t.List[EncodedEvent]:
+    """
+    Encode (id, event) pairs of event bus; with `pack` runs of new_message events are packed into one frame
+    """
+    frames, batch = [], []
+
+    for event_id, event in events:
+        event = {**event, "event_id": event_id}
+
+        if pack and event.get("command") == "new_message":
+            batch.append(event)
+            continue
+
+        frames += _pack(batch)
+        batch = []
+        frames += _pack([event])
+
+    return frames + _pack(batch)
+
+
+class ClientQueue:
+    def __init__(self, max_events: int, policy: str) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {', '.join(POLICIES)}")
+
+        self.max_events = max_events
+        self.policy = policy
+        self.disconnected = False
+        self.dropped = 0
+
+        self._items: "deque[t.Tuple[bool, t.Any]]" = deque()  # (is_event, item)
+        self._events = 0
+        self._resync: t.Optional[t.Dict[str, t.Any]] = None  # sent as dict, it changes until then
+        self._ready = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _put(self, is_event: bool, item: t.Any) -> None:
+        self._items.append((is_event, item))
+        self._events += is_event
+        self._ready.set()
+
+    def put_response(self, response: t.Any) -> None:
+        self._put(False, response)
+
+    def put_event(self, event: EncodedEvent) -> None:
+        if self.disconnected:
+            return
+
+        if self._resync is not None:
+            self._fold(event)
+            return
+
+        if self._events < self.max_events:
+            self._put(True, event)
+            return
+
+        totals["overflows"] += 1
+
+        if self.policy == "disconnect":
+            logger.warning("Websocket client doesn't keep up with events, disconnecting it")
+            totals["disconnects"] += 1
+            self.disconnected = True
+            self._ready.set()
+            return
+
+        if self.policy == "drop_oldest":
+            for i, (is_event, _) in enumerate(self._items):
+                if is_event:
+                    del self._items[i]
+                    self._events -= 1
+                    self._count_dropped(1)
+                    break
+
+            self._put(True, event)
+            return
+
+        self._resync = {"command": RESYNC_COMMAND, "chats": []}
+        responses = deque()
+
+        for is_event, item in self._items:
+            if is_event:
+                self._fold(item)
+            else:
+                responses.append((False, item))
+
+        self._items = responses
+        self._events = 0
+        self._fold(event)
+        self._put(True, self._resync)
+        totals["resyncs"] += 1
+
+    def put_missed(self, events: t.Iterable[EncodedEvent]) -> None:
+        """
+        Queue events client missed before connecting ahead of events queued since then. Events both missed and
+        queued, i.e. published while the missed ones were being read, are queued once
+        """
+        if self._resync is not None or self.disconnected:
+            for event in events:
+                self.put_event(event)
+            return
+
+        queued, self._items, self._events = self._items, deque(), 0
+        received = {event_id for is_event, item in queued if is_event for event_id in item.ids}
+
+        missed = [event for event in events if received.isdisjoint(event.ids)]
+
+        for is_event, item in queued:
+            if not is_event:
+                self._put(False, item)
+                continue
+
+            for event in missed:
+                self.put_event(event)
+
+            missed = []
+            self.put_event(item)
+
+        for event in missed:
+            self.put_event(event)
+
+    def _fold(self, event: EncodedEvent) -> None:
+        """
+        Drop event in favour of resync marker
+        """
+        for chat in event.chats:
+            if chat is not None and chat not in self._resync["chats"]:
+                self._resync["chats"].append(chat)
+
+        self._count_dropped(1)
+
+    def _count_dropped(self, n: int) -> None:
+        self.dropped += n
+        totals["dropped"] += n
+
+    async def get(self) -> t.Any:
+        """
+        Next item to send, or None when client is to be disconnected
+        """
+        while not self._items and not self.disconnected:
+            self._ready.clear()
+            await self._ready.wait()
+
+        if self.disconnected:
+            return None
+
+        is_event, item = self._items.popleft()
+        self._events -= is_event
+
+        if item is self._resync:
+            self._resync = None
+
+        return item
+
+
+def create_queue() -> ClientQueue:
+    return ClientQueue(
+        max_events=settings.get("webui.client_queue_size", 1000),
+        policy=settings.get("webui.client_overflow", "resync"),
+    )
+
+
+def queue_stats(queues: t.Iterable[ClientQueue]) -> t.Dict[str, t.Any]:
+    queues = list(queues)
+    depths = [len(q) for q in queues]
+
+    return {
+        "clients": len(queues),
+        "queued": sum(depths),
+        "max_depth": max(depths, default=0),
+        "max_dropped": max((q.dropped for q in queues), default=0),
+        **{name: totals[name] for name in ("overflows", "dropped", "resyncs", "disconnects")},
+    }
+
+
+def _fake_message(n: int) -> t.Dict[str, t.Any]:
+    return {
+        "command": "new_message",
+        "message": {
+            "id": n,
+            "chat": n % 10,
+            "utctime": 1700000000000 + n,
+            "msg_type": "MUC_PUBLIC",
+            "nick": f"user{n % 50}",
+            "text": "Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 2,
+            "outgoing": False,
+        },
+    }
+
+
+async def _deliver(
+    n_clients: int, events: t.List[t.Tuple[str, t.Dict[str, t.Any]]], mode: str, batch_size: int
+) -> t.Tuple[float, int]:
+    """
+    Deliver events to simulated clients whose socket just counts bytes; returns (seconds, frames sent).
+    In "batched" mode every `batch_size` events stand for those arriving within one batching window
+    """
+    queues = [ClientQueue(len(events) + 1, "resync") for _ in range(n_clients)]
+    sent = Counter()
+
+    async def sender(q: ClientQueue) -> None:
+        while True:
+            message = await q.get()
+
+            # Old sender re-encoded every event for every socket with send_json()
+            text = json.dumps(message) if isinstance(message, dict) else message.text()
+            sent["frames"] += 1
+            sent["bytes"] += len(text)
+
+    senders = [asyncio.create_task(sender(q)) for q in queues]
+    started = time.perf_counter()
+
+    if mode == "per client":
+        for event_id, event in events:
+            event = {**event, "event_id": event_id}
+
+            for q in queues:
+                q.put_response(event)
+    else:
+        step = batch_size if mode == "batched" else 1
+
+        for i in range(0, len(events), step):
+            for frame in encode_events(events[i : i + step], pack=step > 1):
+                for q in queues:
+                    q.put_event(frame)
+
+    while any(len(q) for q in queues):
+        await asyncio.sleep(0)
+
+    elapsed = time.perf_counter() - started
+
+    for task in senders:
+        task.cancel()
+
+    await asyncio.gather(*senders, return_exceptions=True)
+    return elapsed, sent["frames"]
+
+
+def benchmark(n_clients: int, n_events: int, batch_size: int) -> None:
+    events = [(str(n), _fake_message(n)) for n in range(n_events)]
+    print(f"{n_events} new_message events to {n_clients} clients, {batch_size} events per batching window")
+
+    for mode in ("per client", "encoded once", "batched"):
+        elapsed, frames = asyncio.run(_deliver(n_clients, events, mode, batch_size))
+        print(
+            f"  {mode}: {elapsed * 1000:.0f} ms, {elapsed * 1e6 / (n_events * n_clients):.2f} us per event and client,"
+            f" {frames} frames"
+        )
+
+
+def main(argv: t.List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Websocket broadcast benchmark")
+    parser.add_argument("command", choices=("benchmark",))
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=10, help="events arriving within one batching window")
+    args = parser.parse_args(argv[1:])
+
+    benchmark(args.clients, args.events, args.batch)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -61,6 +61,7 @@ class XMPPClient:
         self.running = False
 
         self.joined_rooms: t.List[aioxmpp.muc.Room] = []
+        self._handler_tasks: t.Set[asyncio.Task] = set()
 
         self.handlers = {
             Handler.MESSAGE.value: [],
@@ -111,6 +112,24 @@ class XMPPClient:
 
         return deco
 
+    def _call_handlers(self, handler: Handler, *args, **kwargs):
+        """
+        Call registered handlers. Coroutine handlers are scheduled as tasks in order of arrival
+        """
+        for func in self.handlers[handler.value]:
+            result = func(*args, **kwargs)
+
+            if asyncio.iscoroutine(result):
+                task = asyncio.ensure_future(result)
+                self._handler_tasks.add(task)
+                task.add_done_callback(self._on_handler_task_done)
+
+    def _on_handler_task_done(self, task: asyncio.Task):
+        self._handler_tasks.discard(task)
+
+        if not task.cancelled() and task.exception():
+            logger.error("Handler failed", exc_info=task.exception())
+
     async def on_iq_version_query(self, iq: aioxmpp.IQ):
         logger.info("IQ request from {!r}".format(iq.from_))
         result = Query()
@@ -128,8 +147,7 @@ class XMPPClient:
         if len(msg.body) == 0:
             return
 
-        for handler in self.handlers[Handler.MESSAGE.value]:
-            handler(msg)
+        self._call_handlers(Handler.MESSAGE, msg)
 
     def on_muc_message(self, message: aioxmpp.Message, member: aioxmpp.muc.Occupant, source, **kwargs):
         room = self.get_room_by_muc_jid(member.conversation_jid)
@@ -145,28 +163,24 @@ class XMPPClient:
         if member.is_self:
             logger.info(f"(outgoing) {log}")
 
-            for handler in self.handlers[Handler.OUTGOING_MUC_MESSAGE.value]:
-                handler(message, member, source, **kwargs)
+            self._call_handlers(Handler.OUTGOING_MUC_MESSAGE, message, member, source, **kwargs)
 
             return
 
         logger.info(log)
 
-        for handler in self.handlers[Handler.MUC_MESSAGE.value]:
-            handler(message, member, source, **kwargs)
+        self._call_handlers(Handler.MUC_MESSAGE, message, member, source, **kwargs)
 
     def on_muc_enter(self, presence: aioxmpp.Presence, occupant: aioxmpp.muc.Occupant, **kwargs):
         logger.info(f"Joined room {presence.from_} {occupant.nick}")
 
-        for handler in self.handlers[Handler.MUC_ENTER.value]:
-            handler(presence, occupant, **kwargs)
+        self._call_handlers(Handler.MUC_ENTER, presence, occupant, **kwargs)
 
     def on_muc_user_join(self, member: aioxmpp.muc.Occupant, **kwargs):
         muc_jid: aioxmpp.JID = member.conversation_jid
         logger.info(f"{muc_jid.bare()}: +{member.nick}")
 
-        for handler in self.handlers[Handler.MUC_USER_JOIN.value]:
-            handler(member, **kwargs)
+        self._call_handlers(Handler.MUC_USER_JOIN, member, **kwargs)
 
     def on_muc_leave(
         self,
@@ -178,14 +192,12 @@ class XMPPClient:
         leave_mode = repr(muc_leave_mode) if muc_leave_mode else "Unknown reason"
         logger.info(f"{muc_jid.bare()}: -{occupant.nick} ({leave_mode})")
 
-        for handler in self.handlers[Handler.MUC_USER_LEAVE.value]:
-            handler(occupant, muc_leave_mode, **kwargs)
+        self._call_handlers(Handler.MUC_USER_LEAVE, occupant, muc_leave_mode, **kwargs)
 
     def on_muc_topic_changed(self, member: aioxmpp.muc.ServiceMember, new_topic, *args, **kwargs):
         logger.info(f"Topic changed by {member.conversation_jid}\n{new_topic.any()}")
 
-        for handler in self.handlers[Handler.MUC_TOPIC_CHANGED.value]:
-            handler(member, new_topic, *args, **kwargs)
+        self._call_handlers(Handler.MUC_TOPIC_CHANGED, member, new_topic, *args, **kwargs)
 
     def join_room(self, jid: str, nick: str):
         jid = aioxmpp.JID.fromstr(jid)
@@ -206,8 +218,7 @@ class XMPPClient:
         if isinstance(stanza, Message) and stanza.type_ == MessageType.CHAT:
             stanza.from_ = self.client.local_jid
 
-            for handler in self.handlers[Handler.OUTGOING_MESSAGE.value]:
-                handler(stanza)
+            self._call_handlers(Handler.OUTGOING_MESSAGE, stanza)
 
     async def run(self):
         self.running = True
@@ -221,3 +232,10 @@ class XMPPClient:
     def stop(self):
         self.running = False
         self.client.stop()
+
+    async def wait_handlers(self):
+        """
+        Wait for handler tasks still in flight, including ones scheduled while waiting
+        """
+        while self._handler_tasks:
+            await asyncio.wait(set(self._handler_tasks))